@@ -230,6 +230,12 @@ class PyKotaDumperGUI(DumPyKota) :
                     elif self.options.format == "cups" :
                         ctype = "text/plain"
                         fname = "page_log"
+                    elif self.options.format == "typedtsv" :
+                        ctype = "application/x-gzip"
+                        fname = "dump.tsv.gz"
+                    elif self.options.format == "parquet" :
+                        ctype = "application/octet-stream"
+                        fname = "dump.parquet"
                     sys.stdout.write("Content-type: %s\n" % ctype)
                     sys.stdout.write("Content-disposition: attachment; filename=%s\n\n" % fname)
                     self.main(self.arguments, self.options, restricted=0)
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyKota : Print Quotas for CUPS
+#
+# (c) 2003-2013 Jerome Alet <alet@librelogiciel.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id$
+
+
+"""Moves the job entries of an LDAP Quota Storage to the containers
+   set by the jobcontainers directive in pykota.conf, or back below
+   jobbase if this directive is unset.
+
+   It must be run as a user who can read pykotadmin.conf, and can
+   safely be run again if it was interrupted.
+"""
+
+import sys
+
+import pykota.appinit
+
+from pykota.tool import PyKotaTool
+from pykota.errors import PyKotaStorageError
+
+class MoveJobs(PyKotaTool) :
+    """A tool which only needs to open the database."""
+    pass
+
+if __name__ == "__main__" :
+    retcode = 0
+    movejobs = MoveJobs()
+    try :
+        movejobs.deferredInit()
+        storage = movejobs.storage
+        if not hasattr(storage, "moveJobsToContainers") :
+            sys.stderr.write("This script only works with an LDAP Quota Storage.\n")
+            retcode = -1
+        else :
+            containers = storage.info["jobcontainers"]
+            sys.stdout.write("Moving job entries below %s" % storage.info["jobbase"])
+            if containers :
+                sys.stdout.write(", in containers per %s" % " then per ".join(containers))
+            sys.stdout.write("...\n")
+            try :
+                moved = storage.moveJobsToContainers()
+            except PyKotaStorageError, msg :
+                sys.stderr.write("%s\n" % msg)
+                retcode = -1
+            else :
+                sys.stdout.write("%i job entries moved.\n" % moved)
+    finally :
+        movejobs.clean()
+    sys.exit(retcode)
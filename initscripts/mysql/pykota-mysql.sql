@@ -169,6 +169,17 @@ CREATE TABLE printergroupsmembers(groupid INT4 NOT NULL,
                            INDEX (printerid),
                            FOREIGN KEY (printerid) REFERENCES printers(id),
                            PRIMARY KEY (groupid, printerid)) TYPE=INNODB;
+
+--
+-- Create the printer groups closure : each printer's
+-- printer groups, either directly or through other ones.
+--
+CREATE TABLE printergroupsclosure(ancestorid INT4 NOT NULL,
+                           descendantid INT4 NOT NULL,
+                           FOREIGN KEY (ancestorid) REFERENCES printers(id),
+                           INDEX (descendantid),
+                           FOREIGN KEY (descendantid) REFERENCES printers(id),
+                           PRIMARY KEY (ancestorid, descendantid)) TYPE=INNODB;
 --
 -- Create the table for payments
 --
@@ -139,6 +139,7 @@ CREATE UNIQUE INDEX grouppquota_up_id_ix ON grouppquota (groupid, printerid);
 CREATE TABLE groupsmembers(groupid INT4 REFERENCES groups(id),
                            userid INT4 REFERENCES users(id),
                            PRIMARY KEY (groupid, userid));
+CREATE INDEX groupsmembers_u_id_ix ON groupsmembers (userid);
 
 --
 -- Create the printer groups relationship
@@ -146,6 +147,15 @@ CREATE TABLE groupsmembers(groupid INT4 REFERENCES groups(id),
 CREATE TABLE printergroupsmembers(groupid INT4 REFERENCES printers(id),
                            printerid INT4 REFERENCES printers(id),
                            PRIMARY KEY (groupid, printerid));
+
+--
+-- Create the printer groups closure : each printer's
+-- printer groups, either directly or through other ones.
+--
+CREATE TABLE printergroupsclosure(ancestorid INT4 REFERENCES printers(id),
+                           descendantid INT4 REFERENCES printers(id),
+                           PRIMARY KEY (ancestorid, descendantid));
+CREATE INDEX printergroupsclosure_d_id_ix ON printergroupsclosure (descendantid);
 --
 -- Create the table for payments
 --
@@ -177,10 +187,10 @@ CREATE TABLE billingcodes (id SERIAL PRIMARY KEY NOT NULL,
 --
 -- Set some ACLs
 --
-REVOKE ALL ON users, groups, printers, userpquota, grouppquota, groupsmembers, printergroupsmembers, jobhistory, payments, coefficients, billingcodes FROM public;
+REVOKE ALL ON users, groups, printers, userpquota, grouppquota, groupsmembers, printergroupsmembers, printergroupsclosure, jobhistory, payments, coefficients, billingcodes FROM public;
 REVOKE ALL ON users_id_seq, groups_id_seq, printers_id_seq, userpquota_id_seq, grouppquota_id_seq, jobhistory_id_seq, payments_id_seq, coefficients_id_seq, billingcodes_id_seq FROM public;
 
-GRANT SELECT, INSERT, UPDATE, DELETE, REFERENCES ON users, groups, printers, userpquota, grouppquota, groupsmembers, printergroupsmembers, jobhistory, payments, coefficients, billingcodes TO pykotaadmin;
+GRANT SELECT, INSERT, UPDATE, DELETE, REFERENCES ON users, groups, printers, userpquota, grouppquota, groupsmembers, printergroupsmembers, printergroupsclosure, jobhistory, payments, coefficients, billingcodes TO pykotaadmin;
 GRANT SELECT, UPDATE ON users_id_seq, groups_id_seq, printers_id_seq, userpquota_id_seq, grouppquota_id_seq, jobhistory_id_seq, payments_id_seq, coefficients_id_seq, billingcodes_id_seq TO pykotaadmin;
-GRANT SELECT ON users, groups, printers, userpquota, grouppquota, groupsmembers, printergroupsmembers, jobhistory, payments, coefficients, billingcodes TO pykotauser;
+GRANT SELECT ON users, groups, printers, userpquota, grouppquota, groupsmembers, printergroupsmembers, printergroupsclosure, jobhistory, payments, coefficients, billingcodes TO pykotauser;
 
@@ -0,0 +1,60 @@
+--
+-- PyKota - Print Quotas for CUPS
+--
+-- (c) 2003-2013 Jerome Alet <alet@librelogiciel.com>
+-- This program is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU General Public License as published by
+-- the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- This program is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU General Public License for more details.
+--
+-- You should have received a copy of the GNU General Public License
+-- along with this program.  If not, see <http://www.gnu.org/licenses/>.
+--
+-- $Id$
+--
+--
+--
+-- This script has to be used if you already
+-- have a pre-1.28 version of PyKota to upgrade
+-- your database schema, once upgrade-to-1.27.sql
+-- was applied.
+--
+-- YOU DON'T NEED TO USE IT IF YOU'VE JUST INSTALLED PYKOTA
+--
+
+--
+-- Create the printer groups closure : each printer's
+-- printer groups, either directly or through other ones.
+--
+CREATE TABLE printergroupsclosure(ancestorid INT4 REFERENCES printers(id),
+                           descendantid INT4 REFERENCES printers(id),
+                           PRIMARY KEY (ancestorid, descendantid));
+CREATE INDEX printergroupsclosure_d_id_ix ON printergroupsclosure (descendantid);
+REVOKE ALL ON printergroupsclosure FROM public;
+GRANT SELECT, INSERT, UPDATE, DELETE, REFERENCES ON printergroupsclosure TO pykotaadmin;
+GRANT SELECT ON printergroupsclosure TO pykotauser;
+
+--
+-- Index the groups of each user, for the group balances
+--
+CREATE INDEX groupsmembers_u_id_ix ON groupsmembers (userid);
+
+--
+-- Now fills the printer groups closure.
+-- With PostgreSQL older than 8.4, remove this and
+-- use 'pkprinters --checkgroups' instead.
+--
+BEGIN;
+INSERT INTO printergroupsclosure (ancestorid, descendantid)
+    WITH RECURSIVE closure(ancestorid, descendantid) AS
+        (SELECT groupid, printerid FROM printergroupsmembers
+         UNION SELECT printergroupsmembers.groupid, closure.descendantid
+               FROM printergroupsmembers JOIN closure ON printergroupsmembers.printerid=closure.ancestorid)
+    SELECT ancestorid, descendantid FROM closure WHERE ancestorid<>descendantid;
+COMMIT;
+
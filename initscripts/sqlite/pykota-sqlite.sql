@@ -122,6 +122,7 @@ CREATE UNIQUE INDEX grouppquota_up_id_ix ON grouppquota (groupid, printerid);
 CREATE TABLE groupsmembers(groupid INT4 REFERENCES groups(id),
                            userid INT4 REFERENCES users(id),
                            PRIMARY KEY (groupid, userid));
+CREATE INDEX groupsmembers_u_id_ix ON groupsmembers (userid);
 
 --
 -- Create the printer groups relationship
@@ -129,6 +130,15 @@ CREATE TABLE groupsmembers(groupid INT4 REFERENCES groups(id),
 CREATE TABLE printergroupsmembers(groupid INT4 REFERENCES printers(id),
                            printerid INT4 REFERENCES printers(id),
                            PRIMARY KEY (groupid, printerid));
+
+--
+-- Create the printer groups closure : each printer's
+-- printer groups, either directly or through other ones.
+--
+CREATE TABLE printergroupsclosure(ancestorid INT4 REFERENCES printers(id),
+                           descendantid INT4 REFERENCES printers(id),
+                           PRIMARY KEY (ancestorid, descendantid));
+CREATE INDEX printergroupsclosure_d_id_ix ON printergroupsclosure (descendantid);
 --
 -- Create the table for payments
 --
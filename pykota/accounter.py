@@ -23,8 +23,6 @@
 """This module defines base classes used by all accounting methods."""
 
 import sys
-import os
-import imp
 
 from pykota.errors import PyKotaAccounterError
 
@@ -89,12 +87,13 @@ def openAccounter(kotafilter, ispreaccounter=0) :
         (backend, args) = kotafilter.config.getPreAccounterBackend(kotafilter.PrinterName)
     else :
         (backend, args) = kotafilter.config.getAccounterBackend(kotafilter.PrinterName)
+    modulename = "pykota.accounters.%s" % backend.lower()
     try :
-        accounterbackend = imp.load_source("accounterbackend",
-                                            os.path.join(os.path.dirname(__file__),
-                                                         "accounters",
-                                                         "%s.py" % backend.lower()))
+        # modules already imported, e.g. preloaded by the
+        # accounting daemon, are reused.
+        __import__(modulename)
     except ImportError :
         raise PyKotaAccounterError, _("Unsupported accounter backend %s") % backend
     else :
+        accounterbackend = sys.modules[modulename]
         return accounterbackend.Accounter(kotafilter, args, ispreaccounter, backend.lower())
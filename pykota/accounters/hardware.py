@@ -26,8 +26,9 @@ import os
 import signal
 import popen2
 
-from pykota.errors import PyKotaAccounterError
+from pykota.errors import PyKotaAccounterError, PyKotaStorageError
 from pykota.accounter import AccounterBase
+from pykota import snmppoller, printerstats
 from pykota.accounters import snmp, pjl
 
 class Accounter(AccounterBase) :
@@ -35,6 +36,21 @@ class Accounter(AccounterBase) :
         """Initializes querying accounter."""
         AccounterBase.__init__(self, kotabackend, arguments, ispreaccounter, name)
         self.isSoftware = 0
+        self.printerStats = None
+
+    def getPrinterStats(self) :
+        """Returns the printers' timing statistics, or None if not kept."""
+        if self.printerStats is None :
+            filename = self.filter.config.getPrinterStats()
+            if filename :
+                try :
+                    self.printerStats = printerstats.PrinterStats(self.filter, filename)
+                except PyKotaStorageError, msg :
+                    self.filter.printInfo(str(msg), "warn")
+                    self.printerStats = False
+            else :
+                self.printerStats = False
+        return self.printerStats or None
 
     def getPrinterInternalPageCounter(self) :
         """Returns the printer's internal page counter."""
@@ -113,7 +129,12 @@ class Accounter(AccounterBase) :
         commandline = self.arguments.strip() % locals()
         cmdlower = commandline.lower()
         if (cmdlower == "snmp") or cmdlower.startswith("snmp:") :
-            return snmp.Handler(self, printer, skipinitialwait).retrieveInternalPageCounter()
+            pollersocket = snmppoller.getSocketPath(self.filter.config)
+            if pollersocket :
+                handler = snmp.PolledHandler(self, printer, skipinitialwait, pollersocket)
+            else :
+                handler = snmp.Handler(self, printer, skipinitialwait)
+            return handler.retrieveInternalPageCounter()
         elif (cmdlower == "pjl") or cmdlower.startswith("pjl:") :
             return pjl.Handler(self, printer, skipinitialwait).retrieveInternalPageCounter()
 
@@ -26,13 +26,15 @@ a printer's internal page counter over a TCP connection."""
 import sys
 import os
 import socket
+import select
+import errno
 import time
-import threading
-import Queue
 
-from pykota import constants
+from pykota import constants, printerstats
 
 FORMFEEDCHAR = chr(0x0c)     # Form Feed character, ends PJL answers.
+READSIZE = 4096              # Number of bytes read at once.
+ANSWERTIMEOUT = 5            # Seconds to wait for an answer before complaining.
 
 # Old method : PJLMESSAGE = "\033%-12345X@PJL USTATUSOFF\r\n@PJL INFO STATUS\r\n@PJL INFO PAGECOUNT\r\n\033%-12345X"
 # Here's a new method, which seems to work fine on my HP2300N, while the
@@ -53,7 +55,13 @@ PJLSTATUSVALUES = {
                   }
 
 class Handler :
-    """A class for PJL print accounting."""
+    """A class for PJL print accounting.
+
+       The connection to the printer is opened at the first query, then
+       kept open for all the queries done while waiting for the printer,
+       and closed once the page counter is known, so that the printer
+       is available again for the print job itself.
+    """
     def __init__(self, parent, printerhostname, skipinitialwait=False) :
         self.parent = parent
         self.printerHostname = printerhostname
@@ -63,11 +71,9 @@ class Handler :
         except (IndexError, ValueError) :
             self.port = 9100
         self.printerInternalPageCounter = self.printerStatus = None
-        self.closed = False
+        self.schedule = printerstats.PollingSchedule(parent)
         self.sock = None
-        self.queue = None
-        self.readthread = None
-        self.quitEvent = threading.Event()
+        self.readbuffer = ""
 
     def __del__(self) :
         """Ensures the network connection is closed at object deletion time."""
@@ -80,105 +86,122 @@ class Handler :
             sock.settimeout(1.0)
             sock.connect((self.printerHostname, self.port))
         except socket.error, msg :
+            sock.close()
             self.parent.filter.printInfo(_("Problem during connection to %s:%s : %s") % (self.printerHostname, self.port, str(msg)), "warn")
             return False
         else :
             self.sock = sock
-            self.closed = False
-            self.quitEvent.clear()
-            self.queue = Queue.Queue(0)
-            self.readthread = threading.Thread(target=self.readloop)
-            self.readthread.start()
-            time.sleep(1)
+            self.readbuffer = ""
             self.parent.filter.logdebug("Connected to printer %s:%s" % (self.printerHostname, self.port))
             return True
 
     def close(self) :
         """Closes the network connection."""
-        if not self.closed :
-            self.quitEvent.set()
-            if self.readthread is not None :
-                self.readthread.join()
-                self.readthread = None
-            if self.sock is not None :
-                self.sock.close()
-                self.sock = None
+        if self.sock is not None :
+            self.sock.close()
+            self.sock = None
+            self.readbuffer = ""
             self.parent.filter.logdebug("Connection to %s:%s is now closed." % (self.printerHostname, self.port))
-            self.queue = None
-            self.closed = True
 
-    def readloop(self) :
-        """Reading loop thread."""
-        self.parent.filter.logdebug("Reading thread started.")
-        readbuffer = []
-        while not self.quitEvent.isSet() :
-            try :
-                answer = self.sock.recv(1)
-            except socket.timeout :
-                pass
-            except socket.error, (dummy, msg) :
-                self.parent.filter.printInfo(_("Problem while receiving PJL answer from %s:%s : %s") % (self.printerHostname, self.port, str(msg)), "warn")
-            else :
-                if answer :
-                    readbuffer.append(answer)
-                    if answer.endswith(FORMFEEDCHAR) :
-                        self.queue.put("".join(readbuffer))
-                        readbuffer = []
-        if readbuffer :
-            self.queue.put("".join(readbuffer))
-        self.parent.filter.logdebug("Reading thread ended.")
+    def receive(self, timeout) :
+        """Reads what the printer sent, waiting at most timeout seconds.
+
+           Returns False if nothing was received in time.
+        """
+        try :
+            (readable, dummy, dummy) = select.select([self.sock], [], [], timeout)
+        except select.error, msg :
+            if msg[0] == errno.EINTR :
+                return False
+            raise socket.error, msg[1]
+        if not readable :
+            return False
+        data = self.sock.recv(READSIZE)
+        if not data :
+            raise socket.error, "Connection closed by printer"
+        self.readbuffer += data
+        return True
+
+    def readAnswer(self, timeout) :
+        """Returns the next complete PJL answer, or None if none was received in time."""
+        deadline = time.time() + timeout
+        while FORMFEEDCHAR not in self.readbuffer :
+            remaining = deadline - time.time()
+            if (remaining <= 0) or not self.receive(remaining) :
+                if time.time() >= deadline :
+                    return None
+        (answer, self.readbuffer) = self.readbuffer.split(FORMFEEDCHAR, 1)
+        return answer
+
+    def sendQuery(self) :
+        """Sends the PJL query, after having dropped what remains from a previous one."""
+        while self.receive(0) :
+            pass
+        self.readbuffer = ""
+        self.sock.sendall(PJLMESSAGE)
+        self.parent.filter.logdebug("Query sent to %s : %s" % (self.printerHostname, repr(PJLMESSAGE)))
 
     def retrievePJLValues(self) :
         """Retrieves a printer's internal page counter and status via PJL."""
-        while not self.open() :
+        while (self.sock is None) and not self.open() :
             self.parent.filter.logdebug("Will retry in 1 second.")
             time.sleep(1)
+        actualpagecount = self.printerStatus = None
         try :
-            try :
-                nbsent = self.sock.send(PJLMESSAGE)
-                if nbsent != len(PJLMESSAGE) :
-                    raise socket.error, "Short write"
-            except socket.error, msg :
-                self.parent.filter.printInfo(_("Problem while sending PJL query to %s:%s : %s") % (self.printerHostname, self.port, str(msg)), "warn")
-            else :
-                self.parent.filter.logdebug("Query sent to %s : %s" % (self.printerHostname, repr(PJLMESSAGE)))
-                actualpagecount = self.printerStatus = None
-                while (actualpagecount is None) or (self.printerStatus is None) :
-                    try :
-                        answer = self.queue.get(True, 5)
-                    except Queue.Empty :
-                        self.parent.filter.logdebug("Timeout when reading printer's answer from %s:%s" % (self.printerHostname, self.port))
-                    else :
-                        readnext = False
-                        self.parent.filter.logdebug("PJL answer : %s" % repr(answer))
-                        for line in [l.strip() for l in answer.split()] :
-                            if line.startswith("CODE=") :
-                                self.printerStatus = line.split("=")[1]
-                                self.parent.filter.logdebug("Found status : %s" % self.printerStatus)
-                            elif line.startswith("PAGECOUNT=") :
-                                try :
-                                    actualpagecount = int(line.split('=')[1].strip())
-                                except ValueError :
-                                    self.parent.filter.logdebug("Received incorrect datas : [%s]" % line.strip())
-                                else :
-                                    self.parent.filter.logdebug("Found pages counter : %s" % actualpagecount)
-                            elif line.startswith("PAGECOUNT") :
-                                readnext = True # page counter is on next line
-                            elif readnext :
-                                try :
-                                    actualpagecount = int(line.strip())
-                                except ValueError :
-                                    self.parent.filter.logdebug("Received incorrect datas : [%s]" % line.strip())
-                                else :
-                                    self.parent.filter.logdebug("Found pages counter : %s" % actualpagecount)
-                                    readnext = False
-                self.printerInternalPageCounter = max(actualpagecount, self.printerInternalPageCounter)
-        finally :
+            self.sendQuery()
+            while (actualpagecount is None) or (self.printerStatus is None) :
+                answer = self.readAnswer(ANSWERTIMEOUT)
+                if answer is None :
+                    self.parent.filter.logdebug("Timeout when reading printer's answer from %s:%s" % (self.printerHostname, self.port))
+                else :
+                    readnext = False
+                    self.parent.filter.logdebug("PJL answer : %s" % repr(answer))
+                    for line in [l.strip() for l in answer.split()] :
+                        if line.startswith("CODE=") :
+                            self.printerStatus = line.split("=")[1]
+                            self.parent.filter.logdebug("Found status : %s" % self.printerStatus)
+                        elif line.startswith("PAGECOUNT=") :
+                            try :
+                                actualpagecount = int(line.split('=')[1].strip())
+                            except ValueError :
+                                self.parent.filter.logdebug("Received incorrect datas : [%s]" % line.strip())
+                            else :
+                                self.parent.filter.logdebug("Found pages counter : %s" % actualpagecount)
+                        elif line.startswith("PAGECOUNT") :
+                            readnext = True # page counter is on next line
+                        elif readnext :
+                            try :
+                                actualpagecount = int(line.strip())
+                            except ValueError :
+                                self.parent.filter.logdebug("Received incorrect datas : [%s]" % line.strip())
+                            else :
+                                self.parent.filter.logdebug("Found pages counter : %s" % actualpagecount)
+                                readnext = False
+        except socket.error, msg :
+            self.parent.filter.printInfo(_("Problem while querying %s:%s with PJL : %s") % (self.printerHostname, self.port, str(msg)), "warn")
             self.close()
+            self.printerStatus = None
+        self.printerInternalPageCounter = max(actualpagecount, self.printerInternalPageCounter)
+
+    def reuseSavedCounter(self) :
+        """Returns True if the page counter saved at the end of the previous job is still right.
+
+           This is the case if the printer is still idle, and its page counter didn't change.
+        """
+        savedcounter = self.schedule.savedCounter()
+        if savedcounter is None :
+            return False
+        self.retrievePJLValues()
+        if (self.printerStatus in ('10000', '10001', '35078', '40000')) \
+           and (self.printerInternalPageCounter == savedcounter) :
+            self.parent.filter.logdebug("Printer %s is idle and its page counter didn't change since the previous job." % self.parent.filter.PrinterName)
+            return True
+        self.parent.filter.logdebug("Printer %s was used since the previous job." % self.parent.filter.PrinterName)
+        return False
 
     def waitPrinting(self) :
         """Waits for printer status being 'printing'."""
-        statusstabilizationdelay = constants.get(self.parent.filter, "StatusStabilizationDelay")
+        statusstabilizationdelay = self.schedule.printingDelay()
         noprintingmaxdelay = constants.get(self.parent.filter, "NoPrintingMaxDelay")
         if not noprintingmaxdelay :
             self.parent.filter.logdebug("Will wait indefinitely until printer %s is in 'printing' state." % self.parent.filter.PrinterName)
@@ -190,6 +213,7 @@ class Handler :
         while True :
             self.retrievePJLValues()
             if self.printerStatus in ('10023', '10003') :
+                self.schedule.sawPrinting()
                 break
             if self.printerInternalPageCounter is not None :
                 if firstvalue is None :
@@ -203,6 +227,7 @@ class Handler :
                         # BUT the page counter increases !!!
                         # So we can probably quit being sure it is printing.
                         self.parent.filter.printInfo("Printer %s is lying to us !!!" % self.parent.filter.PrinterName, "warn")
+                        self.schedule.sawPrinting()
                         break
                     elif noprintingmaxdelay and ((time.time() - timebefore) > noprintingmaxdelay) :
                         # More than X seconds without the printer being in 'printing' mode
@@ -222,12 +247,13 @@ class Handler :
 
     def waitIdle(self) :
         """Waits for printer status being 'idle'."""
-        statusstabilizationdelay = constants.get(self.parent.filter, "StatusStabilizationDelay")
-        statusstabilizationloops = constants.get(self.parent.filter, "StatusStabilizationLoops")
+        statusstabilizationloops = self.schedule.idleLoops()
         idle_num = 0
         while True :
             self.retrievePJLValues()
-            if self.printerStatus in ('10000', '10001', '35078', '40000') :
+            idle_flag = self.printerStatus in ('10000', '10001', '35078', '40000')
+            self.schedule.sawStatus(idle_flag)
+            if idle_flag :
                 if (self.printerInternalPageCounter is not None) \
                    and self.skipinitialwait \
                    and (os.environ.get("PYKOTAPHASE") == "BEFORE") :
@@ -240,22 +266,33 @@ class Handler :
             else :
                 idle_num = 0
             self.parent.filter.logdebug(_("Waiting for printer %s's idle status to stabilize...") % self.parent.filter.PrinterName)
-            time.sleep(statusstabilizationdelay)
+            if idle_flag :
+                time.sleep(self.schedule.idleDelay())
+            else :
+                time.sleep(self.schedule.busyDelay())
 
     def retrieveInternalPageCounter(self) :
         """Returns the page counter from the printer via internal PJL handling."""
         try :
-            if (os.environ.get("PYKOTASTATUS") != "CANCELLED") and \
-               (os.environ.get("PYKOTAACTION") == "ALLOW") and \
-               (os.environ.get("PYKOTAPHASE") == "AFTER") and \
-               self.parent.filter.JobSizeBytes :
-                self.waitPrinting()
-            self.waitIdle()
-        except :
-            self.parent.filter.printInfo(_("PJL querying stage interrupted. Using latest value seen for internal page counter (%s) on printer %s.") % (self.printerInternalPageCounter, self.parent.filter.PrinterName), "warn")
-            raise
-        else :
-            return self.printerInternalPageCounter
+            try :
+                if (os.environ.get("PYKOTASTATUS") != "CANCELLED") and \
+                   (os.environ.get("PYKOTAACTION") == "ALLOW") and \
+                   (os.environ.get("PYKOTAPHASE") == "AFTER") and \
+                   self.parent.filter.JobSizeBytes :
+                    self.waitPrinting()
+                if (os.environ.get("PYKOTAPHASE") == "BEFORE") and self.reuseSavedCounter() :
+                    return self.printerInternalPageCounter
+                self.waitIdle()
+                self.schedule.learn()
+                if os.environ.get("PYKOTAPHASE") == "AFTER" :
+                    self.schedule.saveCounter(self.printerInternalPageCounter, self.printerStatus)
+            except :
+                self.parent.filter.printInfo(_("PJL querying stage interrupted. Using latest value seen for internal page counter (%s) on printer %s.") % (self.printerInternalPageCounter, self.parent.filter.PrinterName), "warn")
+                raise
+            else :
+                return self.printerInternalPageCounter
+        finally :
+            self.close()
 
 def main(hostname) :
     """Tries PJL accounting for a printer host."""
@@ -38,7 +38,7 @@ try :
 except ImportError :
     raise RuntimeError, "The pysnmp v4.x module is not available. Download it from http://pysnmp.sf.net/\nPyKota doesn't support earlier releases anymore."
 
-from pykota import constants
+from pykota import constants, snmppoller, printerstats
 
 #
 # Documentation taken from RFC 3805 (Printer MIB v2) and RFC 2790 (Host Resource MIB)
@@ -104,6 +104,7 @@ class BaseHandler :
         except IndexError :
             self.community = "public"
         self.port = 161
+        self.schedule = printerstats.PollingSchedule(parent)
         self.initValues()
 
     def initValues(self) :
@@ -129,17 +130,22 @@ class BaseHandler :
                     states.append(v)
         return states
 
+    def getErrorMask(self) :
+        """Returns the error mask to use for this printer."""
+        try :
+            errormask = self.parent.filter.config.getPrinterSNMPErrorMask(self.parent.filter.PrinterName)
+        except AttributeError : # debug mode
+            errormask = defaultErrorMask
+        if errormask is None :
+            errormask = defaultErrorMask
+        return errormask
+
     def checkIfError(self, errorstates) :
         """Checks if any error state is fatal or not."""
         if errorstates is None :
             return True
         else :
-            try :
-                errormask = self.parent.filter.config.getPrinterSNMPErrorMask(self.parent.filter.PrinterName)
-            except AttributeError : # debug mode
-                errormask = defaultErrorMask
-            if errormask is None :
-                errormask = defaultErrorMask
+            errormask = self.getErrorMask()
             errormaskbytes = [ chr((errormask & 0xff00) >> 8),
                                chr((errormask & 0x00ff)),
                              ]
@@ -153,9 +159,37 @@ class BaseHandler :
             self.parent.filter.logdebug("No error condition matching mask 0x%04x" % errormask)
             return False
 
+    def isIdle(self, error) :
+        """Returns True if the printer is idle and there's no error."""
+        pstatusAsString = printerStatusValues.get(self.printerStatus)
+        dstatusAsString = deviceStatusValues.get(self.deviceStatus)
+        return (not error) and ((pstatusAsString == 'idle') or \
+                                    ((pstatusAsString == 'other') and \
+                                         (dstatusAsString in ('running', 'warning'))))
+
+    def queryPrinter(self) :
+        """Retrieves the printer's current status and page counter once."""
+        self.retrieveSNMPValues()
+
+    def reuseSavedCounter(self) :
+        """Returns True if the page counter saved at the end of the previous job is still right.
+
+           This is the case if the printer is still idle, and its page counter didn't change.
+        """
+        savedcounter = self.schedule.savedCounter()
+        if savedcounter is None :
+            return False
+        self.queryPrinter()
+        if self.isIdle(self.checkIfError(self.printerDetectedErrorState)) \
+           and (self.printerInternalPageCounter == savedcounter) :
+            self.parent.filter.logdebug("Printer %s is idle and its page counter didn't change since the previous job." % self.parent.filter.PrinterName)
+            return True
+        self.parent.filter.logdebug("Printer %s was used since the previous job." % self.parent.filter.PrinterName)
+        return False
+
     def waitPrinting(self) :
         """Waits for printer status being 'printing'."""
-        statusstabilizationdelay = constants.get(self.parent.filter, "StatusStabilizationDelay")
+        statusstabilizationdelay = self.schedule.printingDelay()
         noprintingmaxdelay = constants.get(self.parent.filter, "NoPrintingMaxDelay")
         if not noprintingmaxdelay :
             self.parent.filter.logdebug("Will wait indefinitely until printer %s is in 'printing' state." % self.parent.filter.PrinterName)
@@ -171,6 +205,7 @@ class BaseHandler :
             pstatusAsString = printerStatusValues.get(self.printerStatus)
             dstatusAsString = deviceStatusValues.get(self.deviceStatus)
             if pstatusAsString in ('printing', 'warmup') :
+                self.schedule.sawPrinting()
                 break
             if self.printerInternalPageCounter is not None :
                 if firstvalue is None :
@@ -184,6 +219,7 @@ class BaseHandler :
                         # BUT the page counter increases !!!
                         # So we can probably quit being sure it is printing.
                         self.parent.filter.printInfo("Printer %s is lying to us !!!" % self.parent.filter.PrinterName, "warn")
+                        self.schedule.sawPrinting()
                         break
                     elif noprintingmaxdelay \
                          and ((time.time() - self.timebefore) > noprintingmaxdelay) \
@@ -214,10 +250,9 @@ class BaseHandler :
 
     def waitIdle(self) :
         """Waits for printer status being 'idle'."""
-        statusstabilizationdelay = constants.get(self.parent.filter, "StatusStabilizationDelay")
-        statusstabilizationloops = constants.get(self.parent.filter, "StatusStabilizationLoops")
+        statusstabilizationloops = self.schedule.idleLoops()
         increment = 1
-        waitdelay = statusstabilizationdelay * increment
+        waitdelay = self.schedule.idleDelay() * increment
         idle_num = 0
         while True :
             self.retrieveSNMPValues()
@@ -225,11 +260,10 @@ class BaseHandler :
             pstatusAsString = printerStatusValues.get(self.printerStatus)
             dstatusAsString = deviceStatusValues.get(self.deviceStatus)
             idle_flag = False
-            if (not error) and ((pstatusAsString == 'idle') or \
-                                    ((pstatusAsString == 'other') and \
-                                         (dstatusAsString in ('running', 'warning')))) :
+            if self.isIdle(error) :
                 idle_flag = True # Standby / Powersave is considered idle
                 increment = 1 # Reset initial stabilization delay
+            self.schedule.sawStatus(idle_flag)
             if idle_flag :
                 if (self.printerInternalPageCounter is not None) \
                    and self.skipinitialwait \
@@ -242,6 +276,10 @@ class BaseHandler :
                     break
             else :
                 idle_num = 0
+            if idle_flag :
+                waitdelay = self.schedule.idleDelay() * increment
+            else :
+                waitdelay = self.schedule.busyDelay() * increment
             if error or (dstatusAsString == "down") :
                 if waitdelay < constants.FIVEMINUTES :
                     increment *= 2
@@ -250,7 +288,6 @@ class BaseHandler :
             self.parent.filter.logdebug("Waiting %s seconds for printer %s's idle status to stabilize..." % (waitdelay,
                                                                                                              self.parent.filter.PrinterName))
             time.sleep(waitdelay)
-            waitdelay = statusstabilizationdelay * increment
 
     def retrieveInternalPageCounter(self) :
         """Returns the page counter from the printer via internal SNMP handling."""
@@ -260,7 +297,12 @@ class BaseHandler :
                (os.environ.get("PYKOTAPHASE") == "AFTER") and \
                self.parent.filter.JobSizeBytes :
                 self.waitPrinting()
+            if (os.environ.get("PYKOTAPHASE") == "BEFORE") and self.reuseSavedCounter() :
+                return self.printerInternalPageCounter
             self.waitIdle()
+            self.schedule.learn()
+            if os.environ.get("PYKOTAPHASE") == "AFTER" :
+                self.schedule.saveCounter(self.printerInternalPageCounter, printerStatusValues.get(self.printerStatus))
         except :
             self.parent.filter.printInfo("SNMP querying stage interrupted. Using latest value seen for internal page counter (%s) on printer %s." % (self.printerInternalPageCounter, self.parent.filter.PrinterName), "warn")
             raise
@@ -315,6 +357,106 @@ class Handler(BaseHandler) :
                                                    deviceStatusValues.get(self.deviceStatus), \
                                                    self.printerDetectedErrorState))
 
+class PolledHandler(Handler) :
+    """A class which lets the SNMP poller watch the printer.
+
+       If the poller can't be reached, the printer is queried directly.
+    """
+    def __init__(self, parent, printerhostname, skipinitialwait, pollersocket) :
+        Handler.__init__(self, parent, printerhostname, skipinitialwait)
+        self.lastSnapshot = None
+        try :
+            self.poller = snmppoller.PollerClient(pollersocket)
+        except socket.error, msg :
+            self.parent.filter.printInfo("SNMP poller unavailable on %s (%s), querying printer %s directly." \
+                                             % (pollersocket, msg, self.parent.filter.PrinterName), "warn")
+            self.poller = None
+
+    def waitForEvent(self, event, delay, **request) :
+        """Asks the SNMP poller to wait for an event, returns the reason it happened or None."""
+        request.update({ "hostname" : self.printerHostname,
+                         "port" : self.port,
+                         "community" : self.community,
+                         "event" : event,
+                         "delay" : delay,
+                         "errormask" : self.getErrorMask(),
+                       })
+        try :
+            snapshot = self.poller.wait(**request)
+        except (socket.error, EOFError), msg :
+            self.parent.filter.printInfo("SNMP poller vanished (%s), querying printer %s directly." \
+                                             % (msg, self.parent.filter.PrinterName), "warn")
+            self.poller.close()
+            self.poller = None
+            return None
+        self.lastSnapshot = snapshot
+        if snapshot["pagecounter"] is not None :
+            self.printerInternalPageCounter = max(self.printerInternalPageCounter, snapshot["pagecounter"])
+        self.printerStatus = snapshot["printerstatus"]
+        self.deviceStatus = snapshot["devicestatus"]
+        if snapshot["errorstate"] is None :
+            self.printerDetectedErrorState = None
+        else :
+            self.printerDetectedErrorState = self.extractErrorStates(snapshot["errorstate"])
+        self.parent.filter.logdebug("SNMP poller's answer (%s) : PageCounter : %s  PrinterStatus : '%s'  DeviceStatus : '%s'  PrinterErrorState : '%s'" \
+                                        % (snapshot["reason"], \
+                                           self.printerInternalPageCounter, \
+                                           printerStatusValues.get(self.printerStatus), \
+                                           deviceStatusValues.get(self.deviceStatus), \
+                                           self.printerDetectedErrorState))
+        return snapshot["reason"]
+
+    def queryPrinter(self) :
+        """Retrieves the printer's current status and page counter once."""
+        if (self.poller is None) or (self.waitForEvent("update", self.schedule.idleDelay()) is None) :
+            Handler.queryPrinter(self)
+
+    def waitPrinting(self) :
+        """Waits for printer status being 'printing'."""
+        if self.poller is not None :
+            noprintingmaxdelay = constants.get(self.parent.filter, "NoPrintingMaxDelay")
+            self.parent.filter.logdebug("Asking the SNMP poller to wait until printer %s is in 'printing' state." % self.parent.filter.PrinterName)
+            previousValue = self.parent.getLastPageCounter()
+            reason = self.waitForEvent("printing", self.schedule.printingDelay(), maxdelay=noprintingmaxdelay)
+            if reason in ("printing", "counter") :
+                self.schedule.sawPrinting()
+            if reason == "counter" :
+                self.parent.filter.printInfo("Printer %s is lying to us !!!" % self.parent.filter.PrinterName, "warn")
+            elif reason == "timeout" :
+                if self.printerInternalPageCounter == previousValue :
+                    self.parent.filter.printInfo("Printer %s probably won't print this job !!!" % self.parent.filter.PrinterName, "warn")
+                else :
+                    self.parent.filter.printInfo("Printer %s has probably already printed this job !!!" % self.parent.filter.PrinterName, "warn")
+            if reason is not None :
+                return
+        Handler.waitPrinting(self)
+
+    def waitIdle(self) :
+        """Waits for printer status being 'idle'."""
+        if self.poller is not None :
+            if self.skipinitialwait and (os.environ.get("PYKOTAPHASE") == "BEFORE") :
+                loops = 1
+            else :
+                loops = self.schedule.idleLoops()
+            # before the job, the printer may have been idle for a while
+            # already, but after the job it has to be seen idle again.
+            fresh = (os.environ.get("PYKOTAPHASE") != "BEFORE")
+            self.parent.filter.logdebug("Asking the SNMP poller to wait for printer %s's idle status to stabilize..." % self.parent.filter.PrinterName)
+            if self.waitForEvent("idle", self.schedule.idleDelay(), loops=loops, fresh=fresh) is not None :
+                self.schedule.sawGlitch(self.lastSnapshot["glitch"])
+                self.schedule.sawStatus(True, self.lastSnapshot["firstidle"])
+                return
+        Handler.waitIdle(self)
+
+    def retrieveInternalPageCounter(self) :
+        """Returns the page counter from the printer, closes the connection to the poller."""
+        try :
+            return Handler.retrieveInternalPageCounter(self)
+        finally :
+            if self.poller is not None :
+                self.poller.close()
+                self.poller = None
+
 def main(hostname) :
     """Tries SNMP accounting for a printer host."""
     class fakeFilter :
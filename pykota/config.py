@@ -165,6 +165,17 @@ class PyKotaConfig :
         if ldapinfo["ldaptls"] :
             if not os.access(ldapinfo["cacert"] or "", os.R_OK) :
                 raise PyKotaConfigError, _("Option ldaptls is set, but certificate %s is not readable.") % repr(ldapinfo["cacert"])
+
+        # job entries are stored directly below jobbase, unless
+        # sub-containers per month and/or per printer are wanted
+        ldapinfo["jobcontainers"] = []
+        containers = self.getGlobalOption("jobcontainers", ignore=True)
+        if containers :
+            validcontainers = [ "month", "printer" ]
+            for container in [c.strip().lower() for c in containers.split(",")] :
+                if (container not in validcontainers) or (container in ldapinfo["jobcontainers"]) :
+                    raise PyKotaConfigError, _("Option jobcontainers only supports values in %s") % str(validcontainers)
+                ldapinfo["jobcontainers"].append(container)
         return ldapinfo
 
     def getLoggingBackend(self) :
@@ -509,14 +520,118 @@ class PyKotaConfig :
         """Returns True if debugging is activated, else False."""
         return self.isTrue(self.getGlobalOption("debug", ignore=True))
 
+    def getStoragePooler(self) :
+        """Returns the address of the connection pooler to use, or None if disabled."""
+        pooler = self.getGlobalOption("storagepooler", ignore=True)
+        if pooler :
+            pooler = pooler.strip()
+            if pooler.lower() not in ("", "no", "n", "false", "0") :
+                return pooler
+        return None
+
     def getCaching(self) :
         """Returns True if database caching is enabled, else False."""
         return self.isTrue(self.getGlobalOption("storagecaching", ignore=True))
 
+    def getCacheLimits(self) :
+        """Returns a mapping of cache types to [maxentries, maxage] limits.
+
+           The '*' key holds the default limits, 0 means no limit.
+        """
+        values = ({ "*" : 0 }, { "*" : 0 })
+        for (index, directive) in enumerate(("storagecachemaxentries", "storagecachemaxage")) :
+            value = self.getGlobalOption(directive, ignore=True)
+            if value :
+                for part in [p.strip() for p in value.split(",")] :
+                    if not part :
+                        continue
+                    try :
+                        (cachetype, limit) = [p.strip() for p in part.split(":", 1)]
+                    except ValueError :
+                        (cachetype, limit) = ("*", part)
+                    try :
+                        limit = int(limit)
+                        if limit < 0 :
+                            raise ValueError
+                    except ValueError :
+                        raise PyKotaConfigError, _("Incorrect value %s for the %s directive in the global section") % (str(value), directive)
+                    values[index][cachetype.upper()] = limit
+        limits = {}
+        for cachetype in values[0].keys() + values[1].keys() :
+            limits[cachetype] = [values[0].get(cachetype, values[0]["*"]),
+                                 values[1].get(cachetype, values[1]["*"])]
+        return limits
+
+    def getSharedCache(self) :
+        """Returns the filename of the cross-process cache, or None if disabled."""
+        filename = self.getGlobalOption("sharedcache", ignore=True)
+        if filename :
+            filename = filename.strip()
+            if filename.lower() not in ("", "no", "n", "false", "0") :
+                return filename
+        return None
+
+    def getSharedCacheTTL(self) :
+        """Returns the number of seconds entries live in the cross-process cache."""
+        ttl = self.getGlobalOption("sharedcachettl", ignore=True)
+        if ttl is None :
+            return 300
+        try :
+            ttl = int(ttl)
+            if ttl < 0 :
+                raise ValueError
+        except (TypeError, ValueError) :
+            raise PyKotaConfigError, _("Incorrect value %s for the sharedcachettl directive in the global section") % str(ttl)
+        return ttl
+
+    def getPrinterStats(self) :
+        """Returns the filename of the printers' timing statistics, or None if disabled."""
+        filename = self.getGlobalOption("printerstats", ignore=True)
+        if filename :
+            filename = filename.strip()
+            if not self.isFalse(filename) :
+                return filename
+        return None
+
+    def getSNMPPoller(self) :
+        """Returns the SNMP poller's socket (or Yes for the default one), or None if disabled."""
+        poller = self.getGlobalOption("snmppoller", ignore=True)
+        if poller :
+            poller = poller.strip()
+            if not self.isFalse(poller) :
+                return poller
+        return None
+
     def getLDAPCache(self) :
         """Returns True if low-level LDAP caching is enabled, else False."""
         return self.isTrue(self.getGlobalOption("ldapcache", ignore=True))
 
+    def getLDAPCacheLimits(self) :
+        """Returns the maximal number of entries and age, in seconds, of the low-level LDAP cache, 0 means no limit."""
+        limits = []
+        for (directive, default) in (("ldapcachemaxentries", 10000), ("ldapcachemaxage", 60)) :
+            value = self.getGlobalOption(directive, ignore=True)
+            if value is None :
+                limits.append(default)
+            else :
+                try :
+                    value = int(value)
+                    if value < 0 :
+                        raise ValueError
+                except (TypeError, ValueError) :
+                    raise PyKotaConfigError, _("Incorrect value %s for the %s directive in the global section") % (str(value), directive)
+                limits.append(value)
+        return tuple(limits)
+
+    def getLDAPCacheFile(self) :
+        """Returns the filename of the low-level LDAP cache shared by all processes, or None if disabled."""
+        filename = self.getGlobalOption("ldapcachefile", ignore=True)
+        if filename :
+            filename = filename.strip()
+            if filename.lower() not in ("", "no", "n", "false", "0") :
+                return filename
+        return None
+
     def getDisableHistory(self) :
         """Returns True if we want to disable history, else False."""
         return self.isTrue(self.getGlobalOption("disablehistory", ignore=True))
@@ -597,6 +712,22 @@ class PyKotaConfig :
             else :
                 return maxdelay
 
+    def getCounterMaxAge(self, printername) :
+        """Returns the max number of seconds the page counter saved at the end of a job can be reused."""
+        try :
+            maxage = self.getPrinterOption(printername, "countermaxage")
+        except PyKotaConfigError :
+            return None         # tells to use hardcoded value
+        else :
+            try :
+                maxage = int(maxage)
+                if maxage < 0 :
+                    raise ValueError
+            except (TypeError, ValueError) :
+                raise PyKotaConfigError, _("Incorrect value %s for the countermaxage directive in section %s") % (str(maxage), printername)
+            else :
+                return maxage
+
     def getStatusStabilizationLoops(self, printername) :
         """Returns the number of times the printer must return the 'idle' status to consider it stable."""
         try :
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+# PyKota : Print Quotas for CUPS
+#
+# (c) 2003-2013 Jerome Alet <alet@librelogiciel.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id$
+#
+#
+
+"""This module implements the persistent accounting daemon used by cupspykota.
+
+   The daemon parses PyKota's configuration and imports the storage and
+   accounting modules once, then forks a child for each print job it
+   receives on its Unix socket. The child sees the job exactly as an
+   in-process cupspykota would : same command line, same environment,
+   job's datas on stdin, and its stderr is relayed back to CUPS by
+   the thin client.
+"""
+
+import sys
+import os
+import stat
+import errno
+import socket
+import signal
+import select
+import struct
+import marshal
+import tempfile
+import SocketServer
+
+DEFAULTSOCKET = "/var/run/pykota/cupspykota.sock"
+EXITMARKER = "\0PYKOTADAEMONEXIT:"
+CHUNK = 64 * 1024
+
+def getSocketPath() :
+    """Returns the path to the accounting daemon's socket."""
+    return os.environ.get("PYKOTA_SOCKET") or DEFAULTSOCKET
+
+def sendMessage(sock, message) :
+    """Sends a length prefixed message through a socket."""
+    data = marshal.dumps(message)
+    sock.sendall(struct.pack("!L", len(data)) + data)
+
+def receiveExactly(sock, size) :
+    """Reads exactly size bytes from a socket, or raises EOFError."""
+    chunks = []
+    while size :
+        try :
+            data = sock.recv(min(size, CHUNK))
+        except socket.error, msg :
+            if msg[0] == errno.EINTR :
+                continue
+            raise
+        if not data :
+            raise EOFError, "Connection closed by peer"
+        chunks.append(data)
+        size -= len(data)
+    return "".join(chunks)
+
+def receiveMessage(sock) :
+    """Receives a length prefixed message from a socket."""
+    (size,) = struct.unpack("!L", receiveExactly(sock, 4))
+    return marshal.loads(receiveExactly(sock, size))
+
+def spoolInput(infile, directory=None) :
+    """Copies the job's datas into a temporary file, returns its name."""
+    (fd, filename) = tempfile.mkstemp(prefix="cupspykota-", dir=directory)
+    outfile = os.fdopen(fd, "wb")
+    try :
+        while 1 :
+            data = infile.read(CHUNK)
+            if not data :
+                break
+            outfile.write(data)
+    finally :
+        outfile.close()
+    return filename
+
+def forwardJob(argv, environ, infile=None, socketpath=None) :
+    """Forwards a print job to the accounting daemon.
+
+       Returns the job's exit code, or None if the daemon can't be
+       reached, in which case the caller must process the job by itself.
+    """
+    socketpath = socketpath or getSocketPath()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try :
+        sock.connect(socketpath)
+    except socket.error :
+        sock.close()
+        return None
+
+    spoolfile = None
+    try :
+        if infile is not None :
+            # the job's datas come from stdin : we have to make them
+            # available to the daemon, and at this point
+            # we don't know PyKota's configuration.
+            spoolfile = spoolInput(infile)
+        try :
+            sendMessage(sock, ([a for a in argv], dict(environ), spoolfile))
+        except socket.error :
+            # the daemon vanished between connect() and now.
+            # we're still able to do the job by ourselves,
+            # but the spooled datas have to be used instead of stdin.
+            if spoolfile is not None :
+                infd = os.open(spoolfile, os.O_RDONLY)
+                os.dup2(infd, infile.fileno())
+                os.close(infd)
+            return None
+        # relays everything the daemon writes on the job's
+        # stderr to CUPS, until the exit code is received.
+        retcode = 1
+        buffer = ""
+        while 1 :
+            try :
+                data = sock.recv(CHUNK)
+            except socket.error, msg :
+                if msg[0] == errno.EINTR :
+                    continue
+                data = ""
+            if not data :
+                break
+            buffer += data
+            lines = buffer.split("\n")
+            buffer = lines.pop()
+            for line in lines :
+                if line.startswith(EXITMARKER) :
+                    retcode = int(line[len(EXITMARKER):])
+                elif line :
+                    sys.stderr.write("%s\n" % line)
+            sys.stderr.flush()
+        if buffer and not buffer.startswith(EXITMARKER) :
+            sys.stderr.write(buffer)
+            sys.stderr.flush()
+        return retcode
+    finally :
+        sock.close()
+        if spoolfile is not None :
+            try :
+                os.remove(spoolfile)
+            except OSError :
+                pass
+
+class JobRequestHandler(SocketServer.BaseRequestHandler) :
+    """Handles a single print job, in a child process."""
+    def handle(self) :
+        """Sets the job's context up then runs it."""
+        (argv, environ, spoolfile) = receiveMessage(self.request)
+        os.environ.clear()
+        os.environ.update(environ)
+        sys.argv = argv
+        if spoolfile is not None :
+            infd = os.open(spoolfile, os.O_RDONLY)
+        else :
+            infd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(infd, 0)
+        os.close(infd)
+        sys.stderr.flush()
+        os.dup2(self.request.fileno(), 2)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        try :
+            retcode = self.server.runjob()
+        except SystemExit, err :
+            retcode = err.code
+        except :
+            retcode = 1
+        sys.stderr.flush()
+        self.request.sendall("\n%s%s\n" % (EXITMARKER, retcode or 0))
+
+class AccountingServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer) :
+    """The accounting daemon's Unix socket server."""
+    max_children = 256
+
+    def __init__(self, socketpath, runjob, reload=None) :
+        """Creates the socket, removing a stale one if needed."""
+        self.socketpath = socketpath
+        self.runjob = runjob
+        self.reload = reload
+        self.mustReload = False
+        try :
+            if stat.S_ISSOCK(os.stat(socketpath).st_mode) :
+                os.remove(socketpath)
+        except OSError :
+            pass
+        oldmask = os.umask(077)
+        try :
+            SocketServer.UnixStreamServer.__init__(self, socketpath, JobRequestHandler)
+        finally :
+            os.umask(oldmask)
+        signal.signal(signal.SIGHUP, self.sigHupHandler)
+
+    def sigHupHandler(self, signum, frame) :
+        """Asks for the configuration to be reloaded before the next job."""
+        self.mustReload = True
+
+    def process_request(self, request, client_address) :
+        """Reloads the configuration if needed, then forks."""
+        if self.mustReload and (self.reload is not None) :
+            self.mustReload = False
+            self.reload()
+        SocketServer.ForkingMixIn.process_request(self, request, client_address)
+
+    def serve(self) :
+        """Serves until interrupted, surviving signals."""
+        try :
+            while 1 :
+                try :
+                    self.handle_request()
+                except (select.error, socket.error), msg :
+                    if msg[0] != errno.EINTR :
+                        raise
+        finally :
+            self.server_close()
+            try :
+                os.remove(self.socketpath)
+            except OSError :
+                pass
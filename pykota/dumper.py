@@ -25,25 +25,30 @@
 import sys
 import os
 import pwd
+import time
+import gzip
+import datetime
 from xml.sax import saxutils
 
 from mx import DateTime
 
 try :
-    import jaxml
+    import pyarrow
+    import pyarrow.parquet
 except ImportError :
-    sys.stderr.write("The jaxml Python module is not installed. XML output is disabled.\n")
-    sys.stderr.write("Download jaxml from http://www.librelogiciel.com/software/ or from your Debian archive of choice\n")
-    hasJAXML = False
+    hasParquet = False
 else :
-    hasJAXML = True
+    hasParquet = True
 
 from pykota.utils import *
 
 from pykota import version
 from pykota.tool import PyKotaTool
+from pykota.storage import closeExtraction
 from pykota.errors import PyKotaToolError, PyKotaCommandLineError
 
+ROWGROUPSIZE = 65536 # Number of records per row group in Parquet files
+
 class DumPyKota(PyKotaTool) :
     """A class for dumpykota."""
     validdatatypes = { u"history" : N_("History"),
@@ -63,7 +68,44 @@ class DumPyKota(PyKotaTool) :
                      u"tsv" : N_("Tabulation Separated Values"),
                      u"xml" : N_("eXtensible Markup Language"),
                      u"cups" : N_("CUPS' page_log"),
+                     u"typedtsv" : N_("Typed Tabulation Separated Values, gzip compressed"),
+                     u"parquet" : N_("Apache Parquet, typed and columnar"),
                    }
+    # Columns which aren't listed here contain strings
+    columntypes = { "id" : "int",
+                    "userid" : "int",
+                    "groupid" : "int",
+                    "printerid" : "int",
+                    "pagecounter" : "int",
+                    "lifepagecounter" : "int",
+                    "softlimit" : "int",
+                    "hardlimit" : "int",
+                    "maxjobsize" : "int",
+                    "warncount" : "int",
+                    "jobsize" : "int",
+                    "jobsizebytes" : "int",
+                    "copies" : "int",
+                    "precomputedjobsize" : "int",
+                    "balance" : "float",
+                    "lifetimepaid" : "float",
+                    "overcharge" : "float",
+                    "amount" : "float",
+                    "priceperpage" : "float",
+                    "priceperjob" : "float",
+                    "jobprice" : "float",
+                    "precomputedjobprice" : "float",
+                    "jobdate" : "timestamp",
+                    "date" : "timestamp",
+                    "datelimit" : "timestamp",
+                  }
+    # Columns with few distinct values, dictionary encoded in Parquet files
+    dictionarycolumns = [ "username",
+                          "groupname",
+                          "printername",
+                          "pgroupname",
+                          "hostname",
+                          "billingcode",
+                        ]
     validfilterkeys = [ "username",
                         "groupname",
                         "printername",
@@ -118,8 +160,8 @@ class DumPyKota(PyKotaTool) :
               and ((datatype != u"history") or options.sum)) :
             raise PyKotaCommandLineError, _("Invalid format '%(format)s', see help.") % locals()
 
-        if (format == u"xml") and not hasJAXML :
-            raise PyKotaToolError, _("XML output is disabled because the jaxml module is not available.")
+        if (format == u"parquet") and not hasParquet :
+            raise PyKotaToolError, _("Parquet output is disabled because the pyarrow module is not available.")
 
         if datatype not in (u"payments", u"history") :
             if options.sum :
@@ -147,26 +189,29 @@ class DumPyKota(PyKotaTool) :
 
         if datatype == u"all" :
             # NB : order does matter to allow easier or faster restore
-            allentries = []
             datatypes = [ "printers", "pmembers", "users", "groups", \
                           "billingcodes", "umembers", "upquotas", \
                           "gpquotas", "payments", "history" ]
-            neededdatatypes = datatypes[:]
-            for datatype in datatypes :
-                entries = getattr(self.storage, "extract%s" % datatype.title())(extractonly) # We don't care about ordering here
-                if entries :
-                    nbentries += len(entries)
-                    allentries.append(entries)
-                else :
-                    neededdatatypes.remove(datatype)
-            retcode = self.dumpXml(allentries, neededdatatypes)
+            self.nbdatatypes = 0
+            retcode = self.dumpXml(self.extractAll(datatypes, extractonly))
+            nbentries = self.nbdatatypes
         else :
             datatype = datatype.encode("ASCII")
             format = format.encode("ASCII")
+            if format == "cups" :
+                # page_log is sorted by date, ties keep the asked ordering
+                orderby = [ "+jobdate" ] + orderby
+            if options.sum :
+                # totals are computed while the records arrive, so the
+                # records with the same keys must come one after the other.
+                orderby = [ "+%s" % k for k in self.getSummaryKeys(datatype, extractonly) ] + orderby
             entries = getattr(self.storage, "extract%s" % datatype.title())(extractonly, orderby)
             if entries :
-                nbentries = len(entries)
-                retcode = getattr(self, "dump%s" % format.title())([self.summarizeDatas(entries, datatype, extractonly, options.sum)], [datatype])
+                nbentries = 1
+                try :
+                    retcode = getattr(self, "dump%s" % format.title())([(datatype, self.summarizeDatas(entries, datatype, extractonly, options.sum))])
+                finally :
+                    closeExtraction(entries)
 
         if mustclose :
             self.outfile.close()
@@ -175,6 +220,27 @@ class DumPyKota(PyKotaTool) :
 
         return retcode
 
+    def extractAll(self, datatypes, extractonly) :
+        """Yields the datatypes which have some records, along with these records.
+
+           Each datatype is extracted only once the previous one was
+           dumped, so that a single extraction is in progress at a time.
+        """
+        for datatype in datatypes :
+            entries = getattr(self.storage, "extract%s" % datatype.title())(extractonly) # We don't care about ordering here
+            if entries :
+                self.nbdatatypes += 1
+                yield (datatype, entries)
+                # in case the records weren't all read
+                closeExtraction(entries)
+
+    def getSummaryKeys(self, datatype, extractonly) :
+        """Returns the fields for which --sum computes separate totals."""
+        if datatype == "payments" :
+            return [ "username" ]
+        else : # elif datatype == "history"
+            return [ k for k in ("username", "printername", "hostname", "billingcode") if k in extractonly.keys() ]
+
     def summarizeDatas(self, entries, datatype, extractonly, sum=0) :
         """Transforms the datas into a summarized view (with totals).
 
@@ -183,7 +249,8 @@ class DumPyKota(PyKotaTool) :
         if not sum :
             return entries
         else :
-            headers = entries[0]
+            entries = iter(entries)
+            headers = entries.next()
             nbheaders = len(headers)
             fieldnumber = {}
             fieldname = {}
@@ -192,7 +259,6 @@ class DumPyKota(PyKotaTool) :
 
             if datatype == "payments" :
                 totalize = [ ("amount", float) ]
-                keys = [ "username" ]
             else : # elif datatype == "history"
                 totalize = [ ("jobsize", int),
                              ("jobprice", float),
@@ -200,21 +266,20 @@ class DumPyKota(PyKotaTool) :
                              ("precomputedjobsize", int),
                              ("precomputedjobprice", float),
                            ]
-                keys = [ k for k in ("username", "printername", "hostname", "billingcode") if k in extractonly.keys() ]
+            keys = self.getSummaryKeys(datatype, extractonly)
 
             newentries = [ headers ]
-            sortedentries = entries[1:]
-            if keys :
-                # If we have several keys, we can sort only on the first one, because they
-                # will vary the same way.
-                sortedentries.sort(lambda x, y, fnum=fieldnumber[keys[0]] : cmp(x[fnum], y[fnum]))
+            # The records were asked sorted by keys, so they
+            # are summarized while they are retrieved.
             totals = {}
             for (k, t) in totalize :
                 totals[k] = { "convert" : t, "value" : 0.0 }
-            prevkeys = {}
-            for k in keys :
-                prevkeys[k] = sortedentries[0][fieldnumber[k]]
-            for entry in sortedentries :
+            prevkeys = None
+            for entry in entries :
+                if prevkeys is None :
+                    prevkeys = {}
+                    for k in keys :
+                        prevkeys[k] = entry[fieldnumber[k]]
                 curval = '-'.join([str(entry[fieldnumber[k]]) for k in keys])
                 prevval = '-'.join([str(prevkeys[k]) for k in keys])
                 if curval != prevval :
@@ -242,7 +307,7 @@ class DumPyKota(PyKotaTool) :
     def dumpWithSeparator(self, separator, allentries) :
         """Dumps datas with a separator."""
         try :
-            for entries in allentries :
+            for (datatype, entries) in allentries :
                 for entry in entries :
                     line = []
                     for value in entry :
@@ -262,29 +327,143 @@ class DumPyKota(PyKotaTool) :
             pass # We used to return an error, not really needed
         return 0
 
-    def dumpCsv(self, allentries, dummy) :
+    def dumpCsv(self, allentries) :
         """Dumps datas with a comma as the separator."""
         return self.dumpWithSeparator(",", allentries)
 
-    def dumpSsv(self, allentries, dummy) :
+    def dumpSsv(self, allentries) :
         """Dumps datas with a comma as the separator."""
         return self.dumpWithSeparator(";", allentries)
 
-    def dumpTsv(self, allentries, dummy) :
+    def dumpTsv(self, allentries) :
         """Dumps datas with a comma as the separator."""
         return self.dumpWithSeparator("\t", allentries)
 
-    def dumpCups(self, allentries, dummy) :
-        """Dumps history datas as CUPS' page_log format."""
+    def typedValue(self, value, coltype) :
+        """Converts a value to its column's type.
+
+           Returns None if the value is None or can't be converted,
+           like the '*' of summarized datas.
+        """
+        if value is None :
+            return None
+        try :
+            if coltype == "int" :
+                return int(value)
+            elif coltype == "float" :
+                return float(value)
+            elif coltype == "timestamp" :
+                return datetime.datetime(*time.strptime(str(value)[:19], "%Y-%m-%d %H:%M:%S")[:6])
+            elif isinstance(value, unicode) :
+                return value
+            else :
+                return str(value).decode("UTF-8", "replace")
+        except (ValueError, TypeError) :
+            return None
+
+    def typedRecords(self, entries) :
+        """Yields the headers with their types, then the records converted to these types.
+
+           The first value of each column which can't be converted is logged.
+        """
+        entries = iter(entries)
+        headers = [str(header) for header in entries.next()]
+        coltypes = [self.columntypes.get(header, "string") for header in headers]
+        yield zip(headers, coltypes)
+        failed = {}
+        for entry in entries :
+            record = []
+            for (header, value, coltype) in zip(headers, entry, coltypes) :
+                typedvalue = self.typedValue(value, coltype)
+                if (typedvalue is None) and (value is not None) \
+                   and (value != "*") and not failed.has_key(header) :
+                    failed[header] = None
+                    self.printInfo(_("Unable to convert %(value)r to %(coltype)s in column %(header)s, dumped as NULL. Other values of this column may be dumped as NULL too.") % locals(), "warn")
+                record.append(typedvalue)
+            yield record
+
+    def dumpTypedtsv(self, allentries) :
+        """Dumps datas as gzip compressed tabulation separated values, with typed columns.
+
+           The first line names the columns along with their type, as
+           name:type. Values are escaped like PostgreSQL's COPY does in
+           its text format, with \\N for NULL, strings are UTF-8 encoded
+           and timestamps are written as YYYY-MM-DD HH:MM:SS. COPY
+           doesn't skip a header line in this format, so it must be
+           removed before loading the records, for example with :
+
+             zcat dump.tsv.gz | tail -n +2 | psql -c "COPY mytable FROM STDIN"
+        """
+        records = self.typedRecords(allentries[0][1])
+        output = gzip.GzipFile(filename="", mode="wb", fileobj=self.outfile)
+        try :
+            output.write("%s\n" % "\t".join(["%s:%s" % column for column in records.next()]))
+            for record in records :
+                line = []
+                for value in record :
+                    if value is None :
+                        line.append("\\N")
+                    elif isinstance(value, unicode) :
+                        line.append(value.encode("UTF-8").replace("\\", "\\\\") \
+                                                         .replace("\t", "\\t") \
+                                                         .replace("\n", "\\n") \
+                                                         .replace("\r", "\\r"))
+                    elif isinstance(value, float) :
+                        line.append(repr(value))
+                    else :
+                        line.append(str(value))
+                output.write("%s\n" % "\t".join(line))
+            output.close()
+        except IOError, msg :
+            pass # same as dumpWithSeparator
+        return 0
+
+    def dumpParquet(self, allentries) :
+        """Dumps datas in the Apache Parquet format, typed and columnar.
+
+           Records are written by row groups while they are retrieved.
+        """
+        arrowtypes = { "int" : pyarrow.int64(),
+                       "float" : pyarrow.float64(),
+                       "timestamp" : pyarrow.timestamp("s"),
+                       "string" : pyarrow.string(),
+                     }
+        records = self.typedRecords(allentries[0][1])
+        columns = records.next()
+        schema = pyarrow.schema([pyarrow.field(name, arrowtypes[coltype]) for (name, coltype) in columns])
+        writer = pyarrow.parquet.ParquetWriter(self.outfile, schema, \
+                                               use_dictionary=[name for (name, coltype) in columns if name in self.dictionarycolumns])
+        values = [[] for column in columns]
+        nbrecords = 0
+        for record in records :
+            for i in range(len(record)) :
+                values[i].append(record[i])
+            nbrecords += 1
+            if nbrecords == ROWGROUPSIZE :
+                self.writeRowGroup(writer, schema, values)
+                values = [[] for column in columns]
+                nbrecords = 0
+        if nbrecords :
+            self.writeRowGroup(writer, schema, values)
+        writer.close()
+        return 0
+
+    def writeRowGroup(self, writer, schema, values) :
+        """Writes a row group to a Parquet file."""
+        arrays = [pyarrow.array(values[i], type=schema[i].type) for i in range(len(values))]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+    def dumpCups(self, allentries) :
+        """Dumps history datas as CUPS' page_log format.
+
+           The records must be sorted by date.
+        """
         months = [ "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec" ]
-        entries = allentries[0]
-        fieldnames = entries[0]
+        entries = iter(allentries[0][1])
+        fieldnames = entries.next()
         fields = {}
         for i in range(len(fieldnames)) :
             fields[fieldnames[i]] = i
-        sortindex = fields["jobdate"]
-        entries = entries[1:]
-        entries.sort(lambda m, n, si=sortindex : cmp(m[si], n[si]))
         for entry in entries :
             printername = entry[fields["printername"]]
             username = entry[fields["username"]]
@@ -309,17 +488,25 @@ class DumPyKota(PyKotaTool) :
                                                         "replace"))
         return 0
 
-    def dumpXml(self, allentries, datatypes) :
-        """Dumps datas as XML."""
-        x = jaxml.XML_document(encoding="UTF-8")
-        x.pykota(version=version.__version__, author=version.__author__)
-        for (entries, datatype) in zip(allentries, datatypes) :
-            x._push()
-            x.dump(storage=self.config.getStorageBackend()["storagebackend"], type=datatype)
-            headers = entries[0]
-            for entry in entries[1:] :
-                x._push()
-                x.entry()
+    def dumpXml(self, allentries) :
+        """Dumps datas as XML, while they are retrieved.
+
+           The layout is the one the jaxml module used to produce.
+        """
+        write = self.outfile.write
+        write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        root = '<pykota version="%s" author="%s"' % (version.__version__, version.__author__)
+        storage = self.config.getStorageBackend()["storagebackend"]
+        empty = True
+        for (datatype, entries) in allentries :
+            if empty :
+                write("%s>\n" % root)
+                empty = False
+            write('    <dump type="%s" storage="%s">\n' % (datatype, storage))
+            entries = iter(entries)
+            headers = [str(header) for header in entries.next()]
+            for entry in entries :
+                write("        <entry>\n")
                 for (header, value) in zip(headers, entry) :
                     try :
                         strvalue = saxutils.escape(value.encode("UTF-8", \
@@ -332,10 +519,15 @@ class DumPyKota(PyKotaTool) :
                     # with older releases of PyKota.
                     # The XML dump will contain UTF-8 encoded strings,
                     # not unicode strings anyway.
-                    x.attribute(strvalue, \
-                                type=type(value).__name__.replace("unicode", "str"), \
-                                name=header)
-                x._pop()
-            x._pop()
-        x._output(self.outfile)
+                    write('            <attribute type="%s" name="%s">%s</attribute>\n' \
+                              % (type(value).__name__.replace("unicode", "str"), \
+                                 header, \
+                                 strvalue))
+                write("        </entry>\n")
+            write("    </dump>\n")
+        if empty :
+            write("%s />\n" % root)
+        else :
+            write("</pykota>\n")
+        self.outfile.flush()
         return 0
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# PyKota : Print Quotas for CUPS
+#
+# (c) 2003-2013 Jerome Alet <alet@librelogiciel.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id$
+#
+#
+
+"""This module learns how fast each printer is, for hardware accounting.
+
+   After each job, the time the printer took to begin printing, the
+   time it spent printing, and the longest time it ever reported being
+   idle before printing again are saved in a local SQLite file. Once
+   enough jobs were seen, they are used to query the printer more often
+   and to consider its idle status stable sooner. The configured (or
+   default) status stabilization delay and loops are never exceeded,
+   and the time the idle status must last is never less than half the
+   configured one.
+
+   The page counter seen at the end of each job is saved too, so that
+   the next job doesn't have to wait for the printer's idle status to
+   stabilize if nothing was printed since.
+"""
+
+import time
+import math
+
+try :
+    from pysqlite2 import dbapi2 as sqlite
+except ImportError :
+    try :
+        import sqlite3 as sqlite
+    except ImportError :
+        sqlite = None
+
+from pykota import constants
+from pykota.errors import PyKotaStorageError
+
+LEARNINGJOBS = 5        # number of jobs to see before using what was learned
+SMOOTHING = 0.3         # weight of the latest job in the averages
+MINDELAY = 0.5          # never query a printer more often than that
+MINLOOPS = 2            # idle status must be seen at least that many times
+MINWINDOW = 0.5         # fraction of the configured delay * loops idle status must at least last
+
+class PrinterStats :
+    """Printers' timing statistics, stored in an SQLite file."""
+    def __init__(self, tool, filename) :
+        """Opens or creates the statistics file."""
+        if sqlite is None :
+            raise PyKotaStorageError, "Printers statistics need the PySQLite module, which doesn't seem to be installed correctly."
+        self.tool = tool
+        self.filename = filename
+        try :
+            self.database = sqlite.connect(filename, timeout=2.0, isolation_level=None)
+            self.database.execute("CREATE TABLE IF NOT EXISTS timings (printername TEXT PRIMARY KEY, jobs INTEGER NOT NULL, printingdelay REAL, idledelay REAL, glitch REAL NOT NULL, updated REAL NOT NULL);")
+            self.database.execute("CREATE TABLE IF NOT EXISTS counters (printername TEXT PRIMARY KEY, pagecounter INTEGER NOT NULL, status TEXT, updated REAL NOT NULL);")
+        except sqlite.Error, msg :
+            raise PyKotaStorageError, "Unable to open printers statistics %s : %s" % (filename, msg)
+
+    def close(self) :
+        """Closes the statistics file."""
+        if self.database is not None :
+            self.database.close()
+            self.database = None
+
+    def getTimings(self, printername) :
+        """Returns a printer's timings as a dictionnary, or None if unknown."""
+        try :
+            row = self.database.execute("SELECT jobs, printingdelay, idledelay, glitch FROM timings WHERE printername=?;", \
+                                        (printername,)).fetchone()
+        except sqlite.Error, msg :
+            self.tool.logdebug("Printers statistics read error (%s) : %s" % (printername, msg))
+            return None
+        if row is not None :
+            return { "jobs" : row[0],
+                     "printingdelay" : row[1],
+                     "idledelay" : row[2],
+                     "glitch" : row[3],
+                   }
+
+    def average(self, previous, value) :
+        """Returns the new moving average."""
+        if value is None :
+            return previous
+        elif previous is None :
+            return value
+        return (SMOOTHING * value) + ((1.0 - SMOOTHING) * previous)
+
+    def learn(self, printername, printingdelay, idledelay, glitch) :
+        """Updates a printer's timings with those of the latest job."""
+        timings = self.getTimings(printername) or { "jobs" : 0,
+                                                    "printingdelay" : None,
+                                                    "idledelay" : None,
+                                                    "glitch" : 0.0,
+                                                  }
+        values = (printername,
+                  timings["jobs"] + 1,
+                  self.average(timings["printingdelay"], printingdelay),
+                  self.average(timings["idledelay"], idledelay),
+                  max(glitch, timings["glitch"]),
+                  time.time())
+        try :
+            self.database.execute("INSERT OR REPLACE INTO timings (printername, jobs, printingdelay, idledelay, glitch, updated) VALUES (?, ?, ?, ?, ?, ?);", values)
+        except sqlite.Error, msg :
+            self.tool.logdebug("Printers statistics write error (%s) : %s" % (printername, msg))
+        else :
+            self.tool.logdebug("Printer %s's timings : %s jobs, %s s to begin printing, %s s printing, %.2f s longest idle glitch" % values[:5])
+
+    def getCounter(self, printername, maxage) :
+        """Returns the page counter saved at the end of a printer's last job, or None if older than maxage seconds."""
+        try :
+            row = self.database.execute("SELECT pagecounter FROM counters WHERE printername=? AND updated>=?;", \
+                                        (printername, time.time() - maxage)).fetchone()
+        except sqlite.Error, msg :
+            self.tool.logdebug("Printers statistics read error (%s) : %s" % (printername, msg))
+            return None
+        if row is not None :
+            return row[0]
+
+    def saveCounter(self, printername, pagecounter, status) :
+        """Saves a printer's page counter, seen at the end of a job."""
+        try :
+            self.database.execute("INSERT OR REPLACE INTO counters (printername, pagecounter, status, updated) VALUES (?, ?, ?, ?);", \
+                                  (printername, pagecounter, status, time.time()))
+        except sqlite.Error, msg :
+            self.tool.logdebug("Printers statistics write error (%s) : %s" % (printername, msg))
+
+class PollingSchedule :
+    """Tells how often to query a printer during a job, and learns from it."""
+    def __init__(self, accounter) :
+        """Reads the configured delays and the printer's timings."""
+        self.accounter = accounter
+        self.filter = accounter.filter
+        self.maxdelay = constants.get(self.filter, "StatusStabilizationDelay")
+        self.maxloops = constants.get(self.filter, "StatusStabilizationLoops")
+        self.timings = None
+        getter = getattr(accounter, "getPrinterStats", None)
+        if getter is not None :
+            self.stats = getter()
+        else : # debug mode
+            self.stats = None
+        if self.stats is not None :
+            timings = self.stats.getTimings(self.filter.PrinterName)
+            if (timings is not None) and (timings["jobs"] >= LEARNINGJOBS) :
+                self.timings = timings
+        self.started = time.time()
+        self.printing = None    # when the printer was seen printing
+        self.firstidle = None   # when the printer was first seen idle after that
+        self.idlesince = None   # when the current idle period began
+        self.glitch = 0.0       # longest idle period which didn't last
+
+    def clamp(self, delay) :
+        """Returns a delay between the minimal and configured ones."""
+        return min(self.maxdelay, max(MINDELAY, delay))
+
+    def printingDelay(self) :
+        """Returns the delay between two queries while waiting for the printer to print."""
+        if (self.timings is None) or (self.timings["printingdelay"] is None) :
+            return self.maxdelay
+        return self.clamp(self.timings["printingdelay"] / 2.0)
+
+    def busyDelay(self) :
+        """Returns the delay between two queries while the printer is printing."""
+        if (self.timings is None) or (self.timings["idledelay"] is None) :
+            return self.maxdelay
+        return self.clamp(self.timings["idledelay"] / 4.0)
+
+    def knowsGlitches(self) :
+        """Returns True if an idle glitch was ever measured on this printer."""
+        return (self.timings is not None) and (self.timings["glitch"] > 0.0)
+
+    def idleDelay(self) :
+        """Returns the delay between two queries while the printer is idle."""
+        if not self.knowsGlitches() :
+            return self.maxdelay
+        # with at most maxloops queries, a shorter delay
+        # couldn't make idle status last long enough.
+        return self.clamp(max(self.timings["glitch"], MINWINDOW * self.maxdelay))
+
+    def idleLoops(self) :
+        """Returns the number of times the printer must be seen idle to be considered stable."""
+        if not self.knowsGlitches() :
+            return self.maxloops
+        delay = self.idleDelay()
+        # idle must last 50% longer than the longest glitch seen,
+        # and not much less than configured.
+        loops = max(int(math.ceil((1.5 * self.timings["glitch"]) / delay)) + 1, \
+                    int(math.ceil((MINWINDOW * self.maxdelay * self.maxloops) / delay)))
+        return min(self.maxloops, max(MINLOOPS, loops))
+
+    def sawPrinting(self, when=None) :
+        """Records that the printer was seen printing."""
+        if self.printing is None :
+            self.printing = when or time.time()
+
+    def sawStatus(self, idle, when=None) :
+        """Records the status seen during the stabilization loop."""
+        when = when or time.time()
+        if idle :
+            if self.idlesince is None :
+                self.idlesince = when
+            if self.firstidle is None :
+                self.firstidle = self.idlesince
+        elif self.idlesince is not None :
+            self.sawGlitch(when - self.idlesince)
+            self.idlesince = None
+
+    def sawGlitch(self, duration) :
+        """Records an idle period which didn't last."""
+        self.glitch = max(self.glitch, duration)
+
+    def savedCounter(self) :
+        """Returns the page counter saved at the end of the previous job if recent enough, else None."""
+        maxage = constants.get(self.filter, "CounterMaxAge")
+        if (self.stats is None) or not maxage :
+            return None
+        return self.stats.getCounter(self.filter.PrinterName, maxage)
+
+    def saveCounter(self, pagecounter, status) :
+        """Saves the page counter seen at the end of a job."""
+        if (self.stats is not None) and (pagecounter is not None) :
+            self.stats.saveCounter(self.filter.PrinterName, pagecounter, status)
+
+    def learn(self) :
+        """Saves the timings of a job which was printed."""
+        if (self.stats is None) or (self.printing is None) or (self.firstidle is None) :
+            return
+        printingdelay = self.printing - self.started
+        idledelay = max(0.0, self.firstidle - self.printing)
+        self.stats.learn(self.filter.PrinterName, printingdelay, idledelay, self.glitch)
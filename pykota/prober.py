@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# PyKota : Print Quotas for CUPS
+#
+# (c) 2003-2013 Jerome Alet <alet@librelogiciel.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id$
+#
+#
+
+"""This module detects which accounting method suits each printer best.
+
+   Each printer is first asked for its page counter over SNMP, then for
+   its status over PJL on the usual ports. Every probe is bounded by a
+   socket timeout, and a pool of threads probes many printers at once.
+
+   The results can be saved into a file, so that printers whose device
+   URI didn't change don't have to be probed again.
+"""
+
+import os
+import time
+import random
+import socket
+import threading
+import Queue
+
+from pykota.snmppoller import encodeMessage, decodeMessage, \
+                             pageCounterOID, GETREQUEST, GETRESPONSE
+
+PROBETIMEOUT = 2.0      # seconds allowed to each probe
+SNMPRESEND = 0.5        # seconds before an unanswered SNMP request is sent again
+WORKERS = 32            # printers probed at once
+SOFTWARE = "software()"
+
+PJLQUERY = "\033%-12345X@PJL INFO STATUS\r\n\033%-12345X"
+
+def supportsSNMP(hostname, community="public", port=161, timeout=PROBETIMEOUT) :
+    """Returns True if the printer answers SNMP queries for its page counter."""
+    deadline = time.time() + timeout
+    requestid = random.randint(1, 0x7fffffff)
+    message = encodeMessage(community, GETREQUEST, requestid, [(pageCounterOID, None)])
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try :
+        try :
+            sock.connect((hostname, port))
+            resend = 0
+            while 1 :
+                now = time.time()
+                if now >= deadline :
+                    return False
+                if now >= resend :
+                    sock.send(message)
+                    resend = now + SNMPRESEND
+                sock.settimeout(min(resend, deadline) - now)
+                try :
+                    data = sock.recv(65536)
+                except socket.timeout :
+                    continue
+                try :
+                    (dummy, pdutype, answerid, errorstatus, errorindex, varbinds) = decodeMessage(data)
+                except ValueError :
+                    continue
+                if (pdutype == GETRESPONSE) and (answerid == requestid) :
+                    return not errorstatus
+        except socket.error :
+            return False # includes ICMP port unreachable
+    finally :
+        sock.close()
+
+def supportsPJL(hostname, port=9100, timeout=PROBETIMEOUT) :
+    """Returns True if the printer accepts PJL queries over TCP."""
+    deadline = time.time() + timeout
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try :
+        try :
+            sock.settimeout(timeout)
+            sock.connect((hostname, port))
+            sock.sendall(PJLQUERY)
+            answer = ""
+            while len(answer) < 4 :
+                remaining = deadline - time.time()
+                if remaining <= 0 :
+                    return False
+                sock.settimeout(remaining)
+                data = sock.recv(1024)
+                if not data :
+                    break
+                answer += data
+            return answer.startswith("@PJL")
+        except socket.error :
+            return False # includes timeouts
+    finally :
+        sock.close()
+
+class Prober :
+    """Probes printers with a bounded pool of threads."""
+    def __init__(self, tool, workers=WORKERS, timeout=PROBETIMEOUT, snmpport=161) :
+        """Initializes the prober."""
+        self.tool = tool
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.snmpport = snmpport
+
+    def probe(self, hostname, port) :
+        """Returns the accounter which suits a printer best."""
+        try :
+            address = socket.gethostbyname(hostname)
+        except socket.error, msg :
+            self.tool.logdebug("Unable to resolve %s : %s" % (hostname, msg))
+            return SOFTWARE
+        if supportsSNMP(address, "public", self.snmpport, self.timeout) :
+            return "hardware(snmp)"
+        ports = [9100, 9101]
+        if port not in ports :
+            ports.append(port)
+        for pjlport in ports :
+            if supportsPJL(address, pjlport, self.timeout) :
+                if pjlport == 9100 :
+                    return "hardware(pjl)"
+                return "hardware(pjl:%s)" % pjlport
+        return SOFTWARE
+
+    def probeAll(self, printers) :
+        """Probes a list of (name, hostname, port) printers.
+
+           Returns a dictionnary of accounters by printer name.
+        """
+        results = {}
+        todo = Queue.Queue()
+        for printer in printers :
+            todo.put(printer)
+
+        def worker() :
+            """Probes printers until none is left."""
+            while 1 :
+                try :
+                    (name, hostname, port) = todo.get_nowait()
+                except Queue.Empty :
+                    return
+                before = time.time()
+                accounter = self.probe(hostname, port)
+                self.tool.logdebug("Printer %s (%s:%s) probed in %.2f seconds : %s" \
+                                       % (name, hostname, port, time.time() - before, accounter))
+                results[name] = accounter
+
+        threads = []
+        for i in range(min(self.workers, len(printers))) :
+            thread = threading.Thread(target=worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads :
+            thread.join()
+        return results
+
+def loadCache(filename) :
+    """Returns the saved probe results as a dictionnary of (deviceuri, accounter) by printer name."""
+    cache = {}
+    try :
+        cachefile = open(filename, "r")
+    except IOError :
+        return cache
+    try :
+        for line in cachefile.readlines() :
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) == 3 :
+                cache[fields[0]] = (fields[1], fields[2])
+    finally :
+        cachefile.close()
+    return cache
+
+def saveCache(filename, cache) :
+    """Saves the probe results, given as a dictionnary of (deviceuri, accounter) by printer name."""
+    names = cache.keys()
+    names.sort()
+    temporary = "%s.%i" % (filename, os.getpid())
+    cachefile = open(temporary, "w")
+    try :
+        for name in names :
+            (deviceuri, accounter) = cache[name]
+            cachefile.write("%s\t%s\t%s\n" % (name, deviceuri, accounter))
+    finally :
+        cachefile.close()
+    os.rename(temporary, filename)
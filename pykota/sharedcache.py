@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# PyKota : Print Quotas for CUPS
+#
+# (c) 2003-2013 Jerome Alet <alet@librelogiciel.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id$
+#
+#
+
+"""This module defines a cache shared by all PyKota processes.
+
+   Entries are stored in a local SQLite file, keyed by cache type
+   and key, and expire after a configurable number of seconds.
+   Only plain Python values (strings, numbers, lists, dicts...) can
+   be stored, so storage objects have to be flattened by the caller.
+"""
+
+import time
+import marshal
+
+try :
+    from pysqlite2 import dbapi2 as sqlite
+except ImportError :
+    try :
+        import sqlite3 as sqlite
+    except ImportError :
+        sqlite = None
+
+from pykota.errors import PyKotaStorageError
+
+class SharedCache :
+    """A cross-process cache backed by an SQLite file."""
+    def __init__(self, tool, filename, ttl) :
+        """Opens or creates the cache file."""
+        if sqlite is None :
+            raise PyKotaStorageError, "The shared cache needs the PySQLite module, which doesn't seem to be installed correctly."
+        self.tool = tool
+        self.filename = filename
+        self.ttl = ttl
+        try :
+            self.database = sqlite.connect(filename, timeout=2.0, isolation_level=None)
+            self.database.execute("CREATE TABLE IF NOT EXISTS cache (cachetype TEXT NOT NULL, key TEXT NOT NULL, expires REAL NOT NULL, value BLOB NOT NULL, PRIMARY KEY (cachetype, key));")
+        except sqlite.Error, msg :
+            raise PyKotaStorageError, "Unable to open shared cache %s : %s" % (filename, msg)
+        self.tool.logdebug("Shared cache %s opened (ttl=%is)." % (filename, ttl))
+
+    def close(self) :
+        """Closes the cache file."""
+        if self.database is not None :
+            self.database.close()
+            self.database = None
+
+    def get(self, cachetype, key) :
+        """Returns the value for this entry, or None if missing or expired."""
+        try :
+            row = self.database.execute("SELECT value FROM cache WHERE cachetype=? AND key=? AND expires>?;", \
+                                        (cachetype, key, time.time())).fetchone()
+        except sqlite.Error, msg :
+            self.tool.logdebug("Shared cache read error (%s->%s) : %s" % (cachetype, key, msg))
+            return None
+        if row is not None :
+            return marshal.loads(str(row[0]))
+
+    def put(self, cachetype, key, value) :
+        """Stores an entry."""
+        now = time.time()
+        try :
+            self.database.execute("INSERT OR REPLACE INTO cache (cachetype, key, expires, value) VALUES (?, ?, ?, ?);", \
+                                  (cachetype, key, now + self.ttl, sqlite.Binary(marshal.dumps(value))))
+        except (sqlite.Error, ValueError), msg :
+            self.tool.logdebug("Shared cache write error (%s->%s) : %s" % (cachetype, key, msg))
+
+    def delete(self, cachetype, key=None) :
+        """Removes an entry, or all entries of a given type if key is None."""
+        try :
+            if key is None :
+                self.database.execute("DELETE FROM cache WHERE cachetype=?;", (cachetype,))
+            else :
+                self.database.execute("DELETE FROM cache WHERE cachetype=? AND key=?;", (cachetype, key))
+        except sqlite.Error, msg :
+            self.tool.logdebug("Shared cache delete error (%s->%s) : %s" % (cachetype, key, msg))
+
+    def purge(self) :
+        """Removes all expired entries."""
+        try :
+            self.database.execute("DELETE FROM cache WHERE expires<=?;", (time.time(),))
+        except sqlite.Error, msg :
+            self.tool.logdebug("Shared cache purge error : %s" % msg)
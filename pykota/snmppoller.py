@@ -0,0 +1,628 @@
+# -*- coding: utf-8 -*-
+#
+# PyKota : Print Quotas for CUPS
+#
+# (c) 2003-2013 Jerome Alet <alet@librelogiciel.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id$
+#
+#
+
+"""This module implements the SNMP poller shared by all print jobs.
+
+   The poller runs as a child of the accounting daemon. It keeps the
+   latest page counter and status of each printer it was asked about,
+   and polls all of them concurrently through a single UDP socket.
+   Print jobs don't poll printers by themselves anymore : they connect
+   to the poller's Unix socket and wait for an event, like the printer
+   being idle for a number of consecutive polls, and the poller
+   answers with a snapshot of the printer's state when it happens.
+"""
+
+import os
+import stat
+import time
+import errno
+import socket
+import select
+import struct
+import marshal
+
+from pykota import constants
+from pykota.daemon import sendMessage, receiveMessage
+
+DEFAULTSOCKET = "/var/run/pykota/snmppoller.sock"
+
+SNMPTIMEOUT = 1.0       # seconds to wait for an answer
+SNMPRETRIES = 5         # times a request is sent again before giving up
+IDLEPOLLDELAY = 60.0    # seconds between two polls when nobody waits
+FORGETDELAY = 3600.0    # printers nobody waited for since then are forgotten
+
+# The values we poll, see RFC3805 and RFC2790
+pageCounterOID = "1.3.6.1.2.1.43.10.2.1.4.1.1"
+hrPrinterStatusOID = "1.3.6.1.2.1.25.3.5.1.1.1"
+hrDeviceStatusOID = "1.3.6.1.2.1.25.3.2.1.5.1"
+hrPrinterDetectedErrorStateOID = "1.3.6.1.2.1.25.3.5.1.2.1"
+STATUSOIDS = [ pageCounterOID,
+               hrPrinterStatusOID,
+               hrDeviceStatusOID,
+               hrPrinterDetectedErrorStateOID,
+             ]
+
+# BER tags used by SNMPv1
+INTEGER = 0x02
+OCTETSTRING = 0x04
+NULL = 0x05
+OBJECTIDENTIFIER = 0x06
+SEQUENCE = 0x30
+IPADDRESS = 0x40
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIMETICKS = 0x43
+COUNTER64 = 0x46
+GETREQUEST = 0xa0
+GETNEXTREQUEST = 0xa1
+GETRESPONSE = 0xa2
+
+def encodeTLV(tag, value) :
+    """Encodes a BER tag, length and value."""
+    length = len(value)
+    if length < 0x80 :
+        encodedlength = chr(length)
+    else :
+        encodedlength = ""
+        while length :
+            encodedlength = chr(length & 0xff) + encodedlength
+            length >>= 8
+        encodedlength = chr(0x80 | len(encodedlength)) + encodedlength
+    return chr(tag) + encodedlength + value
+
+def encodeInteger(value, tag=INTEGER) :
+    """Encodes an integer."""
+    data = chr(value & 0xff)
+    value >>= 8
+    while not (((value == 0) and not (ord(data[0]) & 0x80)) \
+               or ((value == -1) and (ord(data[0]) & 0x80))) :
+        data = chr(value & 0xff) + data
+        value >>= 8
+    return encodeTLV(tag, data)
+
+def encodeOID(oid) :
+    """Encodes a dotted object identifier."""
+    parts = [int(p) for p in oid.split(".")]
+    data = [chr(40 * parts[0] + parts[1])]
+    for part in parts[2:] :
+        chunk = chr(part & 0x7f)
+        part >>= 7
+        while part :
+            chunk = chr(0x80 | (part & 0x7f)) + chunk
+            part >>= 7
+        data.append(chunk)
+    return encodeTLV(OBJECTIDENTIFIER, "".join(data))
+
+def encodeValue(value) :
+    """Encodes a Python value : None, integer, string or (tag, integer)."""
+    if value is None :
+        return encodeTLV(NULL, "")
+    elif isinstance(value, tuple) :
+        return encodeInteger(value[1], value[0])
+    elif isinstance(value, (int, long)) :
+        return encodeInteger(value)
+    else :
+        return encodeTLV(OCTETSTRING, value)
+
+def encodeMessage(community, pdutype, requestid, varbinds, errorstatus=0, errorindex=0) :
+    """Encodes an SNMPv1 message, varbinds being a list of (oid, value)."""
+    encodedvarbinds = "".join([encodeTLV(SEQUENCE, encodeOID(oid) + encodeValue(value)) \
+                                   for (oid, value) in varbinds])
+    pdu = encodeTLV(pdutype, encodeInteger(requestid) \
+                             + encodeInteger(errorstatus) \
+                             + encodeInteger(errorindex) \
+                             + encodeTLV(SEQUENCE, encodedvarbinds))
+    return encodeTLV(SEQUENCE, encodeInteger(0) + encodeTLV(OCTETSTRING, community) + pdu)
+
+def decodeTLV(data, offset) :
+    """Decodes a BER tag, length and value, returns them with the next offset."""
+    try :
+        tag = ord(data[offset])
+        length = ord(data[offset+1])
+    except IndexError :
+        raise ValueError, "truncated BER data"
+    offset += 2
+    if length & 0x80 :
+        nbbytes = length & 0x7f
+        length = 0
+        for c in data[offset:offset+nbbytes] :
+            length = (length << 8) | ord(c)
+        offset += nbbytes
+    end = offset + length
+    if end > len(data) :
+        raise ValueError, "truncated BER data"
+    return (tag, data[offset:end], end)
+
+def decodeInteger(data, signed=True) :
+    """Decodes the value of an integer."""
+    value = 0
+    for c in data :
+        value = (value << 8) | ord(c)
+    if signed and data and (ord(data[0]) & 0x80) :
+        value -= 1 << (8 * len(data))
+    return value
+
+def decodeOID(data) :
+    """Decodes the value of an object identifier."""
+    if not data :
+        return ""
+    parts = [ord(data[0]) // 40, ord(data[0]) % 40]
+    part = 0
+    for c in data[1:] :
+        part = (part << 7) | (ord(c) & 0x7f)
+        if not (ord(c) & 0x80) :
+            parts.append(part)
+            part = 0
+    return ".".join([str(p) for p in parts])
+
+def decodeValue(tag, data) :
+    """Decodes a value into a Python value."""
+    if tag == INTEGER :
+        return decodeInteger(data)
+    elif tag in (COUNTER32, GAUGE32, TIMETICKS, COUNTER64) :
+        return decodeInteger(data, signed=False)
+    elif tag in (OCTETSTRING, IPADDRESS) :
+        return data
+    elif tag == OBJECTIDENTIFIER :
+        return decodeOID(data)
+    else :
+        return None # NULL, noSuchObject, noSuchInstance, endOfMibView
+
+def decodeMessage(data) :
+    """Decodes an SNMPv1 or v2c message.
+
+       Returns (community, pdutype, requestid, errorstatus, errorindex, varbinds)
+       or raises ValueError.
+    """
+    (tag, message, dummy) = decodeTLV(data, 0)
+    if tag != SEQUENCE :
+        raise ValueError, "not an SNMP message"
+    (tag, version, offset) = decodeTLV(message, 0)
+    (tag, community, offset) = decodeTLV(message, offset)
+    (pdutype, pdu, offset) = decodeTLV(message, offset)
+    (tag, requestid, offset) = decodeTLV(pdu, 0)
+    (tag, errorstatus, offset) = decodeTLV(pdu, offset)
+    (tag, errorindex, offset) = decodeTLV(pdu, offset)
+    (tag, encodedvarbinds, offset) = decodeTLV(pdu, offset)
+    varbinds = []
+    offset = 0
+    while offset < len(encodedvarbinds) :
+        (tag, varbind, offset) = decodeTLV(encodedvarbinds, offset)
+        (tag, oid, valueoffset) = decodeTLV(varbind, 0)
+        (tag, value, dummy) = decodeTLV(varbind, valueoffset)
+        varbinds.append((decodeOID(oid), decodeValue(tag, value)))
+    return (community, pdutype, decodeInteger(requestid), \
+            decodeInteger(errorstatus), decodeInteger(errorindex), varbinds)
+
+def getSocketPath(config) :
+    """Returns the path to the poller's socket, or None if the poller is disabled."""
+    socketpath = os.environ.get("PYKOTA_POLLER_SOCKET") or config.getSNMPPoller()
+    if socketpath and config.isTrue(socketpath) :
+        return DEFAULTSOCKET
+    return socketpath
+
+class PrinterState :
+    """The latest known state of a printer."""
+    def __init__(self, hostname, port, community) :
+        """Initializes an unknown state."""
+        self.hostname = hostname
+        self.port = port
+        self.community = community
+        self.address = None
+        self.pagecounter = None
+        self.printerstatus = None
+        self.devicestatus = None
+        self.errorstate = None
+        self.error = None
+        self.timestamp = None   # time of the last successful poll
+        self.idleloops = 0      # number of consecutive polls it was idle
+        self.delay = constants.STATUSSTABILIZATIONDELAY
+        self.errormask = 0
+        self.increment = 1
+        self.requestid = None
+        self.sent = None        # time the current (or last) request was sent
+        self.retries = 0
+        self.nextpoll = 0
+        self.wanted = time.time()
+
+    def isError(self) :
+        """Returns True if the printer reports an error matching the error mask."""
+        if self.errorstate is None :
+            return True
+        errorbits = 0
+        for c in self.errorstate[:2] :
+            errorbits = (errorbits << 8) | ord(c)
+        if len(self.errorstate) == 1 :
+            errorbits <<= 8
+        return (errorbits & self.errormask) != 0
+
+    def isIdle(self) :
+        """Returns True if the printer is idle and without error. Standby / Powersave is considered idle."""
+        return (not self.isError()) \
+               and ((self.printerstatus == 3) \
+                    or ((self.printerstatus == 1) and (self.devicestatus in (2, 3))))
+
+    def snapshot(self, waiter=None, reason=None) :
+        """Returns the printer's state, and what a waiter saw, as a dictionnary."""
+        snapshot = { "pagecounter" : self.pagecounter,
+                     "printerstatus" : self.printerstatus,
+                     "devicestatus" : self.devicestatus,
+                     "errorstate" : self.errorstate,
+                     "error" : self.error,
+                     "timestamp" : self.timestamp,
+                     "reason" : reason,
+                     "firstidle" : None,
+                     "glitch" : 0.0,
+                   }
+        if waiter is not None :
+            snapshot["firstidle"] = waiter.firstidle
+            snapshot["glitch"] = waiter.glitch
+        return snapshot
+
+class Waiter :
+    """A client waiting for an event on a printer."""
+    def __init__(self, client, state, request) :
+        """Initializes the waiter."""
+        self.client = client
+        self.state = state
+        self.event = request["event"]
+        self.loops = request.get("loops") or 1
+        self.maxdelay = request.get("maxdelay") or 0
+        self.since = time.time()
+        self.polls = 0
+        self.firstcounter = None
+        self.firstidle = None   # when it was first seen idle
+        self.idlesince = None   # when the current idle period began
+        self.glitch = 0.0       # longest idle period which didn't last
+        if request.get("fresh") :
+            self.idleloops = 0
+        else :
+            self.idleloops = state.idleloops
+
+    def check(self) :
+        """Returns the reason why the event happened, or None.
+
+           This is called after each poll sent after the waiter
+           was created, so that events are never based only on
+           older values.
+        """
+        state = self.state
+        self.polls += 1
+        if self.event == "update" :
+            return "update"
+        elif self.event == "idle" :
+            if state.isIdle() :
+                self.idleloops += 1
+                if self.idlesince is None :
+                    self.idlesince = state.sent
+                    if self.firstidle is None :
+                        self.firstidle = state.sent
+            else :
+                self.idleloops = 0
+                if self.idlesince is not None :
+                    self.glitch = max(self.glitch, state.sent - self.idlesince)
+                    self.idlesince = None
+            if self.idleloops >= self.loops :
+                return "idle"
+        elif self.event == "printing" :
+            if state.error is None :
+                if state.printerstatus in (4, 5) : # printing, warmup
+                    return "printing"
+                if state.pagecounter is not None :
+                    if self.firstcounter is None :
+                        self.firstcounter = state.pagecounter
+                    elif self.firstcounter < state.pagecounter :
+                        return "counter"
+                    elif self.maxdelay \
+                         and ((time.time() - self.since) > self.maxdelay) \
+                         and state.isIdle() :
+                        return "timeout"
+        return None
+
+class SNMPPoller :
+    """Polls printers' page counters and statuses for all print jobs."""
+    def __init__(self, tool, socketpath) :
+        """Opens the poller's sockets."""
+        self.tool = tool
+        self.socketpath = socketpath
+        self.states = {}        # (hostname, port, community) -> PrinterState
+        self.requests = {}      # request id -> PrinterState
+        self.clients = {}       # file descriptor -> [socket, buffer]
+        self.waiters = []
+        self.lastrequestid = int(time.time()) & 0x3fffffff
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setblocking(0)
+        try :
+            if stat.S_ISSOCK(os.stat(socketpath).st_mode) :
+                os.remove(socketpath)
+        except OSError :
+            pass
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oldmask = os.umask(077)
+        try :
+            self.listener.bind(socketpath)
+        finally :
+            os.umask(oldmask)
+        self.listener.listen(64)
+
+    def close(self) :
+        """Closes all the sockets."""
+        for (sock, dummy) in self.clients.values() :
+            sock.close()
+        self.clients = {}
+        self.udp.close()
+        self.listener.close()
+        try :
+            os.remove(self.socketpath)
+        except OSError :
+            pass
+
+    def getState(self, hostname, port, community) :
+        """Returns the state of a printer, creating it if needed."""
+        key = (hostname, port, community)
+        state = self.states.get(key)
+        if state is None :
+            state = self.states[key] = PrinterState(hostname, port, community)
+            self.tool.logdebug("SNMP poller now polls printer %s:%s" % (hostname, port))
+        return state
+
+    def sendRequest(self, state) :
+        """Sends (or sends again) the GET request for a printer's status."""
+        if state.address is None :
+            try :
+                state.address = (socket.gethostbyname(state.hostname), state.port)
+            except socket.error, msg :
+                self.pollDone(state, "Unable to resolve %s : %s" % (state.hostname, msg))
+                return
+        if state.requestid is None :
+            self.lastrequestid = (self.lastrequestid + 1) & 0x7fffffff
+            state.requestid = self.lastrequestid
+            state.sent = time.time()
+            state.retries = SNMPRETRIES
+            self.requests[state.requestid] = state
+        else :
+            state.retries -= 1
+        state.nextpoll = time.time() + SNMPTIMEOUT
+        message = encodeMessage(state.community, GETREQUEST, state.requestid, \
+                                [(oid, None) for oid in STATUSOIDS])
+        try :
+            self.udp.sendto(message, state.address)
+        except socket.error, msg :
+            if msg[0] not in (errno.EAGAIN, errno.EINTR, errno.ENOBUFS) :
+                self.pollDone(state, "Unable to send SNMP request to %s : %s" % (state.hostname, msg))
+
+    def readResponses(self) :
+        """Reads all the SNMP answers available on the UDP socket."""
+        while 1 :
+            try :
+                (data, address) = self.udp.recvfrom(65536)
+            except socket.error, msg :
+                if msg[0] == errno.EINTR :
+                    continue
+                return # EAGAIN, or an ICMP error we can't relate to a request
+            try :
+                (community, pdutype, requestid, errorstatus, errorindex, varbinds) = decodeMessage(data)
+            except ValueError :
+                self.tool.logdebug("SNMP poller received an invalid message from %s" % repr(address))
+                continue
+            state = self.requests.get(requestid)
+            if (state is None) or (pdutype != GETRESPONSE) or (address[0] != state.address[0]) :
+                continue
+            if errorstatus :
+                self.pollDone(state, "SNMP error status %s at %s" % (errorstatus, errorindex))
+            elif len(varbinds) != len(STATUSOIDS) :
+                self.pollDone(state, "Incomplete SNMP answer")
+            else :
+                values = [value for (oid, value) in varbinds]
+                try :
+                    pagecounter = int(values[0] or 0)
+                except (TypeError, ValueError) :
+                    pagecounter = 0
+                try :
+                    state.printerstatus = int(values[1])
+                except (TypeError, ValueError) :
+                    state.printerstatus = 2 # unknown
+                try :
+                    state.devicestatus = int(values[2])
+                except (TypeError, ValueError) :
+                    state.devicestatus = 1 # unknown
+                state.errorstate = str(values[3] or "")
+                state.pagecounter = pagecounter
+                self.pollDone(state)
+
+    def pollDone(self, state, error=None) :
+        """Records the result of a poll, then notifies the waiters."""
+        if state.requestid is not None :
+            del self.requests[state.requestid]
+            state.requestid = None
+        now = time.time()
+        state.error = error
+        if error is None :
+            state.timestamp = now
+            if state.isIdle() :
+                state.idleloops += 1
+            else :
+                state.idleloops = 0
+        else :
+            self.tool.logdebug("SNMP poller : %s" % error)
+            state.printerstatus = state.devicestatus = state.errorstate = None
+            state.idleloops = 0
+        waitdelay = state.delay * state.increment
+        if state.isError() or (state.devicestatus == 5) : # down
+            if waitdelay < constants.FIVEMINUTES :
+                state.increment *= 2
+        else :
+            state.increment = 1
+        sent = state.sent or now
+        waiting = False
+        for waiter in self.waiters[:] :
+            if (waiter.state is state) and (waiter in self.waiters) :
+                if sent >= waiter.since :
+                    reason = waiter.check()
+                    if reason is not None :
+                        self.waiters.remove(waiter)
+                        self.reply(waiter.client, state.snapshot(waiter, reason))
+                else :
+                    # this poll was sent before the waiter arrived,
+                    # so we poll again right now.
+                    waiting = True
+        if waiting :
+            state.nextpoll = now
+        elif [w for w in self.waiters if w.state is state] :
+            state.nextpoll = sent + waitdelay
+        else :
+            state.nextpoll = sent + max(waitdelay, IDLEPOLLDELAY)
+
+    def reply(self, client, message) :
+        """Sends a message to a client, dropping it on error."""
+        try :
+            sendMessage(client, message)
+        except socket.error :
+            self.dropClient(client.fileno())
+
+    def dropClient(self, fd) :
+        """Forgets a client and its waiters."""
+        (sock, dummy) = self.clients.pop(fd, (None, None))
+        if sock is not None :
+            self.waiters = [w for w in self.waiters if w.client is not sock]
+            sock.close()
+
+    def handleRequest(self, client, request) :
+        """Handles a request received from a print job."""
+        try :
+            state = self.getState(request["hostname"], request.get("port") or 161, \
+                                  request.get("community") or "public")
+            if request.get("delay") :
+                state.delay = request["delay"]
+            if request.get("errormask") is not None :
+                state.errormask = request["errormask"]
+            waiter = Waiter(client, state, request)
+        except (KeyError, TypeError, AttributeError) :
+            self.dropClient(client.fileno())
+            return
+        state.wanted = waiter.since
+        if waiter.event not in ("update", "idle", "printing") :
+            self.reply(client, state.snapshot())
+            return
+        self.waiters.append(waiter)
+        if state.requestid is None :
+            # no need to wait for the next scheduled poll
+            state.nextpoll = min(state.nextpoll, waiter.since)
+
+    def readClient(self, fd) :
+        """Reads what a client sent, and handles its complete requests."""
+        (sock, buffer) = self.clients[fd]
+        try :
+            data = sock.recv(4096)
+        except socket.error, msg :
+            if msg[0] == errno.EINTR :
+                return
+            data = ""
+        if not data :
+            self.dropClient(fd)
+            return
+        buffer += data
+        while len(buffer) >= 4 :
+            (size,) = struct.unpack("!L", buffer[:4])
+            if len(buffer) < (size + 4) :
+                break
+            try :
+                request = marshal.loads(buffer[4:size+4])
+            except (ValueError, EOFError, TypeError) :
+                self.dropClient(fd)
+                return
+            buffer = buffer[size+4:]
+            self.handleRequest(sock, request)
+            if fd not in self.clients :
+                return
+        self.clients[fd][1] = buffer
+
+    def pollPrinters(self) :
+        """Sends the requests which are due, returns the delay until the next one."""
+        now = time.time()
+        nextevent = now + IDLEPOLLDELAY
+        for (key, state) in self.states.items() :
+            if state.nextpoll <= now :
+                if state.requestid is not None :
+                    if state.retries > 0 :
+                        self.sendRequest(state)
+                    else :
+                        self.pollDone(state, "No SNMP response received from %s before timeout" % state.hostname)
+                elif ((now - state.wanted) > FORGETDELAY) \
+                     and not [w for w in self.waiters if w.state is state] :
+                    del self.states[key]
+                    self.tool.logdebug("SNMP poller doesn't poll printer %s:%s anymore" % (state.hostname, state.port))
+                    continue
+                else :
+                    self.sendRequest(state)
+            nextevent = min(nextevent, state.nextpoll)
+        return max(0.0, nextevent - time.time())
+
+    def serve(self) :
+        """Serves until interrupted."""
+        self.tool.logdebug("SNMP poller listening on %s" % self.socketpath)
+        try :
+            while 1 :
+                timeout = self.pollPrinters()
+                sockets = [self.listener, self.udp] + [c[0] for c in self.clients.values()]
+                try :
+                    (readable, dummy, dummy) = select.select(sockets, [], [], timeout)
+                except select.error, msg :
+                    if msg[0] == errno.EINTR :
+                        continue
+                    raise
+                for sock in readable :
+                    if sock is self.listener :
+                        try :
+                            (client, dummy) = self.listener.accept()
+                        except socket.error :
+                            continue
+                        self.clients[client.fileno()] = [client, ""]
+                    elif sock is self.udp :
+                        self.readResponses()
+                    elif sock.fileno() in self.clients :
+                        self.readClient(sock.fileno())
+        finally :
+            self.close()
+
+class PollerClient :
+    """A print job's connection to the SNMP poller."""
+    def __init__(self, socketpath) :
+        """Connects to the poller, raises socket.error if it doesn't run."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try :
+            self.sock.connect(socketpath)
+        except socket.error :
+            self.sock.close()
+            raise
+
+    def close(self) :
+        """Closes the connection."""
+        self.sock.close()
+
+    def wait(self, **request) :
+        """Waits for an event, returns the printer's state when it happens.
+
+           Raises socket.error or EOFError if the poller vanished.
+        """
+        sendMessage(self.sock, request)
+        return receiveMessage(self.sock)
@@ -22,11 +22,13 @@
 
 """This module is the database abstraction layer for PyKota."""
 
-import os
-import imp
+import sys
+import time
+import heapq
 from mx import DateTime
 
 from pykota.errors import PyKotaStorageError
+from pykota.sharedcache import SharedCache
 
 class StorageObject :
     """Object present in the database."""
@@ -110,6 +112,7 @@ class StorageUser(StorageObject) :
         """Deletes an user from the database."""
         self.parent.deleteUser(self)
         self.parent.flushEntry("USERS", self.Name)
+        self.parent.flushSharedEntry("USERGROUPS", self.Name)
         if self.parent.usecache :
             for (k, v) in self.parent.caches["USERPQUOTAS"].items() :
                 if v.User.Name == self.Name :
@@ -145,15 +148,18 @@ class StorageGroup(StorageObject) :
     def addUserToGroup(self, user) :
         """Adds an user to an users group."""
         self.parent.addUserToGroup(user, self)
+        self.parent.flushSharedEntry("USERGROUPS", user.Name)
 
     def delUserFromGroup(self, user) :
         """Removes an user from an users group."""
         self.parent.delUserFromGroup(user, self)
+        self.parent.flushSharedEntry("USERGROUPS", user.Name)
 
     def delete(self) :
         """Deletes a group from the database."""
         self.parent.deleteGroup(self)
         self.parent.flushEntry("GROUPS", self.Name)
+        self.parent.flushSharedEntry("USERGROUPS")
         if self.parent.usecache :
             for (k, v) in self.parent.caches["GROUPPQUOTAS"].items() :
                 if v.Group.Name == self.Name :
@@ -194,12 +200,20 @@ class StoragePrinter(StorageObject) :
         """Adds a printer to a printer group."""
         if (printer not in self.parent.getParentPrinters(self)) and (printer.ident != self.ident) :
             self.parent.writePrinterToGroup(self, printer)
-            # TODO : reset cached value for printer parents, or add new parent to cached value
+            self.parent.flushSharedEntry("PRINTERS", self.Name)
+            self.parent.flushParentPrinters()
 
     def delPrinterFromGroup(self, printer) :
         """Deletes a printer from a printer group."""
         self.parent.removePrinterFromGroup(self, printer)
-        # TODO : reset cached value for printer parents, or add new parent to cached value
+        self.parent.flushSharedEntry("PRINTERS", self.Name)
+        self.parent.flushParentPrinters()
+
+    def save(self) :
+        """Saves the printer and invalidates its shared cache entry."""
+        if self.isDirty :
+            StorageObject.save(self)
+            self.parent.flushSharedEntry("PRINTERS", self.Name)
 
     def setPrices(self, priceperpage = None, priceperjob = None) :
         """Sets the printer's prices."""
@@ -227,6 +241,7 @@ class StoragePrinter(StorageObject) :
         """Deletes a printer from the database."""
         self.parent.deletePrinter(self)
         self.parent.flushEntry("PRINTERS", self.Name)
+        self.parent.flushParentPrinters()
         if self.parent.usecache :
             for (k, v) in self.parent.caches["USERPQUOTAS"].items() :
                 if v.Printer.Name == self.Name :
@@ -257,6 +272,9 @@ class StorageUserPQuota(StorageObject) :
         if name == "ParentPrintersUserPQuota" :
             self.ParentPrintersUserPQuota = (self.User.Exists and self.Printer.Exists and self.parent.getParentPrintersUserPQuota(self)) or []
             return self.ParentPrintersUserPQuota
+        elif name == "GroupsPQuota" :
+            self.GroupsPQuota = (self.User.Exists and self.Printer.Exists and self.parent.getUserGroupsPQuota(self)) or []
+            return self.GroupsPQuota
         else :
             raise AttributeError, name
 
@@ -542,7 +560,78 @@ class StorageBillingCode(StorageObject) :
         self.consume(-pages, -price)
 
 
+class CacheStore :
+    """A cache with optional size and age limits, evicting least recently used entries first."""
+    def __init__(self, maxentries=0, maxage=0) :
+        """Initializes an empty cache, 0 means no limit."""
+        self.maxentries = maxentries
+        self.maxage = maxage
+        self.entries = {}       # key -> (value, time of storage)
+        self.ticks = {}         # key -> tick of last access
+        self.heap = []          # (tick, key), possibly outdated
+        self.tick = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self) :
+        """Returns the number of entries."""
+        return len(self.entries)
+
+    def touch(self, key) :
+        """Marks an entry as the most recently used one."""
+        self.tick += 1
+        self.ticks[key] = self.tick
+        heapq.heappush(self.heap, (self.tick, key))
+        if len(self.heap) > (2 * len(self.entries)) + 64 :
+            # too many outdated ticks, rebuild the heap.
+            self.heap = [(tick, k) for (k, tick) in self.ticks.items()]
+            heapq.heapify(self.heap)
+
+    def get(self, key) :
+        """Returns an entry, or None if it is missing or too old."""
+        entry = self.entries.get(key)
+        if entry is None :
+            self.misses += 1
+            return None
+        if self.maxage and ((time.time() - entry[1]) > self.maxage) :
+            self.remove(key)
+            self.evictions += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touch(key)
+        return entry[0]
+
+    def put(self, key, value) :
+        """Stores an entry, evicting the least recently used ones if needed."""
+        self.entries[key] = (value, time.time())
+        self.touch(key)
+        if self.maxentries :
+            while (len(self.entries) > self.maxentries) and self.heap :
+                (tick, oldkey) = heapq.heappop(self.heap)
+                if self.ticks.get(oldkey) == tick :
+                    self.remove(oldkey)
+                    self.evictions += 1
+
+    def remove(self, key) :
+        """Removes an entry, returns True if it was present, else False."""
+        try :
+            del self.entries[key]
+        except KeyError :
+            return False
+        del self.ticks[key]
+        return True
+
+    def items(self) :
+        """Returns the list of (key, value) couples."""
+        return [(key, entry[0]) for (key, entry) in self.entries.items()]
+
+
 class BaseStorage :
+    # Only objects which seldom change are stored in the shared cache,
+    # lazily computed attributes are never stored.
+    sharedobjects = { "PRINTERS" : StoragePrinter }
+    sharedtransients = ("parent", "isDirty", "LastJob", "Parents", "Coefficients")
+
     def __init__(self, pykotatool) :
         """Opens the storage connection."""
         self.closed = True
@@ -554,14 +643,26 @@ class BaseStorage :
             pykotatool.logdebug("Jobs' title, filename and options will be hidden because of privacy concerns.")
         if self.usecache :
             self.tool.logdebug("Caching enabled.")
-            self.caches = { "USERS" : {}, \
-                            "GROUPS" : {}, \
-                            "PRINTERS" : {}, \
-                            "USERPQUOTAS" : {}, \
-                            "GROUPPQUOTAS" : {}, \
-                            "JOBS" : {}, \
-                            "LASTJOBS" : {}, \
-                            "BILLINGCODES" : {} }
+            limits = pykotatool.config.getCacheLimits()
+            self.caches = {}
+            for cachetype in ("USERS", "GROUPS", "PRINTERS", "USERPQUOTAS", \
+                              "GROUPPQUOTAS", "JOBS", "LASTJOBS", "BILLINGCODES") :
+                (maxentries, maxage) = limits.get(cachetype, limits["*"])
+                self.caches[cachetype] = CacheStore(maxentries, maxage)
+            # hits and misses for the lists of related objects
+            # which are cached in the objects themselves.
+            self.relatedcounters = { "Parents" : [0, 0], \
+                                     "Members" : [0, 0], \
+                                     "Groups" : [0, 0] }
+            self.sharedhits = 0
+        self.sharedcache = None
+        if self.usecache :
+            sharedcachefile = pykotatool.config.getSharedCache()
+            if sharedcachefile :
+                self.sharedcache = SharedCache(pykotatool, \
+                                               sharedcachefile, \
+                                               pykotatool.config.getSharedCacheTTL())
+                self.sharedcache.purge()
 
     def close(self) :
         """Must be overriden in children classes."""
@@ -587,27 +688,73 @@ class BaseStorage :
         """Tries to extract something from the cache."""
         if self.usecache :
             entry = self.caches[cachetype].get(key)
-            if entry is not None :
-                self.tool.logdebug("Cache hit (%s->%s)" % (cachetype, key))
-            else :
-                self.tool.logdebug("Cache miss (%s->%s)" % (cachetype, key))
+            if (entry is None) and (self.sharedcache is not None) \
+               and self.sharedobjects.has_key(cachetype) :
+                entry = self.getFromSharedCache(cachetype, key)
             return entry
 
-    def cacheEntry(self, cachetype, key, value) :
+    def cacheEntry(self, cachetype, key, value, shared=True) :
         """Puts an entry in the cache."""
         if self.usecache and getattr(value, "Exists", 0) :
-            self.caches[cachetype][key] = value
-            self.tool.logdebug("Cache store (%s->%s)" % (cachetype, key))
+            self.caches[cachetype].put(key, value)
+            if shared and (self.sharedcache is not None) and self.sharedobjects.has_key(cachetype) :
+                attributes = {}
+                for (name, attrvalue) in value.__dict__.items() :
+                    if name not in self.sharedtransients :
+                        attributes[name] = attrvalue
+                self.sharedcache.put(cachetype, key, attributes)
 
     def flushEntry(self, cachetype, key) :
         """Removes an entry from the cache."""
         if self.usecache :
-            try :
-                del self.caches[cachetype][key]
-            except KeyError :
-                pass
-            else :
+            if self.caches[cachetype].remove(key) :
                 self.tool.logdebug("Cache flush (%s->%s)" % (cachetype, key))
+            if self.sharedobjects.has_key(cachetype) :
+                self.flushSharedEntry(cachetype, key)
+
+    def getFromSharedCache(self, cachetype, key) :
+        """Rebuilds an object from the shared cache, and caches it locally."""
+        attributes = self.sharedcache.get(cachetype, key)
+        if attributes is not None :
+            entry = self.sharedobjects[cachetype](self, key)
+            entry.__dict__.update(attributes)
+            self.caches[cachetype].put(key, entry)
+            self.sharedhits += 1
+            return entry
+
+    def flushSharedEntry(self, cachetype, key=None) :
+        """Removes an entry, or all entries of a given type, from the shared cache."""
+        if self.sharedcache is not None :
+            self.sharedcache.delete(cachetype, key)
+            self.tool.logdebug("Shared cache flush (%s->%s)" % (cachetype, key or "*"))
+
+    def getSharedNames(self, cachetype, entry, frombackend, getter) :
+        """Returns a list of related objects, whose names may be in the shared cache."""
+        if self.sharedcache is not None :
+            names = self.sharedcache.get(cachetype, entry.Name)
+            if names is not None :
+                self.sharedhits += 1
+                return [o for o in [getter(name) for name in names] if o.Exists]
+        related = frombackend(entry)
+        if (self.sharedcache is not None) and entry.Exists :
+            self.sharedcache.put(cachetype, entry.Name, [o.Name for o in related])
+        return related
+
+    def logCacheStatistics(self) :
+        """Logs the caches' hits, misses and evictions counters."""
+        if self.usecache :
+            cachetypes = self.caches.keys()
+            cachetypes.sort()
+            for cachetype in cachetypes :
+                cache = self.caches[cachetype]
+                if cache.hits or cache.misses :
+                    self.tool.logdebug("Cache %s : %i hits, %i misses, %i evictions, %i entries." \
+                                           % (cachetype, cache.hits, cache.misses, cache.evictions, len(cache)))
+            for (name, (hits, misses)) in self.relatedcounters.items() :
+                if hits or misses :
+                    self.tool.logdebug("Cache %s : %i hits, %i misses." % (name, hits, misses))
+            if self.sharedcache is not None :
+                self.tool.logdebug("Shared cache : %i hits." % self.sharedhits)
 
     def getUser(self, username) :
         """Returns the user from cache."""
@@ -668,33 +815,89 @@ class BaseStorage :
         return code
 
     def getParentPrinters(self, printer) :
-        """Extracts parent printers information for a given printer from cache."""
+        """Extracts all the parent printers of a given printer, recursively, from cache."""
         if self.usecache :
             if not hasattr(printer, "Parents") :
-                self.tool.logdebug("Cache miss (%s->Parents)" % printer.Name)
-                printer.Parents = self.getParentPrintersFromBackend(printer)
-                self.tool.logdebug("Cache store (%s->Parents)" % printer.Name)
+                self.relatedcounters["Parents"][1] += 1
+                printer.Parents = self.getSharedNames("PARENTS", printer, \
+                                                      self.getParentPrintersFromBackend, \
+                                                      self.getPrinter)
             else :
-                self.tool.logdebug("Cache hit (%s->Parents)" % printer.Name)
+                self.relatedcounters["Parents"][0] += 1
         else :
             printer.Parents = self.getParentPrintersFromBackend(printer)
-        for parent in printer.Parents[:] :
-            printer.Parents.extend(self.getParentPrinters(parent))
-        uniquedic = {}
-        for parent in printer.Parents :
-            uniquedic[parent.Name] = parent
-        printer.Parents = uniquedic.values()
         return printer.Parents
 
+    def walkPrinterGroups(self, printerid, parents) :
+        """Returns the identifiers of all the ancestors of a printer, and True if it is its own ancestor.
+
+           parents maps printers identifiers to the identifiers of the
+           printer groups they are direct members of. A printer group
+           met twice isn't walked again, so loops can't recurse forever.
+        """
+        ancestors = []
+        isloop = False
+        seen = { printerid : None }
+        level = [ printerid ]
+        while level :
+            nextlevel = []
+            for ident in level :
+                for parentid in parents.get(ident, []) :
+                    if parentid == printerid :
+                        isloop = True
+                    elif not seen.has_key(parentid) :
+                        seen[parentid] = None
+                        ancestors.append(parentid)
+                        nextlevel.append(parentid)
+            level = nextlevel
+        return (ancestors, isloop)
+
+    def flushParentPrinters(self) :
+        """Forgets all the known parent printers, after printer groups were modified."""
+        self.flushSharedEntry("PARENTS")
+        if self.usecache :
+            for (name, printer) in self.caches["PRINTERS"].items() :
+                if hasattr(printer, "Parents") :
+                    del printer.Parents
+
+    def flushQuotas(self, cachetype, attribute, names) :
+        """Removes the print quota entries of some deleted users, groups or printers from the cache."""
+        if self.usecache :
+            for (key, pquota) in self.caches[cachetype].items() :
+                if names.has_key(getattr(pquota, attribute).Name) :
+                    self.flushEntry(cachetype, key)
+
+    def flushDeletedUsers(self, users) :
+        """Removes many deleted users from the caches."""
+        for user in users :
+            self.flushEntry("USERS", user.Name)
+            self.flushSharedEntry("USERGROUPS", user.Name)
+        self.flushQuotas("USERPQUOTAS", "User", {}.fromkeys([user.Name for user in users]))
+
+    def flushDeletedGroups(self, groups) :
+        """Removes many deleted groups from the caches."""
+        for group in groups :
+            self.flushEntry("GROUPS", group.Name)
+        self.flushSharedEntry("USERGROUPS")
+        self.flushQuotas("GROUPPQUOTAS", "Group", {}.fromkeys([group.Name for group in groups]))
+
+    def flushDeletedPrinters(self, printers) :
+        """Removes many deleted printers from the caches."""
+        for printer in printers :
+            self.flushEntry("PRINTERS", printer.Name)
+        self.flushParentPrinters()
+        names = {}.fromkeys([printer.Name for printer in printers])
+        self.flushQuotas("USERPQUOTAS", "Printer", names)
+        self.flushQuotas("GROUPPQUOTAS", "Printer", names)
+
     def getGroupMembers(self, group) :
         """Returns the group's members list from in-group cache."""
         if self.usecache :
             if not hasattr(group, "Members") :
-                self.tool.logdebug("Cache miss (%s->Members)" % group.Name)
+                self.relatedcounters["Members"][1] += 1
                 group.Members = self.getGroupMembersFromBackend(group)
-                self.tool.logdebug("Cache store (%s->Members)" % group.Name)
             else :
-                self.tool.logdebug("Cache hit (%s->Members)" % group.Name)
+                self.relatedcounters["Members"][0] += 1
         else :
             group.Members = self.getGroupMembersFromBackend(group)
         return group.Members
@@ -703,23 +906,57 @@ class BaseStorage :
         """Returns the user's groups list from in-user cache."""
         if self.usecache :
             if not hasattr(user, "Groups") :
-                self.tool.logdebug("Cache miss (%s->Groups)" % user.Name)
-                user.Groups = self.getUserGroupsFromBackend(user)
-                self.tool.logdebug("Cache store (%s->Groups)" % user.Name)
+                self.relatedcounters["Groups"][1] += 1
+                user.Groups = self.getSharedNames("USERGROUPS", user, \
+                                                  self.getUserGroupsFromBackend, \
+                                                  self.getGroup)
             else :
-                self.tool.logdebug("Cache hit (%s->Groups)" % user.Name)
+                self.relatedcounters["Groups"][0] += 1
         else :
             user.Groups = self.getUserGroupsFromBackend(user)
         return user.Groups
 
     def getParentPrintersUserPQuota(self, userpquota) :
         """Returns all user print quota on the printer and all its parents recursively."""
-        upquotas = [ ]
-        for printer in self.getParentPrinters(userpquota.Printer) :
-            upq = self.getUserPQuota(userpquota.User, printer)
-            if upq.Exists :
-                upquotas.append(upq)
-        return upquotas
+        if self.usecache and hasattr(userpquota.Printer, "Parents") :
+            upquotas = [ ]
+            for printer in userpquota.Printer.Parents :
+                upq = self.getUserPQuota(userpquota.User, printer)
+                if upq.Exists :
+                    upquotas.append(upq)
+            return upquotas
+        return self.getParentPrintersUserPQuotaFromBackend(userpquota)
+
+    def getUserGroupsPQuota(self, userpquota) :
+        """Returns the print quota on the same printer for each of the user's groups."""
+        return [self.getGroupPQuota(group, userpquota.Printer) for group in self.getUserGroups(userpquota.User)]
+
+    def getAdmissionContext(self, username, printername, billingcode=None) :
+        """Returns (printer, user, userpquota, billingcode) for a job to admit.
+
+           The printer's last job and parents, the user's groups and
+           all the related print quotas are retrieved at the same time,
+           which backends do with as few round trips as they can.
+           The billing code is None if none was asked for.
+        """
+        (printer, user, userpquota, code) = self.getAdmissionContextFromBackend(username, printername, billingcode)
+        if self.usecache :
+            # shared entries aren't refreshed here, this
+            # would mean writing to the shared cache for each job.
+            self.cacheEntry("PRINTERS", printername, printer, shared=False)
+            self.cacheEntry("USERS", username, user)
+            if code is not None :
+                self.cacheEntry("BILLINGCODES", billingcode, code)
+            if printer.Exists and user.Exists and userpquota.Exists :
+                self.cacheEntry("LASTJOBS", printer.Name, printer.LastJob)
+                for upq in [ userpquota ] + userpquota.ParentPrintersUserPQuota :
+                    self.cacheEntry("PRINTERS", upq.Printer.Name, upq.Printer, shared=False)
+                    self.cacheEntry("USERPQUOTAS", "%s@%s" % (user.Name, upq.Printer.Name), upq)
+                for grouppquota in userpquota.GroupsPQuota :
+                    self.cacheEntry("GROUPS", grouppquota.Group.Name, grouppquota.Group)
+                    for gpq in [ grouppquota ] + grouppquota.ParentPrintersGroupPQuota :
+                        self.cacheEntry("GROUPPQUOTAS", "%s@%s" % (gpq.Group.Name, gpq.Printer.Name), gpq)
+        return (printer, user, userpquota, code)
 
     def getParentPrintersGroupPQuota(self, grouppquota) :
         """Returns all group print quota on the printer and all its parents recursively."""
@@ -828,18 +1065,25 @@ class BaseStorage :
 
         return (start, end)
 
+def closeExtraction(records) :
+    """Ends an extraction whose records may not have all been read, if it can be ended."""
+    close = getattr(records, "close", None)
+    if close is not None :
+        close()
+
 def openConnection(pykotatool) :
     """Returns a connection handle to the appropriate database."""
     backendinfo = pykotatool.config.getStorageBackend()
     backend = backendinfo["storagebackend"]
+    modulename = "pykota.storages.%s" % backend.lower()
     try :
-        storagebackend = imp.load_source("storagebackend",
-                                         os.path.join(os.path.dirname(__file__),
-                                                      "storages",
-                                                      "%s.py" % backend.lower()))
+        # modules already imported, e.g. preloaded by the
+        # accounting daemon, are reused.
+        __import__(modulename)
     except ImportError :
         raise PyKotaStorageError, _("Unsupported quota storage backend %s") % backend
     else :
+        storagebackend = sys.modules[modulename]
         host = backendinfo["storageserver"]
         database = backendinfo["storagename"]
         admin = backendinfo["storageadmin"] or backendinfo["storageuser"]
@@ -33,20 +33,24 @@ import time
 import md5
 import base64
 import random
+import heapq
+import itertools
 
 from mx import DateTime
 
 from pykota.errors import PyKotaStorageError
-from pykota.storage import BaseStorage, \
+from pykota.storage import BaseStorage, CacheStore, \
                            StorageUser, StorageGroup, StoragePrinter, \
                            StorageJob, StorageLastJob, StorageUserPQuota, \
                            StorageGroupPQuota, StorageBillingCode
+from pykota.sharedcache import SharedCache
 
 from pykota.utils import *
 
 try :
     import ldap
     import ldap.modlist
+    import ldap.filter
 except ImportError :
     raise PyKotaStorageError, "This python version (%s) doesn't seem to have the python-ldap module installed correctly." % sys.version.split()[0]
 else :
@@ -57,8 +61,179 @@ else :
         sys.stderr.write("ERROR: PyKota requires a newer version of python-ldap. Workaround activated. Please upgrade python-ldap !\n")
         class cidict(UserDict.UserDict) :
             pass # Fake it all, and don't care for case insensitivity : users who need it will have to upgrade.
+    try :
+        from ldap.controls import SimplePagedResultsControl
+    except ImportError :
+        SimplePagedResultsControl = None
+    try :
+        from ldap.controls.sss import SSSRequestControl, SSSResponseControl
+    except ImportError :
+        SSSRequestControl = SSSResponseControl = None
+    try :
+        from ldap.controls.psearch import PersistentSearchControl
+    except ImportError :
+        PersistentSearchControl = None
+    from ldap.controls import LDAPControl
+    from ldap.dn import escape_dn_chars
+
+LDAPPAGESIZE = 500 # Number of entries retrieved at once by paged searches
+LDAPFILTERCHUNK = 100 # Maximum number of values in a single OR filter
+LDAPWINDOW = 200 # Maximum number of asynchronous requests waiting for an answer
+TREEDELETEOID = "1.2.840.113556.1.4.805" # Tree Delete control
+OPERATIONALATTRIBUTES = ("createtimestamp", "modifytimestamp") # not returned by "*"
+JOBATTRIBUTES = [ "pykotaJobSizeBytes", "pykotaHostName", "pykotaUserName",
+                  "pykotaPrinterName", "pykotaJobId", "pykotaPrinterPageCounter",
+                  "pykotaAction", "pykotaJobSize", "pykotaJobPrice",
+                  "pykotaFileName", "pykotaTitle", "pykotaCopies",
+                  "pykotaOptions", "pykotaBillingCode", "pykotaPages",
+                  "pykotaMD5Sum", "pykotaPrecomputedJobSize",
+                  "pykotaPrecomputedJobPrice", "createTimestamp" ] # read from job entries
+
+class LDAPEntryCache :
+    """A DN keyed cache of LDAP entries, with size and age limits.
+
+       Entries may also be stored in a file shared by all processes.
+       When the server supports persistent searches, entries modified
+       by other clients are removed as soon as the server tells us.
+    """
+    def __init__(self, tool, maxentries, maxage, filename=None) :
+        """Initializes an empty cache."""
+        self.tool = tool
+        self.maxentries = maxentries
+        self.maxage = maxage
+        self.entries = CacheStore(maxentries, maxage)
+        self.shared = None
+        if filename :
+            self.shared = SharedCache(tool, filename, maxage or 300)
+            self.shared.purge()
+        self.database = None
+        self.watchid = None
+
+    def watch(self, database, base) :
+        """Asks the server to tell us about entries modified below base, if it can."""
+        if self.database is not None :
+            # changes done while we were disconnected are unknown
+            self.entries = CacheStore(self.maxentries, self.maxage)
+        self.database = database
+        self.watchid = None
+        if PersistentSearchControl is not None :
+            try :
+                control = PersistentSearchControl(True, ["modify", "delete", "modDN"], True, True)
+                self.watchid = database.search_ext(base, ldap.SCOPE_SUBTREE, "(objectClass=*)", ["1.1"], serverctrls=[control])
+            except ldap.LDAPError, msg :
+                self.tool.logdebug("LDAP cache : persistent search unavailable (%s)" % msg)
+
+    def poll(self) :
+        """Removes the entries the server told us about since the last time."""
+        while self.watchid is not None :
+            try :
+                (rtype, rdata, rmsgid, rctrls) = self.database.result3(self.watchid, 0, 0)
+            except ldap.TIMEOUT :
+                break
+            except ldap.LDAPError, msg :
+                self.tool.logdebug("LDAP cache : persistent search unavailable (%s), entries will only expire." % msg)
+                self.watchid = None
+                break
+            if rtype is None :
+                break
+            if rtype == ldap.RES_SEARCH_RESULT :
+                self.tool.logdebug("LDAP cache : persistent search ended by the server, entries will only expire.")
+                self.watchid = None
+                break
+            for (dn, attributes) in rdata or [] :
+                if dn :
+                    self.remove(dn)
+            for control in rctrls or [] :
+                previousdn = getattr(control, "previousDN", None)
+                if previousdn :
+                    self.remove(previousdn)
+
+    def covers(self, attributes, fetched, fields) :
+        """Returns True if a cached entry includes all the fields."""
+        present = [k.lower() for k in attributes.keys()]
+        for field in [f.lower() for f in (fields or ["*"])] :
+            if (field in fetched) or (field in present) :
+                continue
+            if ("*" in fetched) and (field != "*") and (field not in OPERATIONALATTRIBUTES) :
+                continue # we know it's not set
+            return False
+        return True
+
+    def lookup(self, key) :
+        """Returns the (attributes, fetched fields) couple for an entry, or None."""
+        cached = self.entries.get(key)
+        if (cached is None) and (self.shared is not None) :
+            cached = self.shared.get("LDAPENTRIES", key)
+            if cached is not None :
+                cached = (cidict(cached[0]), cached[1])
+                self.entries.put(key, cached)
+        return cached
+
+    def store(self, key, attributes, fetched) :
+        """Stores an entry, and shares it if needed."""
+        self.entries.put(key, (attributes, fetched))
+        if self.shared is not None :
+            self.shared.put("LDAPENTRIES", key, (dict(attributes.items()), fetched))
+
+    def get(self, dn, fields=None) :
+        """Returns a copy of an entry if all the fields are known, else None."""
+        self.poll()
+        cached = self.lookup(dn.lower())
+        if cached is not None :
+            (attributes, fetched) = cached
+            if self.covers(attributes, fetched, fields) :
+                self.tool.logdebug("LDAP cache hit %s => %s" % (dn, attributes))
+                return cidict(attributes)
+        self.tool.logdebug("LDAP cache miss %s" % dn)
+        return None
+
+    def put(self, dn, attributes, fields=None) :
+        """Stores an entry retrieved with these fields, or added."""
+        key = dn.lower()
+        requested = [f.lower() for f in (fields or ["*"])]
+        attributes = cidict(attributes)
+        cached = self.lookup(key)
+        if (cached is not None) and ("*" not in requested) :
+            (oldattributes, fetched) = cached
+            merged = cidict()
+            for (k, v) in oldattributes.items() :
+                if k.lower() not in requested :
+                    merged[k] = v
+            merged.update(attributes)
+            attributes = merged
+            requested = fetched + [f for f in requested if f not in fetched]
+        self.tool.logdebug("LDAP cache store %s => %s" % (dn, attributes))
+        self.store(key, attributes, requested)
+
+    def update(self, dn, modlist) :
+        """Applies the modifications we did to an entry."""
+        key = dn.lower()
+        cached = self.lookup(key)
+        if cached is not None :
+            (attributes, fetched) = cached
+            for (mop, mtyp, mval) in modlist :
+                if mop in (ldap.MOD_ADD, ldap.MOD_REPLACE) :
+                    attributes[mtyp] = mval
+                else :
+                    try :
+                        del attributes[mtyp]
+                    except KeyError :
+                        pass
+            self.tool.logdebug("LDAP cache update %s => %s" % (dn, attributes))
+            self.store(key, attributes, fetched)
+
+    def remove(self, dn) :
+        """Removes an entry."""
+        key = dn.lower()
+        self.tool.logdebug("LDAP cache del %s" % dn)
+        self.entries.remove(key)
+        if self.shared is not None :
+            self.shared.delete("LDAPENTRIES", key)
 
 class Storage(BaseStorage) :
+    batch = None # operations deferred until commit, if not None
+    ldapcache = None # low-level cache specific to LDAP backend, if enabled
+
     def __init__(self, pykotatool, host, dbname, user, passwd) :
         """Opens the LDAP connection."""
         self.savedtool = pykotatool
@@ -66,6 +241,7 @@ class Storage(BaseStorage) :
         self.saveddbname = dbname
         self.saveduser = user
         self.savedpasswd = passwd
+        self.jobcontainers = {} # containers for job entries known to exist
         self.secondStageInit()
 
     def secondStageInit(self) :
@@ -102,7 +278,11 @@ class Storage(BaseStorage) :
                 self.useldapcache = self.tool.config.getLDAPCache()
                 if self.useldapcache :
                     self.tool.logdebug("Low-Level LDAP Caching enabled.")
-                    self.ldapcache = {} # low-level cache specific to LDAP backend
+                    if self.ldapcache is None :
+                        (maxentries, maxage) = self.tool.config.getLDAPCacheLimits()
+                        self.ldapcache = LDAPEntryCache(self.tool, maxentries, maxage, \
+                                                        self.tool.config.getLDAPCacheFile())
+                    self.ldapcache.watch(self.database, self.basedn)
                 self.closed = False
                 self.tool.logdebug("Database opened (host=%s, dbname=%s, user=%s)" \
                                        % (repr(self.savedhost),
@@ -117,6 +297,10 @@ class Storage(BaseStorage) :
             self.database.unbind_s()
             self.closed = True
             self.tool.logdebug("Database closed.")
+            if self.ldapcache is not None :
+                cache = self.ldapcache.entries
+                self.tool.logdebug("LDAP cache : %i hits, %i misses, %i evictions, %i entries." \
+                                       % (cache.hits, cache.misses, cache.evictions, len(cache)))
 
     def genUUID(self) :
         """Generates an unique identifier.
@@ -141,31 +325,209 @@ class Storage(BaseStorage) :
 
     def commitTransaction(self) :
         """Commits a transaction."""
+        self.flushBatch()
         self.tool.logdebug("Transaction committed. WARNING : No transactions in LDAP !")
 
     def rollbackTransaction(self) :
         """Rollbacks a transaction."""
+        batch = self.endBatch()
+        if batch :
+            self.tool.logdebug("%i deferred modifications discarded." % len(batch))
         self.tool.logdebug("Transaction aborted. WARNING : No transaction in LDAP !")
 
+    def beginBatch(self) :
+        """Defers additions, modifications and deletions until commit.
+
+           They are then sent without waiting for each answer, using
+           python-ldap's asynchronous API. Searches done meanwhile
+           don't see these modifications.
+        """
+        self.batch = []
+
+    def endBatch(self) :
+        """Stops deferring modifications, returns the pending ones."""
+        batch = self.batch or []
+        self.batch = None
+        return batch
+
+    def flushBatch(self) :
+        """Does the deferred modifications.
+
+           The entries to modify are read all at once, then all the
+           operations are sent, only waiting for an answer before
+           another operation on the same entry, since the server
+           may process the operations it receives concurrently.
+        """
+        batch = self.endBatch()
+        if not batch :
+            return
+        entries = {}
+        searches = {}
+        try :
+            for operation in batch :
+                (optype, dn) = operation[:2]
+                if entries.has_key(dn) or searches.has_key(dn) :
+                    continue
+                if optype == "add" :
+                    entries[dn] = operation[2]
+                elif optype == "delete" :
+                    entries[dn] = cidict()
+                else :
+                    cached = None
+                    if self.useldapcache and not (operation[4] or self.hasRelativeValues(operation[2])) :
+                        cached = self.ldapcache.get(dn)
+                    if cached is not None :
+                        entries[dn] = self.uncachedEntry(cached)
+                    else :
+                        searches[dn] = self.database.search(dn, ldap.SCOPE_BASE, "objectClass=*")
+            self.querydebug("QUERY : %i entries read at once : %s" % (len(searches), searches.keys()))
+            for (dn, msgid) in searches.items() :
+                (rtype, rdata) = self.database.result(msgid)
+                attributes = cidict(rdata[0][1])
+                if self.useldapcache :
+                    self.ldapcache.put(dn, attributes)
+                entries[dn] = self.uncachedEntry(attributes)
+        except ldap.LDAPError, msg :
+            # nothing was modified yet, so we can do it again the slow way
+            self.tool.printInfo("LDAP error : %s" % msg, "error")
+            self.tool.printInfo("LDAP connection will be closed and reopened.", "warn")
+            self.close()
+            self.secondStageInit()
+            for operation in batch :
+                if operation[0] == "add" :
+                    self.doAdd(operation[1], operation[2])
+                elif operation[0] == "modify" :
+                    self.doModify(operation[1], operation[2], operation[3], operation[4])
+                else :
+                    self.doDelete(operation[1])
+            return
+
+        pending = {}
+        errors = []
+        try :
+            try :
+                for operation in batch :
+                    (optype, dn) = operation[:2]
+                    if pending.has_key(dn) :
+                        self.waitForOperation(dn, pending.pop(dn), errors)
+                    if optype == "add" :
+                        fields = operation[2]
+                        self.querydebug("QUERY : ADD(%s, %s)" % (dn, fields))
+                        msgid = self.database.add(dn, ldap.modlist.addModlist(fields))
+                        pending[dn] = (msgid, optype, fields)
+                        entries[dn] = cidict(fields)
+                    elif optype == "modify" :
+                        (fields, entry, modentry) = self.createModlist(dn, entries[dn], operation[2], operation[3])
+                        if modentry :
+                            msgid = self.database.modify(dn, modentry)
+                            pending[dn] = (msgid, optype, entry)
+                        self.applyModlist(entries[dn], entry)
+                    else :
+                        self.querydebug("QUERY : Delete(%s)" % dn)
+                        msgid = self.database.delete(dn)
+                        pending[dn] = (msgid, optype, None)
+                        entries[dn] = cidict()
+            except ldap.LDAPError, msg :
+                errors.append("Problem sending deferred LDAP operations : %s" % msg)
+                self.tool.printInfo("LDAP error : %s" % errors[-1], "error")
+        finally :
+            for (dn, waiting) in pending.items() :
+                self.waitForOperation(dn, waiting, errors)
+        if errors :
+            raise PyKotaStorageError, errors[0]
+
+    def waitForOperation(self, dn, waiting, errors) :
+        """Waits for an asynchronous operation's result, appends its error message if any to errors."""
+        (msgid, optype, data) = waiting
+        try :
+            self.database.result(msgid)
+        except ldap.NO_SUCH_OBJECT :
+            if optype == "delete" :
+                self.tool.printInfo("Entry %s was already missing before we deleted it. This **MAY** be normal." % dn, "info")
+            else :
+                errors.append((_("Problem modifying LDAP entry (%s, %s)") % (dn, data)) + " : entry doesn't exist")
+                self.tool.printInfo("LDAP error : %s" % errors[-1], "error")
+        except ldap.LDAPError, msg :
+            if optype == "add" :
+                errors.append((_("Problem adding LDAP entry (%s, %s)") % (dn, str(data))) + " : %s" % msg)
+            elif optype == "modify" :
+                errors.append((_("Problem modifying LDAP entry (%s, %s)") % (dn, data)) + " : %s" % msg)
+            else :
+                errors.append((_("Problem deleting LDAP entry (%s)") % dn) + " : %s" % msg)
+            self.tool.printInfo("LDAP error : %s" % errors[-1], "error")
+            return
+        if self.useldapcache :
+            if optype == "add" :
+                self.ldapcache.put(dn, data)
+            elif optype == "modify" :
+                self.ldapcache.update(dn, data)
+            else :
+                self.ldapcache.remove(dn)
+
+    def hasRelativeValues(self, fields) :
+        """Returns True if some new values are computed from the old ones."""
+        for value in fields.values() :
+            if type(value) == type({}) :
+                return True
+        return False
+
+    def uncachedEntry(self, attributes) :
+        """Returns a copy of an entry without its operational attributes, suitable for modifications."""
+        oldentry = cidict()
+        for (k, v) in attributes.items() :
+            if k.lower() != "createtimestamp" :
+                oldentry[k] = v
+        return oldentry
+
+    def createModlist(self, dn, oldentry, fields, ignoreold) :
+        """Computes the new values and the modifications to apply to an entry.
+
+           Returns the normalized fields, the full modifications list,
+           and the one to send to the server.
+        """
+        for (k, v) in fields.items() :
+            if type(v) == type({}) :
+                try :
+                    oldvalue = v["convert"](oldentry.get(k, [0])[0])
+                except ValueError :
+                    self.querydebug("Error converting %s with %s(%s)" % (oldentry.get(k), k, v))
+                    oldvalue = 0
+                if v["operator"] == '+' :
+                    newvalue = oldvalue + v["value"]
+                else :
+                    newvalue = oldvalue - v["value"]
+                fields[k] = str(newvalue)
+        fields = self.normalizeFields(fields)
+        self.querydebug("QUERY : Modify(%s, %s ==> %s)" % (dn, oldentry, fields))
+        entry = ldap.modlist.modifyModlist(oldentry, fields, ignore_oldexistent=ignoreold)
+        modentry = []
+        for (mop, mtyp, mval) in entry :
+            if mtyp and (mtyp.lower() != "createtimestamp") :
+                modentry.append((mop, mtyp, mval))
+        self.querydebug("MODIFY : %s ==> %s ==> %s" % (fields, entry, modentry))
+        return (fields, entry, modentry)
+
+    def applyModlist(self, cachedentry, entry) :
+        """Applies a modifications list to an entry we know about."""
+        for (mop, mtyp, mval) in entry :
+            if mop in (ldap.MOD_ADD, ldap.MOD_REPLACE) :
+                cachedentry[mtyp] = mval
+            else :
+                try :
+                    del cachedentry[mtyp]
+                except KeyError :
+                    pass
+
     def doSearch(self, key, fields=None, base="", scope=ldap.SCOPE_SUBTREE, flushcache=0) :
         """Does an LDAP search query."""
         message = ""
         for tryit in range(3) :
             try :
                 base = base or self.basedn
-                if self.useldapcache :
-                    # Here we overwrite the fields the app want, to try and
-                    # retrieve ALL user defined attributes ("*")
-                    # + the createTimestamp attribute, needed by job history
-                    #
-                    # This may not work with all LDAP servers
-                    # but works at least in OpenLDAP (2.1.25)
-                    # and iPlanet Directory Server (5.1 SP3)
-                    fields = ["*", "createTimestamp"]
-
-                if self.useldapcache and (not flushcache) and (scope == ldap.SCOPE_BASE) and self.ldapcache.has_key(base) :
-                    entry = self.ldapcache[base]
-                    self.tool.logdebug("LDAP cache hit %s => %s" % (base, entry))
+                entry = None
+                if self.useldapcache and (not flushcache) and (scope == ldap.SCOPE_BASE) :
+                    entry = self.ldapcache.get(base, fields)
+                if entry is not None :
                     result = [(base, entry)]
                 else :
                     self.querydebug("QUERY : Filter : %s, BaseDN : %s, Scope : %s, Attributes : %s" % (key, base, scope, fields))
@@ -181,16 +543,266 @@ class Storage(BaseStorage) :
             else :
                 self.querydebug("QUERY : Result : %s" % result)
                 result = [ (dn, cidict(attrs)) for (dn, attrs) in result ]
-                if self.useldapcache :
+                if self.useldapcache and (entry is None) :
                     for (dn, attributes) in result :
-                        self.querydebug("LDAP cache store %s => %s" % (dn, attributes))
-                        self.ldapcache[dn] = attributes
+                        self.ldapcache.put(dn, attributes, fields)
                 return result
         raise PyKotaStorageError, message
 
+    def doPagedSearch(self, key, fields, base, process, sortby=None, enough=None) :
+        """Does an LDAP search query, retrieving entries page by page.
+
+           process(dn, attributes) is called for each entry, see pagedSearch().
+        """
+        for (dn, attributes) in self.pagedSearch(key, fields, base, sortby, enough) :
+            process(dn, attributes)
+
+    def pagedSearch(self, key, fields, base, sortby=None, enough=None) :
+        """Does an LDAP search query, yields the entries while retrieving them page by page.
+
+           If the server sorted the entries by sortby, the search stops as
+           soon as enough() returns True. Without the paged results control
+           (python-ldap < 2.4), a single search is done.
+        """
+        base = base or self.basedn
+        pagecontrol = None
+        if SimplePagedResultsControl is not None :
+            try :
+                pagecontrol = SimplePagedResultsControl(False, size=LDAPPAGESIZE, cookie="")
+            except TypeError : # older python-ldap API
+                pagecontrol = None
+        if pagecontrol is None :
+            for (dn, attributes) in self.doSearch(key, fields, base=base) :
+                yield (dn, attributes)
+            return
+        serverctrls = [pagecontrol]
+        if (sortby is not None) and (SSSRequestControl is not None) :
+            serverctrls.append(SSSRequestControl(False, [sortby]))
+        nbentries = 0
+        tryit = 0
+        while 1 :
+            self.querydebug("QUERY : Filter : %s, BaseDN : %s, Attributes : %s, Page size : %s, Sort : %s" % (key, base, fields, LDAPPAGESIZE, sortby))
+            try :
+                msgid = self.database.search_ext(base, ldap.SCOPE_SUBTREE, key, fields, serverctrls=serverctrls)
+                (rtype, rdata, rmsgid, rctrls) = self.database.result3(msgid)
+            except ldap.NO_SUCH_OBJECT, msg :
+                raise PyKotaStorageError, (_("Search base %s doesn't seem to exist. Probable misconfiguration. Please double check /etc/pykota/pykota.conf : %s") % (base, msg))
+            except ldap.LDAPError, msg :
+                message = (_("Search for %s(%s) from %s(scope=%s) returned no answer.") % (key, fields, base, ldap.SCOPE_SUBTREE)) + " : %s" % msg
+                self.tool.printInfo("LDAP error : %s" % message, "error")
+                tryit += 1
+                if nbentries or (tryit >= 3) :
+                    # can't restart in the middle of the results
+                    raise PyKotaStorageError, message
+                self.tool.printInfo("LDAP connection will be closed and reopened.", "warn")
+                self.close()
+                self.secondStageInit()
+                continue
+            for (dn, attributes) in rdata :
+                if dn is not None : # skips search references
+                    yield (dn, cidict(attributes))
+                    nbentries += 1
+            cookie = None
+            sortedbyserver = False
+            for control in rctrls :
+                if control.controlType == pagecontrol.controlType :
+                    cookie = control.cookie
+                elif (SSSResponseControl is not None) and (control.controlType == SSSResponseControl.controlType) :
+                    sortedbyserver = (getattr(control, "result", None) == 0)
+            if not cookie :
+                break
+            pagecontrol.cookie = cookie
+            if sortedbyserver and (enough is not None) and enough() :
+                # tells the server we don't want the next pages
+                pagecontrol.size = 0
+                try :
+                    self.database.search_ext_s(base, ldap.SCOPE_SUBTREE, key, fields, serverctrls=serverctrls)
+                except ldap.LDAPError :
+                    pass
+                break
+        self.querydebug("QUERY : Result : %i entries" % nbentries)
+
+    def toLDAPTimestamp(self, date) :
+        """Converts a local date as found in job history to an LDAP timestamp (UTC), or None."""
+        try :
+            return DateTime.ISO.ParseDateTime(date[:19]).gmtime().strftime("%Y%m%d%H%M%SZ")
+        except :
+            return None
+
+    def jobMonth(self, date) :
+        """Returns the name of the month container for a local date, or None.
+
+           date is either an mx.DateTime or a string as found in job
+           history or returned by cleanDates().
+        """
+        if isinstance(date, types.StringTypes) :
+            try :
+                date = DateTime.ISO.ParseDateTime(date[:19])
+            except :
+                return None
+        return date.strftime("%Y-%m")
+
+    def jobContainer(self, month, printername) :
+        """Returns the DN of the container for a printer's jobs of a given month."""
+        dn = self.info["jobbase"]
+        for container in self.info["jobcontainers"] :
+            if container == "month" :
+                dn = "ou=%s,%s" % (month, dn)
+            else :
+                dn = "ou=%s,%s" % (escape_dn_chars(unicodeToDatabase(printername)), dn)
+        return dn
+
+    def jobReference(self, uuid, month) :
+        """Returns the value of pykotaLastJobIdent for a job."""
+        if self.info["jobcontainers"] :
+            return "%s/%s" % (month, uuid)
+        return uuid
+
+    def jobDN(self, jobref, printername) :
+        """Returns a job's DN given the value of pykotaLastJobIdent."""
+        if "/" in jobref :
+            (month, uuid) = jobref.split("/", 1)
+            return "cn=%s,%s" % (uuid, self.jobContainer(month, printername))
+        return "cn=%s,%s" % (jobref, self.info["jobbase"])
+
+    def createJobContainers(self, month, printername) :
+        """Creates the containers for a printer's jobs of a given month if needed.
+
+           Returns the DN of the innermost container.
+        """
+        dn = self.jobContainer(month, printername)
+        if (dn == self.info["jobbase"]) or self.jobcontainers.has_key(dn) :
+            return dn
+        try :
+            try :
+                self.querydebug("QUERY : Filter : objectClass=*, BaseDN : %s, Scope : %s, Attributes : ['ou']" % (dn, ldap.SCOPE_BASE))
+                self.database.search_s(dn, ldap.SCOPE_BASE, "objectClass=*", ["ou"])
+            except ldap.NO_SUCH_OBJECT :
+                # containers are created synchronously, outside of any
+                # batch, so that they exist before the job is added.
+                parent = self.info["jobbase"]
+                for container in self.info["jobcontainers"] :
+                    if container == "month" :
+                        value = month
+                    else :
+                        value = unicodeToDatabase(printername)
+                    parent = "ou=%s,%s" % (escape_dn_chars(value), parent)
+                    try :
+                        self.querydebug("QUERY : ADD(%s)" % parent)
+                        self.database.add_s(parent, ldap.modlist.addModlist({ "objectClass" : ["organizationalUnit"],
+                                                                              "ou" : value }))
+                    except ldap.ALREADY_EXISTS :
+                        pass # created meanwhile by another process
+        except ldap.LDAPError, msg :
+            raise PyKotaStorageError, (_("Problem adding LDAP entry (%s)") % dn) + " : %s" % msg
+        self.jobcontainers[dn] = None
+        return dn
+
+    def jobBases(self, printernames=None, start=None, end=None) :
+        """Returns the search bases for jobs on some printers between two dates.
+
+           Containers are listed only as deep as needed to honour the
+           printer names and dates, the searches being done in subtrees.
+        """
+        bases = [self.info["jobbase"]]
+        containers = self.info["jobcontainers"]
+        firstmonth = lastmonth = None
+        if start is not None :
+            firstmonth = self.jobMonth(start)
+        if end is not None :
+            lastmonth = self.jobMonth(end)
+        for level in range(len(containers)) :
+            if (not printernames or ("printer" not in containers[level:])) \
+               and (not (start or end) or ("month" not in containers[level:])) :
+                break # no constraint on deeper containers
+            subbases = []
+            for base in bases :
+                if (containers[level] == "printer") and printernames :
+                    names = self.escapeValues([unicodeToDatabase(name) for name in printernames])
+                    for i in range(0, len(names), LDAPFILTERCHUNK) :
+                        result = self.doSearch("(&(objectClass=organizationalUnit)%s)" % self.orFilter("ou", names[i:i+LDAPFILTERCHUNK]), \
+                                               ["ou"], \
+                                               base=base, \
+                                               scope=ldap.SCOPE_ONELEVEL)
+                        subbases.extend([dn for (dn, fields) in result])
+                else :
+                    result = self.doSearch("objectClass=organizationalUnit", ["ou"], base=base, scope=ldap.SCOPE_ONELEVEL)
+                    for (dn, fields) in result :
+                        month = fields["ou"][0]
+                        if (containers[level] == "printer") \
+                           or (((firstmonth is None) or (month >= firstmonth)) and ((lastmonth is None) or (month <= lastmonth))) :
+                            subbases.append(dn)
+            bases = subbases
+        return bases
+
+    def moveJobsToContainers(self) :
+        """Moves all job entries to the containers set by jobcontainers.
+
+           Entries are renamed, so they keep their creation timestamp.
+           Last job entries are updated to point to the new DNs.
+           Returns the number of moved entries.
+        """
+        lastjobs = {}
+        def keepLastJob(dn, fields) :
+            """Remembers which last job entry points to which job."""
+            jobref = fields["pykotaLastJobIdent"][0]
+            lastjobs[jobref.split("/")[-1]] = (dn, jobref)
+        self.doPagedSearch("objectClass=pykotaLastJob", ["pykotaLastJobIdent"], self.info["lastjobbase"], keepLastJob)
+        nbrdns = len(ldap.explode_dn(self.info["jobbase"]))
+        modifications = []
+        pending = []
+        errors = []
+        moved = [0]
+        def moveJob(dn, fields) :
+            """Moves a job entry if it's not in the correct container."""
+            rdns = ldap.explode_dn(dn)
+            uuid = rdns[0].split("=", 1)[1]
+            date = fields.get("createTimestamp", ["19700101000000Z"])[0][:14]
+            month = self.jobMonth(DateTime.strptime(date, "%Y%m%d%H%M%S").localtime()) # It's in UTC !
+            container = self.createJobContainers(month, databaseToUnicode(fields["pykotaPrinterName"][0]))
+            if lastjobs.has_key(uuid) :
+                (lastdn, jobref) = lastjobs[uuid]
+                if jobref != self.jobReference(uuid, month) :
+                    modifications.append((lastdn, { "pykotaLastJobIdent" : self.jobReference(uuid, month) }, 1))
+            containerrdns = [rdn.replace(" ", "").lower() for rdn in ldap.explode_dn(container)[:-nbrdns]]
+            if [rdn.replace(" ", "").lower() for rdn in rdns[1:-nbrdns]] != containerrdns :
+                if len(pending) >= LDAPWINDOW :
+                    self.waitForMove(pending.pop(0), errors)
+                self.querydebug("QUERY : Rename(%s, %s)" % (dn, container))
+                pending.append((dn, self.database.rename(dn, rdns[0], container)))
+                moved[0] += 1
+        try :
+            try :
+                self.doPagedSearch("objectClass=pykotaJob", ["pykotaPrinterName", "createTimestamp"], self.info["jobbase"], moveJob)
+            except ldap.LDAPError, msg :
+                errors.append("Problem sending LDAP renames : %s" % msg)
+                self.tool.printInfo("LDAP error : %s" % errors[-1], "error")
+        finally :
+            for waiting in pending :
+                self.waitForMove(waiting, errors)
+        if errors :
+            raise PyKotaStorageError, errors[0]
+        self.modifyEntries(modifications)
+        return moved[0]
+
+    def waitForMove(self, waiting, errors) :
+        """Waits for an asynchronous rename's result, appends its error message if any to errors."""
+        (dn, msgid) = waiting
+        try :
+            self.database.result(msgid)
+        except ldap.LDAPError, msg :
+            errors.append((_("Problem moving LDAP entry (%s)") % dn) + " : %s" % msg)
+            self.tool.printInfo("LDAP error : %s" % errors[-1], "error")
+        else :
+            if self.useldapcache :
+                self.ldapcache.remove(dn)
+
     def doAdd(self, dn, fields) :
         """Adds an entry in the LDAP directory."""
         fields = self.normalizeFields(cidict(fields))
+        if self.batch is not None :
+            self.batch.append(("add", dn, fields))
+            return dn
         message = ""
         for tryit in range(3) :
             try :
@@ -208,13 +820,15 @@ class Storage(BaseStorage) :
                 self.secondStageInit()
             else :
                 if self.useldapcache :
-                    self.querydebug("LDAP cache add %s => %s" % (dn, fields))
-                    self.ldapcache[dn] = fields
+                    self.ldapcache.put(dn, fields)
                 return dn
         raise PyKotaStorageError, message
 
     def doDelete(self, dn) :
         """Deletes an entry from the LDAP directory."""
+        if self.batch is not None :
+            self.batch.append(("delete", dn))
+            return
         message = ""
         for tryit in range(3) :
             try :
@@ -230,53 +844,23 @@ class Storage(BaseStorage) :
                 self.secondStageInit()
             else :
                 if self.useldapcache :
-                    try :
-                        self.querydebug("LDAP cache del %s" % dn)
-                        del self.ldapcache[dn]
-                    except KeyError :
-                        pass
+                    self.ldapcache.remove(dn)
                 return
         raise PyKotaStorageError, message
 
     def doModify(self, dn, fields, ignoreold=1, flushcache=0) :
         """Modifies an entry in the LDAP directory."""
         fields = cidict(fields)
+        if self.batch is not None :
+            self.batch.append(("modify", dn, fields, ignoreold, flushcache))
+            return dn
         for tryit in range(3) :
             try :
-                # TODO : take care of, and update LDAP specific cache
-                if self.useldapcache and not flushcache :
-                    if self.ldapcache.has_key(dn) :
-                        old = self.ldapcache[dn]
-                        self.querydebug("LDAP cache hit %s => %s" % (dn, old))
-                        oldentry = {}
-                        for (k, v) in old.items() :
-                            if k != "createTimestamp" :
-                                oldentry[k] = v
-                    else :
-                        self.querydebug("LDAP cache miss %s" % dn)
-                        oldentry = self.doSearch("objectClass=*", base=dn, scope=ldap.SCOPE_BASE)[0][1]
-                else :
-                    oldentry = self.doSearch("objectClass=*", base=dn, scope=ldap.SCOPE_BASE, flushcache=flushcache)[0][1]
-                for (k, v) in fields.items() :
-                    if type(v) == type({}) :
-                        try :
-                            oldvalue = v["convert"](oldentry.get(k, [0])[0])
-                        except ValueError :
-                            self.querydebug("Error converting %s with %s(%s)" % (oldentry.get(k), k, v))
-                            oldvalue = 0
-                        if v["operator"] == '+' :
-                            newvalue = oldvalue + v["value"]
-                        else :
-                            newvalue = oldvalue - v["value"]
-                        fields[k] = str(newvalue)
-                fields = self.normalizeFields(fields)
-                self.querydebug("QUERY : Modify(%s, %s ==> %s)" % (dn, oldentry, fields))
-                entry = ldap.modlist.modifyModlist(oldentry, fields, ignore_oldexistent=ignoreold)
-                modentry = []
-                for (mop, mtyp, mval) in entry :
-                    if mtyp and (mtyp.lower() != "createtimestamp") :
-                        modentry.append((mop, mtyp, mval))
-                self.querydebug("MODIFY : %s ==> %s ==> %s" % (fields, entry, modentry))
+                # values computed from the old ones are always read
+                # from the server, other processes may have changed them.
+                flushcache = flushcache or self.hasRelativeValues(fields)
+                oldentry = self.doSearch("objectClass=*", base=dn, scope=ldap.SCOPE_BASE, flushcache=flushcache)[0][1]
+                (fields, entry, modentry) = self.createModlist(dn, oldentry, fields, ignoreold)
                 if modentry :
                     self.database.modify_s(dn, modentry)
             except ldap.LDAPError, msg :
@@ -287,16 +871,7 @@ class Storage(BaseStorage) :
                 self.secondStageInit()
             else :
                 if self.useldapcache :
-                    cachedentry = self.ldapcache[dn]
-                    for (mop, mtyp, mval) in entry :
-                        if mop in (ldap.MOD_ADD, ldap.MOD_REPLACE) :
-                            cachedentry[mtyp] = mval
-                        else :
-                            try :
-                                del cachedentry[mtyp]
-                            except KeyError :
-                                pass
-                    self.querydebug("LDAP cache update %s => %s" % (dn, cachedentry))
+                    self.ldapcache.update(dn, entry)
                 return dn
         raise PyKotaStorageError, message
 
@@ -368,64 +943,68 @@ class Storage(BaseStorage) :
         username = unicodeToDatabase(username)
         result = self.doSearch("(&(objectClass=pykotaAccount)(|(pykotaUserName=%s)(%s=%s)))" % (username, self.info["userrdn"], username), ["pykotaUserName", "pykotaLimitBy", self.info["usermail"], "description"], base=self.info["userbase"])
         if result :
-            fields = result[0][1]
-            user.ident = result[0][0]
-            user.Description = databaseToUnicode(fields.get("description", [None])[0])
-            user.Email = databaseToUnicode(fields.get(self.info["usermail"], [None])[0])
-            user.LimitBy = databaseToUnicode(fields.get("pykotaLimitBy", ["quota"])[0])
+            self.setUserFromEntry(user, result[0])
             result = self.doSearch("(&(objectClass=pykotaAccountBalance)(|(pykotaUserName=%s)(%s=%s)))" % (username, self.info["balancerdn"], username), ["pykotaBalance", "pykotaLifeTimePaid", "pykotaPayments", "pykotaOverCharge"], base=self.info["balancebase"])
             if not result :
                 raise PyKotaStorageError, _("No pykotaAccountBalance object found for user %s. Did you create LDAP entries manually ?") % username
             else :
-                fields = result[0][1]
-                user.idbalance = result[0][0]
-                user.AccountBalance = fields.get("pykotaBalance")
-                if user.AccountBalance is not None :
-                    if user.AccountBalance[0].upper() == "NONE" :
-                        user.AccountBalance = None
-                    else :
-                        user.AccountBalance = float(user.AccountBalance[0])
-                user.AccountBalance = user.AccountBalance or 0.0
-                user.LifeTimePaid = fields.get("pykotaLifeTimePaid")
-                user.OverCharge = float(fields.get("pykotaOverCharge", [1.0])[0])
-                if user.LifeTimePaid is not None :
-                    if user.LifeTimePaid[0].upper() == "NONE" :
-                        user.LifeTimePaid = None
-                    else :
-                        user.LifeTimePaid = float(user.LifeTimePaid[0])
-                user.LifeTimePaid = user.LifeTimePaid or 0.0
-                user.Payments = []
-                for payment in fields.get("pykotaPayments", []) :
-                    try :
-                        (date, amount, description) = payment.split(" # ")
-                    except ValueError :
-                        # Payment with no description (old Payment)
-                        try :
-                            (date, amount) = payment.split(" # ")
-                        except ValueError :
-                            # Payment with no date ? Bug or something else ?
-                            amount = payment.split(" # ")[0]
-                            date = ""
-                        description = ""
-                    else :
-                        description = databaseToUnicode(base64.decodestring(description))
-                    if amount.endswith(" #") :
-                        amount = amount[:-2] # TODO : should be catched earlier, the bug is above I think
-                    user.Payments.append((date, float(amount), description))
+                self.setUserBalanceFromEntry(user, result[0])
             user.Exists = True
         return user
 
+    def setUserFromEntry(self, user, entry) :
+        """Sets an user's attributes from its pykotaAccount entry."""
+        (dn, fields) = entry
+        user.ident = dn
+        user.Description = databaseToUnicode(fields.get("description", [None])[0])
+        user.Email = databaseToUnicode(fields.get(self.info["usermail"], [None])[0])
+        user.LimitBy = databaseToUnicode(fields.get("pykotaLimitBy", ["quota"])[0])
+
+    def setUserBalanceFromEntry(self, user, entry) :
+        """Sets an user's balance attributes from its pykotaAccountBalance entry."""
+        (dn, fields) = entry
+        user.idbalance = dn
+        user.AccountBalance = fields.get("pykotaBalance")
+        if user.AccountBalance is not None :
+            if user.AccountBalance[0].upper() == "NONE" :
+                user.AccountBalance = None
+            else :
+                user.AccountBalance = float(user.AccountBalance[0])
+        user.AccountBalance = user.AccountBalance or 0.0
+        user.LifeTimePaid = fields.get("pykotaLifeTimePaid")
+        user.OverCharge = float(fields.get("pykotaOverCharge", [1.0])[0])
+        if user.LifeTimePaid is not None :
+            if user.LifeTimePaid[0].upper() == "NONE" :
+                user.LifeTimePaid = None
+            else :
+                user.LifeTimePaid = float(user.LifeTimePaid[0])
+        user.LifeTimePaid = user.LifeTimePaid or 0.0
+        user.Payments = []
+        for payment in fields.get("pykotaPayments", []) :
+            try :
+                (date, amount, description) = payment.split(" # ")
+            except ValueError :
+                # Payment with no description (old Payment)
+                try :
+                    (date, amount) = payment.split(" # ")
+                except ValueError :
+                    # Payment with no date ? Bug or something else ?
+                    amount = payment.split(" # ")[0]
+                    date = ""
+                description = ""
+            else :
+                description = databaseToUnicode(base64.decodestring(description))
+            if amount.endswith(" #") :
+                amount = amount[:-2] # TODO : should be catched earlier, the bug is above I think
+            user.Payments.append((date, float(amount), description))
+
     def getGroupFromBackend(self, groupname) :
         """Extracts group information given its name."""
         group = StorageGroup(self, groupname)
         groupname = unicodeToDatabase(groupname)
         result = self.doSearch("(&(objectClass=pykotaGroup)(|(pykotaGroupName=%s)(%s=%s)))" % (groupname, self.info["grouprdn"], groupname), ["pykotaGroupName", "pykotaLimitBy", "description"], base=self.info["groupbase"])
         if result :
-            fields = result[0][1]
-            group.ident = result[0][0]
-            group.Name = databaseToUnicode(fields.get("pykotaGroupName", [groupname])[0])
-            group.Description = databaseToUnicode(fields.get("description", [None])[0])
-            group.LimitBy = databaseToUnicode(fields.get("pykotaLimitBy", ["quota"])[0])
+            self.setGroupFromEntry(group, result[0])
             group.AccountBalance = 0.0
             group.LifeTimePaid = 0.0
             for member in self.getGroupMembers(group) :
@@ -435,6 +1014,14 @@ class Storage(BaseStorage) :
             group.Exists = True
         return group
 
+    def setGroupFromEntry(self, group, entry) :
+        """Sets a group's attributes from its pykotaGroup entry."""
+        (dn, fields) = entry
+        group.ident = dn
+        group.Name = databaseToUnicode(fields.get("pykotaGroupName", [unicodeToDatabase(group.Name)])[0])
+        group.Description = databaseToUnicode(fields.get("description", [None])[0])
+        group.LimitBy = databaseToUnicode(fields.get("pykotaLimitBy", ["quota"])[0])
+
     def getPrinterFromBackend(self, printername) :
         """Extracts printer information given its name : returns first matching printer."""
         printer = StoragePrinter(self, printername)
@@ -467,9 +1054,43 @@ class Storage(BaseStorage) :
             printer.Exists = True
         return printer
 
+    def storageUserPQuotaFromRecord(self, user, printer, record) :
+        """Returns a StorageUserPQuota instance from an LDAP entry."""
+        userpquota = StorageUserPQuota(self, user, printer)
+        (dn, fields) = record
+        userpquota.ident = dn
+        userpquota.PageCounter = int(fields.get("pykotaPageCounter", [0])[0])
+        userpquota.LifePageCounter = int(fields.get("pykotaLifePageCounter", [0])[0])
+        userpquota.WarnCount = int(fields.get("pykotaWarnCount", [0])[0])
+        userpquota.SoftLimit = fields.get("pykotaSoftLimit")
+        if userpquota.SoftLimit is not None :
+            if userpquota.SoftLimit[0].upper() == "NONE" :
+                userpquota.SoftLimit = None
+            else :
+                userpquota.SoftLimit = int(userpquota.SoftLimit[0])
+        userpquota.HardLimit = fields.get("pykotaHardLimit")
+        if userpquota.HardLimit is not None :
+            if userpquota.HardLimit[0].upper() == "NONE" :
+                userpquota.HardLimit = None
+            elif userpquota.HardLimit is not None :
+                userpquota.HardLimit = int(userpquota.HardLimit[0])
+        userpquota.DateLimit = fields.get("pykotaDateLimit")
+        if userpquota.DateLimit is not None :
+            if userpquota.DateLimit[0].upper() == "NONE" :
+                userpquota.DateLimit = None
+            else :
+                userpquota.DateLimit = userpquota.DateLimit[0]
+        userpquota.MaxJobSize = fields.get("pykotaMaxJobSize")
+        if userpquota.MaxJobSize is not None :
+            if userpquota.MaxJobSize[0].upper() == "NONE" :
+                userpquota.MaxJobSize = None
+            else :
+                userpquota.MaxJobSize = int(userpquota.MaxJobSize[0])
+        userpquota.Exists = True
+        return userpquota
+
     def getUserPQuotaFromBackend(self, user, printer) :
         """Extracts a user print quota."""
-        userpquota = StorageUserPQuota(self, user, printer)
         if printer.Exists and user.Exists :
             if self.info["userquotabase"].lower() == "user" :
                 base = user.ident
@@ -480,41 +1101,71 @@ class Storage(BaseStorage) :
                                       ["pykotaPageCounter", "pykotaLifePageCounter", "pykotaSoftLimit", "pykotaHardLimit", "pykotaDateLimit", "pykotaWarnCount", "pykotaMaxJobSize"], \
                                       base=base)
             if result :
-                fields = result[0][1]
-                userpquota.ident = result[0][0]
-                userpquota.PageCounter = int(fields.get("pykotaPageCounter", [0])[0])
-                userpquota.LifePageCounter = int(fields.get("pykotaLifePageCounter", [0])[0])
-                userpquota.WarnCount = int(fields.get("pykotaWarnCount", [0])[0])
-                userpquota.SoftLimit = fields.get("pykotaSoftLimit")
-                if userpquota.SoftLimit is not None :
-                    if userpquota.SoftLimit[0].upper() == "NONE" :
-                        userpquota.SoftLimit = None
-                    else :
-                        userpquota.SoftLimit = int(userpquota.SoftLimit[0])
-                userpquota.HardLimit = fields.get("pykotaHardLimit")
-                if userpquota.HardLimit is not None :
-                    if userpquota.HardLimit[0].upper() == "NONE" :
-                        userpquota.HardLimit = None
-                    elif userpquota.HardLimit is not None :
-                        userpquota.HardLimit = int(userpquota.HardLimit[0])
-                userpquota.DateLimit = fields.get("pykotaDateLimit")
-                if userpquota.DateLimit is not None :
-                    if userpquota.DateLimit[0].upper() == "NONE" :
-                        userpquota.DateLimit = None
-                    else :
-                        userpquota.DateLimit = userpquota.DateLimit[0]
-                userpquota.MaxJobSize = fields.get("pykotaMaxJobSize")
-                if userpquota.MaxJobSize is not None :
-                    if userpquota.MaxJobSize[0].upper() == "NONE" :
-                        userpquota.MaxJobSize = None
-                    else :
-                        userpquota.MaxJobSize = int(userpquota.MaxJobSize[0])
-                userpquota.Exists = True
-        return userpquota
+                return self.storageUserPQuotaFromRecord(user, printer, result[0])
+        return StorageUserPQuota(self, user, printer)
+
+    def storageGroupPQuotaFromRecord(self, group, printer, record) :
+        """Returns a StorageGroupPQuota instance from an LDAP entry.
+
+           Its page counters are set to 0, they must be computed
+           from the group members' print quota entries.
+        """
+        grouppquota = StorageGroupPQuota(self, group, printer)
+        (dn, fields) = record
+        grouppquota.ident = dn
+        grouppquota.SoftLimit = fields.get("pykotaSoftLimit")
+        if grouppquota.SoftLimit is not None :
+            if grouppquota.SoftLimit[0].upper() == "NONE" :
+                grouppquota.SoftLimit = None
+            else :
+                grouppquota.SoftLimit = int(grouppquota.SoftLimit[0])
+        grouppquota.HardLimit = fields.get("pykotaHardLimit")
+        if grouppquota.HardLimit is not None :
+            if grouppquota.HardLimit[0].upper() == "NONE" :
+                grouppquota.HardLimit = None
+            else :
+                grouppquota.HardLimit = int(grouppquota.HardLimit[0])
+        grouppquota.DateLimit = fields.get("pykotaDateLimit")
+        if grouppquota.DateLimit is not None :
+            if grouppquota.DateLimit[0].upper() == "NONE" :
+                grouppquota.DateLimit = None
+            else :
+                grouppquota.DateLimit = grouppquota.DateLimit[0]
+        grouppquota.PageCounter = 0
+        grouppquota.LifePageCounter = 0
+        grouppquota.Exists = True
+        return grouppquota
+
+    def addGroupPQuotasCounters(self, group, gpquotas) :
+        """Adds the group members' page counters to a list of group print quotas on different printers."""
+        bynames = {}
+        for grouppquota in gpquotas :
+            bynames[grouppquota.Printer.Name] = grouppquota
+        printernamesfilter = "".join(["(pykotaPrinterName=%s)" % unicodeToDatabase(name) for name in bynames.keys()])
+        if len(bynames) > 1 :
+            printernamesfilter = "(|%s)" % printernamesfilter
+        usernamesfilter = "".join(["(pykotaUserName=%s)" % unicodeToDatabase(member.Name) for member in self.getGroupMembers(group)])
+        if usernamesfilter :
+            usernamesfilter = "(|%s)" % usernamesfilter
+        if self.info["userquotabase"].lower() == "user" :
+            base = self.info["userbase"]
+        else :
+            base = self.info["userquotabase"]
+        result = self.doSearch("(&(objectClass=pykotaUserPQuota)%s%s)" % \
+                                  (printernamesfilter, usernamesfilter), \
+                                  ["pykotaPageCounter", "pykotaLifePageCounter", "pykotaPrinterName"], base=base)
+        if result :
+            for userpquota in result :
+                if len(gpquotas) == 1 :
+                    grouppquota = gpquotas[0]
+                else :
+                    grouppquota = bynames.get(databaseToUnicode(userpquota[1].get("pykotaPrinterName", [""])[0]))
+                if grouppquota is not None :
+                    grouppquota.PageCounter += int(userpquota[1].get("pykotaPageCounter", [0])[0] or 0)
+                    grouppquota.LifePageCounter += int(userpquota[1].get("pykotaLifePageCounter", [0])[0] or 0)
 
     def getGroupPQuotaFromBackend(self, group, printer) :
         """Extracts a group print quota."""
-        grouppquota = StorageGroupPQuota(self, group, printer)
         if group.Exists :
             if self.info["groupquotabase"].lower() == "group" :
                 base = group.ident
@@ -525,44 +1176,10 @@ class Storage(BaseStorage) :
                                       ["pykotaSoftLimit", "pykotaHardLimit", "pykotaDateLimit"], \
                                       base=base)
             if result :
-                fields = result[0][1]
-                grouppquota.ident = result[0][0]
-                grouppquota.SoftLimit = fields.get("pykotaSoftLimit")
-                if grouppquota.SoftLimit is not None :
-                    if grouppquota.SoftLimit[0].upper() == "NONE" :
-                        grouppquota.SoftLimit = None
-                    else :
-                        grouppquota.SoftLimit = int(grouppquota.SoftLimit[0])
-                grouppquota.HardLimit = fields.get("pykotaHardLimit")
-                if grouppquota.HardLimit is not None :
-                    if grouppquota.HardLimit[0].upper() == "NONE" :
-                        grouppquota.HardLimit = None
-                    else :
-                        grouppquota.HardLimit = int(grouppquota.HardLimit[0])
-                grouppquota.DateLimit = fields.get("pykotaDateLimit")
-                if grouppquota.DateLimit is not None :
-                    if grouppquota.DateLimit[0].upper() == "NONE" :
-                        grouppquota.DateLimit = None
-                    else :
-                        grouppquota.DateLimit = grouppquota.DateLimit[0]
-                grouppquota.PageCounter = 0
-                grouppquota.LifePageCounter = 0
-                usernamesfilter = "".join(["(pykotaUserName=%s)" % unicodeToDatabase(member.Name) for member in self.getGroupMembers(group)])
-                if usernamesfilter :
-                    usernamesfilter = "(|%s)" % usernamesfilter
-                if self.info["userquotabase"].lower() == "user" :
-                    base = self.info["userbase"]
-                else :
-                    base = self.info["userquotabase"]
-                result = self.doSearch("(&(objectClass=pykotaUserPQuota)(pykotaPrinterName=%s)%s)" % \
-                                          (unicodeToDatabase(printer.Name), usernamesfilter), \
-                                          ["pykotaPageCounter", "pykotaLifePageCounter"], base=base)
-                if result :
-                    for userpquota in result :
-                        grouppquota.PageCounter += int(userpquota[1].get("pykotaPageCounter", [0])[0] or 0)
-                        grouppquota.LifePageCounter += int(userpquota[1].get("pykotaLifePageCounter", [0])[0] or 0)
-                grouppquota.Exists = True
-        return grouppquota
+                grouppquota = self.storageGroupPQuotaFromRecord(group, printer, result[0])
+                self.addGroupPQuotasCounters(group, [ grouppquota ])
+                return grouppquota
+        return StorageGroupPQuota(self, group, printer)
 
     def getPrinterLastJobFromBackend(self, printer) :
         """Extracts a printer's last job information."""
@@ -596,7 +1213,7 @@ class Storage(BaseStorage) :
                                                                   "pykotaPrecomputedJobSize",
                                                                   "pykotaPrecomputedJobPrice",
                                                                   "createTimestamp" ],
-                                                                base="cn=%s,%s" % (lastjobident, self.info["jobbase"]), scope=ldap.SCOPE_BASE)
+                                                                base=self.jobDN(lastjobident, printer.Name), scope=ldap.SCOPE_BASE)
             except PyKotaStorageError :
                 pass # Last job entry exists, but job probably doesn't exist anymore.
             if result :
@@ -684,20 +1301,133 @@ class Storage(BaseStorage) :
         return groups
 
     def getParentPrintersFromBackend(self, printer) :
-        """Get all the printer groups this printer is a member of."""
+        """Get all the printer groups this printer is a member of, recursively.
+
+           Each level of printer groups is retrieved with a single search,
+           a printer group met twice isn't searched again so that loops
+           can't recurse forever.
+        """
         pgroups = []
-        result = self.doSearch("(&(objectClass=pykotaPrinter)(uniqueMember=%s))" % \
-                                  printer.ident, \
-                                  ["pykotaPrinterName"], \
-                                  base=self.info["printerbase"])
-        if result :
-            for (printerid, fields) in result :
-                if printerid != printer.ident : # In case of integrity violation.
-                    parentprinter = self.getPrinter(databaseToUnicode(fields.get("pykotaPrinterName")[0]))
-                    if parentprinter.Exists :
-                        pgroups.append(parentprinter)
+        seen = { printer.ident : None }
+        level = [ printer ]
+        while level :
+            result = self.doSearch("(&(objectClass=pykotaPrinter)(|%s))" % \
+                                      "".join(["(uniqueMember=%s)" % p.ident for p in level]), \
+                                      ["pykotaPrinterName"], \
+                                      base=self.info["printerbase"])
+            level = []
+            for (printerid, fields) in (result or []) :
+                if seen.has_key(printerid) :
+                    if printerid == printer.ident :
+                        self.tool.printInfo("Printer %s is a member of itself through printer groups, please fix this." % printer.Name, "warn")
+                    continue
+                seen[printerid] = None
+                parentprinter = self.getPrinter(databaseToUnicode(fields.get("pykotaPrinterName")[0]))
+                if parentprinter.Exists :
+                    pgroups.append(parentprinter)
+                    level.append(parentprinter)
         return pgroups
 
+    def checkPrinterGroups(self) :
+        """Checks printer groups membership.
+
+           There's no precomputed printer groups closure in LDAP, so
+           (0, 0, loops) is returned, loops being the names of printers
+           which are members of themselves through printer groups.
+        """
+        result = self.doSearch("objectClass=pykotaPrinter", \
+                                  ["pykotaPrinterName", self.info["printerrdn"], "uniqueMember"], \
+                                  base=self.info["printerbase"])
+        parents = {}
+        names = {}
+        for (printerid, fields) in (result or []) :
+            names[printerid] = databaseToUnicode(fields.get("pykotaPrinterName", [""])[0] or fields.get(self.info["printerrdn"], [""])[0])
+            for member in fields.get("uniqueMember", []) :
+                parents.setdefault(member, []).append(printerid)
+        loops = [names[printerid] for printerid in names.keys() if self.walkPrinterGroups(printerid, parents)[1]]
+        loops.sort()
+        return (0, 0, loops)
+
+    def getParentPrintersUserPQuotaFromBackend(self, userpquota) :
+        """Returns the user's print quotas on all the printer's parents, with a single search."""
+        user = userpquota.User
+        parents = self.getParentPrinters(userpquota.Printer)
+        upquotas = {}
+        if parents :
+            printers = {}
+            for p in parents :
+                printers[p.Name] = p
+            if self.info["userquotabase"].lower() == "user" :
+                base = user.ident
+            else :
+                base = self.info["userquotabase"]
+            result = self.doSearch("(&(objectClass=pykotaUserPQuota)(pykotaUserName=%s)(|%s))" % \
+                                      (unicodeToDatabase(user.Name), \
+                                       "".join(["(pykotaPrinterName=%s)" % unicodeToDatabase(p.Name) for p in parents])), \
+                                      ["pykotaPageCounter", "pykotaLifePageCounter", "pykotaSoftLimit", "pykotaHardLimit", "pykotaDateLimit", "pykotaWarnCount", "pykotaMaxJobSize", "pykotaPrinterName"], \
+                                      base=base)
+            for record in (result or []) :
+                pname = databaseToUnicode(record[1].get("pykotaPrinterName", [""])[0])
+                if printers.has_key(pname) and not upquotas.has_key(pname) :
+                    upquotas[pname] = self.storageUserPQuotaFromRecord(user, printers[pname], record)
+                    self.cacheEntry("USERPQUOTAS", "%s@%s" % (user.Name, pname), upquotas[pname])
+        return [upquotas[p.Name] for p in parents if upquotas.has_key(p.Name)]
+
+    def getAdmissionContextFromBackend(self, username, printername, billingcode) :
+        """Retrieves everything needed to admit a job with as few searches as possible.
+
+           The user's print quota entries on all the printer's parents
+           are retrieved with a single search, and so are the print quota
+           entries of all the user's groups on the printer and its parents.
+        """
+        printer = self.getPrinter(printername)
+        user = self.getUser(username)
+        userpquota = self.getUserPQuota(user, printer)
+        code = None
+        if billingcode :
+            code = self.getBillingCode(billingcode)
+        if not userpquota.Exists :
+            # the job won't be checked against print quotas.
+            return (printer, user, userpquota, code)
+
+        parents = self.getParentPrinters(printer)
+        printers = {}
+        for p in [ printer ] + parents :
+            printers[p.Name] = p
+        userpquota.ParentPrintersUserPQuota = self.getParentPrintersUserPQuotaFromBackend(userpquota)
+
+        groups = [g for g in self.getUserGroups(user) if g.Exists]
+        gpquotas = {}
+        if groups :
+            if self.info["groupquotabase"].lower() == "group" :
+                base = self.info["groupbase"]
+            else :
+                base = self.info["groupquotabase"]
+            result = self.doSearch("(&(objectClass=pykotaGroupPQuota)(|%s)(|%s))" % \
+                                      ("".join(["(pykotaGroupName=%s)" % unicodeToDatabase(g.Name) for g in groups]), \
+                                       "".join(["(pykotaPrinterName=%s)" % unicodeToDatabase(name) for name in printers.keys()])), \
+                                      ["pykotaSoftLimit", "pykotaHardLimit", "pykotaDateLimit", "pykotaGroupName", "pykotaPrinterName"], \
+                                      base=base)
+            groupsbyname = {}
+            for group in groups :
+                groupsbyname[group.Name] = group
+            for record in (result or []) :
+                gname = databaseToUnicode(record[1].get("pykotaGroupName", [""])[0])
+                pname = databaseToUnicode(record[1].get("pykotaPrinterName", [""])[0])
+                if groupsbyname.has_key(gname) and printers.has_key(pname) \
+                   and not gpquotas.has_key((gname, pname)) :
+                    gpquotas[(gname, pname)] = self.storageGroupPQuotaFromRecord(groupsbyname[gname], printers[pname], record)
+            for group in groups :
+                found = [gpquotas[(group.Name, p.Name)] for p in [ printer ] + parents if gpquotas.has_key((group.Name, p.Name))]
+                if found :
+                    self.addGroupPQuotasCounters(group, found)
+        userpquota.GroupsPQuota = []
+        for group in groups :
+            grouppquota = gpquotas.get((group.Name, printer.Name)) or StorageGroupPQuota(self, group, printer)
+            grouppquota.ParentPrintersGroupPQuota = [gpquotas[(group.Name, p.Name)] for p in parents if gpquotas.has_key((group.Name, p.Name))]
+            userpquota.GroupsPQuota.append(grouppquota)
+        return (printer, user, userpquota, code)
+
     def getMatchingPrinters(self, printerpattern) :
         """Returns the list of all printers for which name matches a certain pattern."""
         printers = []
@@ -823,6 +1553,121 @@ class Storage(BaseStorage) :
                     self.cacheEntry("GROUPS", group.Name, group)
         return groups
 
+    def entriesByName(self, entries, names, attributes) :
+        """Returns a dictionnary of entries keyed by the names they were searched for.
+
+           An entry matches a name if one of the attributes has it
+           as a value, case insensitively if no entry has it exactly
+           (e.g. uid), like the server does. The first matching entry
+           is kept.
+        """
+        byname = {}
+        for casefold in (False, True) :
+            wanted = {}
+            for name in names :
+                if not byname.has_key(name) :
+                    value = unicodeToDatabase(name)
+                    if casefold :
+                        value = value.lower()
+                    wanted[value] = name
+            for entry in entries :
+                for attribute in attributes :
+                    for value in entry[1].get(attribute, []) :
+                        if casefold :
+                            value = value.lower()
+                        name = wanted.get(value)
+                        if (name is not None) and not byname.has_key(name) :
+                            byname[name] = entry
+        return byname
+
+    def getUsersByNames(self, usernames) :
+        """Returns a dictionnary of users keyed by name.
+
+           Users not in the cache are retrieved with a few searches,
+           along with their balances. Unknown users are returned as
+           non-existing users, like getUser() does.
+        """
+        users = {}
+        missing = []
+        for username in usernames :
+            if not users.has_key(username) :
+                user = self.getFromCache("USERS", username)
+                if user is None :
+                    missing.append(username)
+                    user = StorageUser(self, username)
+                users[username] = user
+        if missing :
+            names = self.escapeValues([unicodeToDatabase(name) for name in missing])
+            attributes = ["pykotaUserName", self.info["userrdn"]]
+            accounts = self.entriesByName(self.searchMany("(objectClass=pykotaAccount)", \
+                                                          attributes, \
+                                                          names, \
+                                                          self.info["userbase"], \
+                                                          attributes + ["pykotaLimitBy", self.info["usermail"], "description"]), \
+                                          missing, attributes)
+            if accounts :
+                attributes = ["pykotaUserName", self.info["balancerdn"]]
+                balances = self.entriesByName(self.searchMany("(objectClass=pykotaAccountBalance)", \
+                                                              attributes, \
+                                                              self.escapeValues([unicodeToDatabase(name) for name in accounts.keys()]), \
+                                                              self.info["balancebase"], \
+                                                              attributes + ["pykotaBalance", "pykotaLifeTimePaid", "pykotaPayments", "pykotaOverCharge"]), \
+                                              accounts.keys(), attributes)
+                for (username, entry) in accounts.items() :
+                    if not balances.has_key(username) :
+                        raise PyKotaStorageError, _("No pykotaAccountBalance object found for user %s. Did you create LDAP entries manually ?") % unicodeToDatabase(username)
+                    user = users[username]
+                    self.setUserFromEntry(user, entry)
+                    self.setUserBalanceFromEntry(user, balances[username])
+                    user.Exists = True
+                    self.cacheEntry("USERS", username, user)
+        return users
+
+    def getGroupsByNames(self, groupnames) :
+        """Returns a dictionnary of groups keyed by name.
+
+           Groups not in the cache are retrieved with a few searches,
+           then all their members at once, to compute their balances.
+           Unknown groups are returned as non-existing groups, like
+           getGroup() does.
+        """
+        groups = {}
+        missing = []
+        for groupname in groupnames :
+            if not groups.has_key(groupname) :
+                group = self.getFromCache("GROUPS", groupname)
+                if group is None :
+                    missing.append(groupname)
+                    group = StorageGroup(self, groupname)
+                groups[groupname] = group
+        if missing :
+            names = self.escapeValues([unicodeToDatabase(name) for name in missing])
+            attributes = ["pykotaGroupName", self.info["grouprdn"]]
+            entries = self.entriesByName(self.searchMany("(objectClass=pykotaGroup)", \
+                                                         attributes, \
+                                                         names, \
+                                                         self.info["groupbase"], \
+                                                         attributes + ["pykotaLimitBy", "description", self.info["groupmembers"]]), \
+                                         missing, attributes)
+            membernames = {}
+            for (groupname, entry) in entries.items() :
+                for member in entry[1].get(self.info["groupmembers"], []) :
+                    membernames[databaseToUnicode(member)] = None
+            members = self.getUsersByNames(membernames.keys())
+            for (groupname, entry) in entries.items() :
+                group = groups[groupname]
+                self.setGroupFromEntry(group, entry)
+                group.Members = [members[databaseToUnicode(member)] for member in entry[1].get(self.info["groupmembers"], [])]
+                group.AccountBalance = 0.0
+                group.LifeTimePaid = 0.0
+                for member in group.Members :
+                    if member.Exists :
+                        group.AccountBalance += member.AccountBalance
+                        group.LifeTimePaid += member.LifeTimePaid
+                group.Exists = True
+                self.cacheEntry("GROUPS", groupname, group)
+        return groups
+
     def getPrinterUsersAndQuotas(self, printer, names=["*"]) :
         """Returns the list of users who uses a given printer, along with their quotas."""
         usersandquotas = []
@@ -832,37 +1677,16 @@ class Storage(BaseStorage) :
             base = self.info["userbase"]
         else :
             base = self.info["userquotabase"]
-        result = self.doSearch("(&(objectClass=pykotaUserPQuota)(pykotaPrinterName=%s)(|%s))" % \
-                                  (pname, "".join(["(pykotaUserName=%s)" % uname for uname in names])), \
-                                  ["pykotaUserName", "pykotaPageCounter", "pykotaLifePageCounter", "pykotaSoftLimit", "pykotaHardLimit", "pykotaDateLimit", "pykotaWarnCount"], \
-                                  base=base)
+        result = self.searchMany("(objectClass=pykotaUserPQuota)(pykotaPrinterName=%s)" % pname, \
+                                 "pykotaUserName", \
+                                 names, \
+                                 base, \
+                                 ["pykotaUserName", "pykotaPageCounter", "pykotaLifePageCounter", "pykotaSoftLimit", "pykotaHardLimit", "pykotaDateLimit", "pykotaWarnCount", "pykotaMaxJobSize"])
         if result :
-            for (userquotaid, fields) in result :
-                user = self.getUser(databaseToUnicode(fields.get("pykotaUserName")[0]))
-                userpquota = StorageUserPQuota(self, user, printer)
-                userpquota.ident = userquotaid
-                userpquota.PageCounter = int(fields.get("pykotaPageCounter", [0])[0])
-                userpquota.LifePageCounter = int(fields.get("pykotaLifePageCounter", [0])[0])
-                userpquota.WarnCount = int(fields.get("pykotaWarnCount", [0])[0])
-                userpquota.SoftLimit = fields.get("pykotaSoftLimit")
-                if userpquota.SoftLimit is not None :
-                    if userpquota.SoftLimit[0].upper() == "NONE" :
-                        userpquota.SoftLimit = None
-                    else :
-                        userpquota.SoftLimit = int(userpquota.SoftLimit[0])
-                userpquota.HardLimit = fields.get("pykotaHardLimit")
-                if userpquota.HardLimit is not None :
-                    if userpquota.HardLimit[0].upper() == "NONE" :
-                        userpquota.HardLimit = None
-                    elif userpquota.HardLimit is not None :
-                        userpquota.HardLimit = int(userpquota.HardLimit[0])
-                userpquota.DateLimit = fields.get("pykotaDateLimit")
-                if userpquota.DateLimit is not None :
-                    if userpquota.DateLimit[0].upper() == "NONE" :
-                        userpquota.DateLimit = None
-                    else :
-                        userpquota.DateLimit = userpquota.DateLimit[0]
-                userpquota.Exists = True
+            users = self.getUsersByNames([databaseToUnicode(fields.get("pykotaUserName")[0]) for (userquotaid, fields) in result])
+            for record in result :
+                user = users[databaseToUnicode(record[1].get("pykotaUserName")[0])]
+                userpquota = self.storageUserPQuotaFromRecord(user, printer, record)
                 usersandquotas.append((user, userpquota))
                 self.cacheEntry("USERPQUOTAS", "%s@%s" % (user.Name, printer.Name), userpquota)
         usersandquotas.sort(lambda x, y : cmp(x[0].Name, y[0].Name))
@@ -877,15 +1701,43 @@ class Storage(BaseStorage) :
             base = self.info["groupbase"]
         else :
             base = self.info["groupquotabase"]
-        result = self.doSearch("(&(objectClass=pykotaGroupPQuota)(pykotaPrinterName=%s)(|%s))" % \
-                                  (pname, "".join(["(pykotaGroupName=%s)" % gname for gname in names])), \
-                                  ["pykotaGroupName"], \
-                                  base=base)
+        result = self.searchMany("(objectClass=pykotaGroupPQuota)(pykotaPrinterName=%s)" % pname, \
+                                 "pykotaGroupName", \
+                                 names, \
+                                 base, \
+                                 ["pykotaGroupName", "pykotaSoftLimit", "pykotaHardLimit", "pykotaDateLimit"])
         if result :
-            for (groupquotaid, fields) in result :
-                group = self.getGroup(databaseToUnicode(fields.get("pykotaGroupName")[0]))
-                grouppquota = self.getGroupPQuota(group, printer)
+            groups = self.getGroupsByNames([databaseToUnicode(fields.get("pykotaGroupName")[0]) for (groupquotaid, fields) in result])
+            bymember = {}
+            for record in result :
+                group = groups[databaseToUnicode(record[1].get("pykotaGroupName")[0])]
+                if group.Exists :
+                    grouppquota = self.storageGroupPQuotaFromRecord(group, printer, record)
+                    members = getattr(group, "Members", None)
+                    if members is None :
+                        members = self.getGroupMembers(group)
+                    for member in members :
+                        bymember.setdefault(unicodeToDatabase(member.Name), []).append(grouppquota)
+                else :
+                    grouppquota = StorageGroupPQuota(self, group, printer)
                 groupsandquotas.append((group, grouppquota))
+            # the page counters of all the groups come from a single
+            # pass over their members' print quota entries.
+            if bymember :
+                if self.info["userquotabase"].lower() == "user" :
+                    base = self.info["userbase"]
+                else :
+                    base = self.info["userquotabase"]
+                for (dn, fields) in self.searchMany("(objectClass=pykotaUserPQuota)(pykotaPrinterName=%s)" % pname, \
+                                                    "pykotaUserName", \
+                                                    self.escapeValues(bymember.keys()), \
+                                                    base, \
+                                                    ["pykotaUserName", "pykotaPageCounter", "pykotaLifePageCounter"]) :
+                    for grouppquota in bymember.get(fields.get("pykotaUserName", [""])[0], []) :
+                        grouppquota.PageCounter += int(fields.get("pykotaPageCounter", [0])[0] or 0)
+                        grouppquota.LifePageCounter += int(fields.get("pykotaLifePageCounter", [0])[0] or 0)
+            for (group, grouppquota) in groupsandquotas :
+                self.cacheEntry("GROUPPQUOTAS", "%s@%s" % (group.Name, printer.Name), grouppquota)
         groupsandquotas.sort(lambda x, y : cmp(x[0].Name, y[0].Name))
         return groupsandquotas
 
@@ -1198,10 +2050,13 @@ class Storage(BaseStorage) :
         pname = unicodeToDatabase(printer.Name)
         if (not self.disablehistory) or (not printer.LastJob.Exists) :
             uuid = self.genUUID()
-            dn = "cn=%s,%s" % (uuid, self.info["jobbase"])
+            month = self.jobMonth(DateTime.now())
+            dn = "cn=%s,%s" % (uuid, self.createJobContainers(month, printer.Name))
+            jobref = self.jobReference(uuid, month)
         else :
             uuid = printer.LastJob.ident[3:].split(",")[0]
             dn = printer.LastJob.ident
+            jobref = None # the last job entry already points to it
         if self.privacy :
             # For legal reasons, we want to hide the title, filename and options
             title = filename = options = u"hidden"
@@ -1235,10 +2090,11 @@ class Storage(BaseStorage) :
             self.doModify(dn, fields)
 
         if printer.LastJob.Exists :
-            fields = {
-                       "pykotaLastJobIdent" : uuid,
-                     }
-            self.doModify(printer.LastJob.lastjobident, fields)
+            if jobref is not None :
+                fields = {
+                           "pykotaLastJobIdent" : jobref,
+                         }
+                self.doModify(printer.LastJob.lastjobident, fields)
         else :
             lastjuuid = self.genUUID()
             lastjdn = "cn=%s,%s" % (lastjuuid, self.info["lastjobbase"])
@@ -1246,7 +2102,7 @@ class Storage(BaseStorage) :
                        "objectClass" : ["pykotaObject", "pykotaLastJob"],
                        "cn" : lastjuuid,
                        "pykotaPrinterName" : pname,
-                       "pykotaLastJobIdent" : uuid,
+                       "pykotaLastJobIdent" : jobref,
                      }
             self.doAdd(lastjdn, fields)
 
@@ -1307,8 +2163,8 @@ class Storage(BaseStorage) :
                      }
             self.doModify(pgroup.ident, fields)
 
-    def retrieveHistory(self, user=None, printer=None, hostname=None, billingcode=None, jobid=None, limit=100, start=None, end=None) :
-        """Retrieves all print jobs for user on printer (or all) between start and end date, limited to first 100 results."""
+    def historyFilter(self, user=None, printer=None, hostname=None, billingcode=None, jobid=None, start=None, end=None) :
+        """Returns the LDAP filter for the print jobs matching some criteria."""
         precond = "(objectClass=pykotaJob)"
         where = []
         if user is not None :
@@ -1321,88 +2177,278 @@ class Storage(BaseStorage) :
             where.append("(pykotaBillingCode=%s)" % unicodeToDatabase(billingcode))
         if jobid is not None :
             where.append("(pykotaJobId=%s)" % jobid) # TODO : jobid is text, so unicodeToDatabase(jobid) but do all of them as well.
+        if start is not None :
+            timestamp = self.toLDAPTimestamp(start)
+            if timestamp is not None :
+                where.append("(createTimestamp>=%s)" % timestamp)
+        if end is not None :
+            timestamp = self.toLDAPTimestamp(end)
+            if timestamp is not None :
+                where.append("(createTimestamp<=%s)" % timestamp)
         if where :
-            where = "(&%s)" % "".join([precond] + where)
+            return "(&%s)" % "".join([precond] + where)
         else :
-            where = precond
+            return precond
+
+    def storageJobFromEntry(self, ident, fields, start=None, end=None) :
+        """Returns a StorageJob instance from an LDAP entry.
+
+           The job doesn't exist if its date isn't between start and end.
+        """
+        job = StorageJob(self)
+        job.ident = ident
+        job.JobId = databaseToUnicode(fields.get("pykotaJobId")[0])
+        job.PrinterPageCounter = int(fields.get("pykotaPrinterPageCounter", [0])[0] or 0)
+        try :
+            job.JobSize = int(fields.get("pykotaJobSize", [0])[0])
+        except ValueError :
+            job.JobSize = None
+        try :
+            job.JobPrice = float(fields.get("pykotaJobPrice", [0.0])[0])
+        except ValueError :
+            job.JobPrice = None
+        job.JobAction = databaseToUnicode(fields.get("pykotaAction", [""])[0])
+        job.JobFileName = databaseToUnicode(fields.get("pykotaFileName", [""])[0])
+        job.JobTitle = databaseToUnicode(fields.get("pykotaTitle", [""])[0])
+        job.JobCopies = int(fields.get("pykotaCopies", [0])[0])
+        job.JobOptions = databaseToUnicode(fields.get("pykotaOptions", [""])[0])
+        job.JobHostName = databaseToUnicode(fields.get("pykotaHostName", [""])[0])
+        job.JobSizeBytes = fields.get("pykotaJobSizeBytes", [0L])[0]
+        job.JobBillingCode = databaseToUnicode(fields.get("pykotaBillingCode", [None])[0])
+        job.JobMD5Sum = databaseToUnicode(fields.get("pykotaMD5Sum", [None])[0])
+        job.JobPages = fields.get("pykotaPages", [""])[0]
+        try :
+            job.PrecomputedJobSize = int(fields.get("pykotaPrecomputedJobSize", [0])[0])
+        except ValueError :
+            job.PrecomputedJobSize = None
+        try :
+            job.PrecomputedJobPrice = float(fields.get("pykotaPrecomputedJobPrice", [0.0])[0])
+        except ValueError :
+            job.PrecomputedJobPrice = None
+        if job.JobTitle == job.JobFileName == job.JobOptions == u"hidden" :
+            (job.JobTitle, job.JobFileName, job.JobOptions) = (_("Hidden because of privacy concerns"),) * 3
+        date = fields.get("createTimestamp", ["19700101000000Z"])[0][:14]
+        mxtime = DateTime.strptime(date, "%Y%m%d%H%M%S").localtime() # It's in UTC !
+        job.JobDate = mxtime.strftime("%Y-%m-%d %H:%M:%S")
+        if ((start is None) and (end is None)) or \
+           ((start is None) and (job.JobDate <= end)) or \
+           ((end is None) and (job.JobDate >= start)) or \
+           ((job.JobDate >= start) and (job.JobDate <= end)) :
+            job.UserName = databaseToUnicode(fields.get("pykotaUserName")[0])
+            job.PrinterName = databaseToUnicode(fields.get("pykotaPrinterName")[0])
+            job.Exists = True
+        return job
+
+    def retrieveHistory(self, user=None, printer=None, hostname=None, billingcode=None, jobid=None, limit=100, start=None, end=None) :
+        """Retrieves all print jobs for user on printer (or all) between start and end date, limited to first 100 results."""
+        where = self.historyFilter(user, printer, hostname, billingcode, jobid, start, end)
+        if limit :
+            limit = int(limit)
+        # Only the most recent entries are kept, in a heap whose
+        # smallest item is the oldest job, or the last one retrieved
+        # among jobs with the same date, like the sort used to do.
+        entries = []
+        sequence = itertools.count()
+        found = [0] # entries found by the current search
+        # dates which couldn't be put in the LDAP filter
+        # are checked before entries are kept.
+        checkdates = ((start is not None) and (self.toLDAPTimestamp(start) is None)) \
+                     or ((end is not None) and (self.toLDAPTimestamp(end) is None))
+        def keepEntry(ident, fields) :
+            """Keeps a job's entry if it's among the most recent ones."""
+            if checkdates and not self.storageJobFromEntry(ident, fields, start, end).Exists :
+                return
+            found[0] += 1
+            date = fields.get("createTimestamp", ["19700101000000Z"])[0][:14]
+            entry = (date, -sequence.next(), ident, fields)
+            if not limit :
+                entries.append(entry)
+            elif len(entries) < limit :
+                heapq.heappush(entries, entry)
+            elif entry > entries[0] :
+                heapq.heapreplace(entries, entry)
+        def enoughEntries() :
+            """Returns True when no more recent job can come from this search, entries being sorted."""
+            return limit and (found[0] >= limit)
+        if printer is not None :
+            printernames = [printer.Name]
+        else :
+            printernames = None
+        for base in self.jobBases(printernames, start, end) :
+            found[0] = 0
+            self.doPagedSearch(where, JOBATTRIBUTES, base, keepEntry,
+                               sortby="-createTimestamp",
+                               enough=enoughEntries)
+        entries.sort()
+        entries.reverse()
         jobs = []
-        result = self.doSearch(where, fields=[ "pykotaJobSizeBytes",
-                                               "pykotaHostName",
-                                               "pykotaUserName",
-                                               "pykotaPrinterName",
-                                               "pykotaJobId",
-                                               "pykotaPrinterPageCounter",
-                                               "pykotaAction",
-                                               "pykotaJobSize",
-                                               "pykotaJobPrice",
-                                               "pykotaFileName",
-                                               "pykotaTitle",
-                                               "pykotaCopies",
-                                               "pykotaOptions",
-                                               "pykotaBillingCode",
-                                               "pykotaPages",
-                                               "pykotaMD5Sum",
-                                               "pykotaPrecomputedJobSize",
-                                               "pykotaPrecomputedJobPrice",
-                                               "createTimestamp" ],
-                                      base=self.info["jobbase"])
-        if result :
-            for (ident, fields) in result :
-                job = StorageJob(self)
-                job.ident = ident
-                job.JobId = databaseToUnicode(fields.get("pykotaJobId")[0])
-                job.PrinterPageCounter = int(fields.get("pykotaPrinterPageCounter", [0])[0] or 0)
-                try :
-                    job.JobSize = int(fields.get("pykotaJobSize", [0])[0])
-                except ValueError :
-                    job.JobSize = None
-                try :
-                    job.JobPrice = float(fields.get("pykotaJobPrice", [0.0])[0])
-                except ValueError :
-                    job.JobPrice = None
-                job.JobAction = databaseToUnicode(fields.get("pykotaAction", [""])[0])
-                job.JobFileName = databaseToUnicode(fields.get("pykotaFileName", [""])[0])
-                job.JobTitle = databaseToUnicode(fields.get("pykotaTitle", [""])[0])
-                job.JobCopies = int(fields.get("pykotaCopies", [0])[0])
-                job.JobOptions = databaseToUnicode(fields.get("pykotaOptions", [""])[0])
-                job.JobHostName = databaseToUnicode(fields.get("pykotaHostName", [""])[0])
-                job.JobSizeBytes = fields.get("pykotaJobSizeBytes", [0L])[0]
-                job.JobBillingCode = databaseToUnicode(fields.get("pykotaBillingCode", [None])[0])
-                job.JobMD5Sum = databaseToUnicode(fields.get("pykotaMD5Sum", [None])[0])
-                job.JobPages = fields.get("pykotaPages", [""])[0]
-                try :
-                    job.PrecomputedJobSize = int(fields.get("pykotaPrecomputedJobSize", [0])[0])
-                except ValueError :
-                    job.PrecomputedJobSize = None
-                try :
-                    job.PrecomputedJobPrice = float(fields.get("pykotaPrecomputedJobPrice", [0.0])[0])
-                except ValueError :
-                    job.PrecomputedJobPrice = None
-                if job.JobTitle == job.JobFileName == job.JobOptions == u"hidden" :
-                    (job.JobTitle, job.JobFileName, job.JobOptions) = (_("Hidden because of privacy concerns"),) * 3
-                date = fields.get("createTimestamp", ["19700101000000Z"])[0] # It's in UTC !
-                mxtime = DateTime.strptime(date[:14], "%Y%m%d%H%M%S").localtime()
-                job.JobDate = mxtime.strftime("%Y-%m-%d %H:%M:%S")
-                if ((start is None) and (end is None)) or \
-                   ((start is None) and (job.JobDate <= end)) or \
-                   ((end is None) and (job.JobDate >= start)) or \
-                   ((job.JobDate >= start) and (job.JobDate <= end)) :
-                    job.UserName = databaseToUnicode(fields.get("pykotaUserName")[0])
-                    job.PrinterName = databaseToUnicode(fields.get("pykotaPrinterName")[0])
-                    job.Exists = True
-                    jobs.append(job)
-            jobs.sort(lambda x, y : cmp(y.JobDate, x.JobDate))
-            if limit :
-                jobs = jobs[:int(limit)]
+        for (date, seq, ident, fields) in entries :
+            job = self.storageJobFromEntry(ident, fields, start, end)
+            if job.Exists :
+                jobs.append(job)
         return jobs
 
+    def stripPyKotaAttributes(self, fields) :
+        """Removes PyKota's attributes and object classes from an entry.
+
+           Returns the remaining attributes, or None if the entry has
+           no object class left and must be deleted.
+        """
+        for k in fields.keys() :
+            if k.startswith("pykota") :
+                del fields[k]
+            elif k.lower() == "objectclass" :
+                todelete = []
+                for i in range(len(fields[k])) :
+                    if fields[k][i].startswith("pykota") :
+                        todelete.append(i)
+                todelete.sort()
+                todelete.reverse()
+                for i in todelete :
+                    del fields[k][i]
+        if fields.get("objectClass") or fields.get("objectclass") :
+            return fields
+        return None
+
+    def orFilter(self, attribute, values) :
+        """Returns an LDAP filter matching any of the values of an attribute.
+
+           attribute can also be a list of attributes, any of which
+           can then have any of the values.
+        """
+        if type(attribute) not in (types.ListType, types.TupleType) :
+            attribute = [attribute]
+        terms = []
+        for value in values :
+            terms.extend(["(%s=%s)" % (attr, value) for attr in attribute])
+        if len(terms) == 1 :
+            return terms[0]
+        return "(|%s)" % "".join(terms)
+
+    def escapeValues(self, values) :
+        """Returns values which LDAP filters will match literally, without wildcards."""
+        return [ldap.filter.escape_filter_chars(value) for value in values]
+
+    def searchMany(self, precond, attribute, values, base, fields=None, extra="") :
+        """Returns the entries whose attribute has one of the values.
+
+           The values are sent by chunks of LDAPFILTERCHUNK values in
+           OR filters, and entries retrieved by pages.
+        """
+        entries = []
+        def keepEntry(dn, attributes) :
+            """Keeps an entry."""
+            entries.append((dn, attributes))
+        if fields is None :
+            if type(attribute) in (types.ListType, types.TupleType) :
+                fields = list(attribute)
+            else :
+                fields = [attribute]
+        for i in range(0, len(values), LDAPFILTERCHUNK) :
+            self.doPagedSearch("(&%s%s%s)" % (precond, self.orFilter(attribute, values[i:i+LDAPFILTERCHUNK]), extra), \
+                               fields, \
+                               base, \
+                               keepEntry)
+        return entries
+
+    def readEntries(self, dns, key="objectClass=*") :
+        """Reads many entries at once, returns those which match key."""
+        entries = []
+        try :
+            for i in range(0, len(dns), LDAPWINDOW) :
+                msgids = []
+                for dn in dns[i:i+LDAPWINDOW] :
+                    self.querydebug("QUERY : Filter : %s, BaseDN : %s, Scope : %s, Attributes : None" % (key, dn, ldap.SCOPE_BASE))
+                    msgids.append(self.database.search(dn, ldap.SCOPE_BASE, key))
+                for msgid in msgids :
+                    try :
+                        (rtype, rdata) = self.database.result(msgid)
+                    except ldap.NO_SUCH_OBJECT :
+                        continue
+                    entries.extend([(dn, cidict(attributes)) for (dn, attributes) in rdata])
+        except ldap.LDAPError, msg :
+            raise PyKotaStorageError, (_("Search for %s(%s) from %s(scope=%s) returned no answer.") % (key, None, dns[i], ldap.SCOPE_BASE)) + " : %s" % msg
+        return entries
+
+    def hasTreeDelete(self) :
+        """Returns True if the server supports the Tree Delete control."""
+        if not hasattr(self, "supportedcontrols") :
+            try :
+                result = self.database.search_s("", ldap.SCOPE_BASE, "(objectClass=*)", ["supportedControl"])
+                self.supportedcontrols = cidict(result[0][1]).get("supportedControl", [])
+            except (ldap.LDAPError, IndexError) :
+                self.supportedcontrols = []
+        return TREEDELETEOID in self.supportedcontrols
+
+    def deleteEntries(self, dns, percent=None) :
+        """Deletes many entries, without waiting for each answer.
+
+           Entries are deleted deepest first. When the server supports
+           the Tree Delete control, entries below them are deleted too.
+        """
+        levels = {}
+        for dn in dns :
+            levels.setdefault(dn.count(","), {})[dn] = None
+        depths = levels.keys()
+        depths.sort()
+        depths.reverse()
+        if percent is not None :
+            percent.setSize(len(dns))
+        serverctrls = None
+        if self.hasTreeDelete() :
+            serverctrls = [LDAPControl(TREEDELETEOID, True)]
+        errors = []
+        for depth in depths :
+            # an entry can't be deleted before the entries below it
+            pending = []
+            try :
+                try :
+                    for dn in levels[depth].keys() :
+                        if len(pending) >= LDAPWINDOW :
+                            self.waitForDelete(pending.pop(0), errors, percent)
+                        self.querydebug("QUERY : Delete(%s)" % dn)
+                        pending.append((dn, self.database.delete_ext(dn, serverctrls)))
+                except ldap.LDAPError, msg :
+                    errors.append("Problem sending LDAP deletions : %s" % msg)
+                    self.tool.printInfo("LDAP error : %s" % errors[-1], "error")
+            finally :
+                for waiting in pending :
+                    self.waitForDelete(waiting, errors, percent)
+            if errors :
+                raise PyKotaStorageError, errors[0]
+
+    def waitForDelete(self, waiting, errors, percent) :
+        """Waits for an asynchronous deletion's result, appends its error message if any to errors."""
+        (dn, msgid) = waiting
+        try :
+            self.database.result(msgid)
+        except ldap.NO_SUCH_OBJECT :
+            self.tool.logdebug("Entry %s was already missing before we deleted it." % dn)
+        except ldap.LDAPError, msg :
+            errors.append((_("Problem deleting LDAP entry (%s)") % dn) + " : %s" % msg)
+            self.tool.printInfo("LDAP error : %s" % errors[-1], "error")
+            return
+        if self.useldapcache :
+            self.ldapcache.remove(dn)
+        if percent is not None :
+            percent.oneMore()
+
+    def modifyEntries(self, modifications) :
+        """Does many modifications, without waiting for each answer."""
+        if modifications :
+            self.beginBatch()
+            try :
+                for (dn, fields, ignoreold) in modifications :
+                    self.doModify(dn, fields, ignoreold)
+            except :
+                self.endBatch()
+                raise
+            self.flushBatch()
+
     def deleteUser(self, user) :
         """Completely deletes an user from the Quota Storage."""
         uname = unicodeToDatabase(user.Name)
         todelete = []
-        result = self.doSearch("(&(objectClass=pykotaJob)(pykotaUserName=%s))" % uname, base=self.info["jobbase"])
-        for (ident, fields) in result :
-            todelete.append(ident)
         if self.info["userquotabase"].lower() == "user" :
             base = self.info["userbase"]
         else :
@@ -1410,6 +2456,7 @@ class Storage(BaseStorage) :
         result = self.doSearch("(&(objectClass=pykotaUserPQuota)(pykotaUserName=%s))" % uname, \
                                   ["pykotaPrinterName", "pykotaUserName"], \
                                   base=base)
+        printernames = []
         for (ident, fields) in result :
             # ensure the user print quota entry will be deleted
             todelete.append(ident)
@@ -1417,28 +2464,23 @@ class Storage(BaseStorage) :
             # if last job of current printer was printed by the user
             # to delete, we also need to delete the printer's last job entry.
             printer = self.getPrinter(databaseToUnicode(fields["pykotaPrinterName"][0]))
+            printernames.append(printer.Name)
             if printer.LastJob.UserName == user.Name :
                 todelete.append(printer.LastJob.lastjobident)
 
+        # the user's jobs can only be on printers with a quota entry
+        for base in self.jobBases(printernames) :
+            result = self.doSearch("(&(objectClass=pykotaJob)(pykotaUserName=%s))" % uname, ["pykotaUserName"], base=base)
+            for (ident, fields) in result :
+                todelete.append(ident)
+
         for ident in todelete :
             self.doDelete(ident)
 
         result = self.doSearch("objectClass=pykotaAccount", None, base=user.ident, scope=ldap.SCOPE_BASE)
         if result :
-            fields = result[0][1]
-            for k in fields.keys() :
-                if k.startswith("pykota") :
-                    del fields[k]
-                elif k.lower() == "objectclass" :
-                    todelete = []
-                    for i in range(len(fields[k])) :
-                        if fields[k][i].startswith("pykota") :
-                            todelete.append(i)
-                    todelete.sort()
-                    todelete.reverse()
-                    for i in todelete :
-                        del fields[k][i]
-            if fields.get("objectClass") or fields.get("objectclass") :
+            fields = self.stripPyKotaAttributes(result[0][1])
+            if fields is not None :
                 self.doModify(user.ident, fields, ignoreold=0)
             else :
                 self.doDelete(user.ident)
@@ -1464,71 +2506,158 @@ class Storage(BaseStorage) :
             self.doDelete(ident)
         result = self.doSearch("objectClass=pykotaGroup", None, base=group.ident, scope=ldap.SCOPE_BASE)
         if result :
-            fields = result[0][1]
-            for k in fields.keys() :
-                if k.startswith("pykota") :
-                    del fields[k]
-                elif k.lower() == "objectclass" :
-                    todelete = []
-                    for i in range(len(fields[k])) :
-                        if fields[k][i].startswith("pykota") :
-                            todelete.append(i)
-                    todelete.sort()
-                    todelete.reverse()
-                    for i in todelete :
-                        del fields[k][i]
-            if fields.get("objectClass") or fields.get("objectclass") :
+            fields = self.stripPyKotaAttributes(result[0][1])
+            if fields is not None :
                 self.doModify(group.ident, fields, ignoreold=0)
             else :
                 self.doDelete(group.ident)
 
-    def deleteManyBillingCodes(self, billingcodes) :
+    def deleteManyBillingCodes(self, billingcodes, percent=None) :
         """Deletes many billing codes."""
-        for bcode in billingcodes :
-            bcode.delete()
+        self.deleteEntries([bcode.ident for bcode in billingcodes], percent)
 
-    def deleteManyUsers(self, users) :
+    def deleteManyUsers(self, users, percent=None) :
         """Deletes many users."""
-        for user in users :
-            user.delete()
-
-    def deleteManyGroups(self, groups) :
+        if not users :
+            return
+        names = self.escapeValues([unicodeToDatabase(user.Name) for user in users])
+        usernames = {}.fromkeys([user.Name for user in users])
+        todelete = []
+        if self.info["userquotabase"].lower() == "user" :
+            base = self.info["userbase"]
+        else :
+            base = self.info["userquotabase"]
+        printernames = {}
+        for (ident, fields) in self.searchMany("(objectClass=pykotaUserPQuota)", "pykotaUserName", names, base, ["pykotaPrinterName"]) :
+            todelete.append(ident)
+            printernames[databaseToUnicode(fields["pykotaPrinterName"][0])] = None
+        for printername in printernames.keys() :
+            # if last job of this printer was printed by one of
+            # the users to delete, we also delete the last job entry.
+            printer = self.getPrinter(printername)
+            if usernames.has_key(printer.LastJob.UserName) :
+                todelete.append(printer.LastJob.lastjobident)
+        for base in self.jobBases(printernames.keys()) :
+            todelete.extend([ident for (ident, fields) in self.searchMany("(objectClass=pykotaJob)", "pykotaUserName", names, base)])
+        modifications = []
+        accounts = {}
+        for (ident, fields) in self.readEntries([user.ident for user in users], "objectClass=pykotaAccount") :
+            accounts[ident.lower()] = None
+            fields = self.stripPyKotaAttributes(fields)
+            if fields is not None :
+                modifications.append((ident, fields, 0))
+            else :
+                todelete.append(ident)
+        for (ident, fields) in self.searchMany("(objectClass=pykotaAccountBalance)", "pykotaUserName", names, self.info["balancebase"]) :
+            if not accounts.has_key(ident.lower()) : # balances may be stored in accounts
+                todelete.append(ident)
+        self.modifyEntries(modifications)
+        self.deleteEntries(todelete, percent)
+        self.flushDeletedUsers(users)
+
+    def deleteManyGroups(self, groups, percent=None) :
         """Deletes many groups."""
-        for group in groups :
-            group.delete()
+        if not groups :
+            return
+        names = self.escapeValues([unicodeToDatabase(group.Name) for group in groups])
+        if self.info["groupquotabase"].lower() == "group" :
+            base = self.info["groupbase"]
+        else :
+            base = self.info["groupquotabase"]
+        todelete = [ident for (ident, fields) in self.searchMany("(objectClass=pykotaGroupPQuota)", "pykotaGroupName", names, base)]
+        modifications = []
+        for (ident, fields) in self.readEntries([group.ident for group in groups], "objectClass=pykotaGroup") :
+            fields = self.stripPyKotaAttributes(fields)
+            if fields is not None :
+                modifications.append((ident, fields, 0))
+            else :
+                todelete.append(ident)
+        self.modifyEntries(modifications)
+        self.deleteEntries(todelete, percent)
+        self.flushDeletedGroups(groups)
 
-    def deleteManyPrinters(self, printers) :
+    def deleteManyPrinters(self, printers, percent=None) :
         """Deletes many printers."""
+        if not printers :
+            return
+        names = self.escapeValues([unicodeToDatabase(printer.Name) for printer in printers])
+        todelete = [ident for (ident, fields) in self.searchMany("(objectClass=pykotaLastJob)", "pykotaPrinterName", names, self.info["lastjobbase"])]
+        for base in self.jobBases([printer.Name for printer in printers]) :
+            if "printer" in self.info["jobcontainers"] :
+                # the printers' containers are deleted with the jobs in them
+                todelete.extend([ident for (ident, fields) in self.searchMany("(objectClass=*)", "objectClass", ["pykotaJob", "organizationalUnit"], base)])
+            else :
+                todelete.extend([ident for (ident, fields) in self.searchMany("(objectClass=pykotaJob)", "pykotaPrinterName", names, base)])
+        if self.info["groupquotabase"].lower() == "group" :
+            base = self.info["groupbase"]
+        else :
+            base = self.info["groupquotabase"]
+        todelete.extend([ident for (ident, fields) in self.searchMany("(objectClass=pykotaGroupPQuota)", "pykotaPrinterName", names, base)])
+        if self.info["userquotabase"].lower() == "user" :
+            base = self.info["userbase"]
+        else :
+            base = self.info["userquotabase"]
+        todelete.extend([ident for (ident, fields) in self.searchMany("(objectClass=pykotaUserPQuota)", "pykotaPrinterName", names, base)])
+        # removes the printers from the printers groups they belong to
+        deleted = {}
         for printer in printers :
-            printer.delete()
-
-    def deleteManyUserPQuotas(self, printers, users) :
+            deleted[printer.ident.lower()] = None
+        modifications = []
+        for (ident, fields) in self.searchMany("(objectClass=pykotaPrinter)", "uniqueMember", self.escapeValues([printer.ident for printer in printers]), self.info["printerbase"]) :
+            if not deleted.has_key(ident.lower()) :
+                members = [m for m in fields.get("uniqueMember", []) if not deleted.has_key(m.lower())]
+                modifications.append((ident, { "uniqueMember" : members }, 1))
+        self.modifyEntries(modifications)
+        todelete.extend([printer.ident for printer in printers])
+        self.deleteEntries(todelete, percent)
+        self.flushDeletedPrinters(printers)
+
+    def deleteManyUserPQuotas(self, printers, users, percent=None) :
         """Deletes many user print quota entries."""
-        # TODO : grab all with a single (possibly VERY huge) filter if possible (might depend on the LDAP server !)
+        if not (printers and users) :
+            return
+        names = self.escapeValues([unicodeToDatabase(user.Name) for user in users])
+        usernames = {}.fromkeys([user.Name for user in users])
+        if self.info["userquotabase"].lower() == "user" :
+            base = self.info["userbase"]
+        else :
+            base = self.info["userquotabase"]
+        todelete = []
+        for i in range(0, len(printers), LDAPFILTERCHUNK) :
+            printersfilter = self.orFilter("pykotaPrinterName", self.escapeValues([unicodeToDatabase(p.Name) for p in printers[i:i+LDAPFILTERCHUNK]]))
+            for jobbase in self.jobBases([p.Name for p in printers[i:i+LDAPFILTERCHUNK]]) :
+                todelete.extend([ident for (ident, fields) in self.searchMany("(objectClass=pykotaJob)", "pykotaUserName", names, jobbase, extra=printersfilter)])
+            todelete.extend([ident for (ident, fields) in self.searchMany("(objectClass=pykotaUserPQuota)", "pykotaUserName", names, base, extra=printersfilter)])
         for printer in printers :
-            for user in users :
-                upq = self.getUserPQuota(user, printer)
-                if upq.Exists :
-                    upq.delete()
+            if usernames.has_key(printer.LastJob.UserName) :
+                todelete.append(printer.LastJob.lastjobident)
+        self.deleteEntries(todelete, percent)
 
-    def deleteManyGroupPQuotas(self, printers, groups) :
+    def deleteManyGroupPQuotas(self, printers, groups, percent=None) :
         """Deletes many group print quota entries."""
-        # TODO : grab all with a single (possibly VERY huge) filter if possible (might depend on the LDAP server !)
-        for printer in printers :
-            for group in groups :
-                gpq = self.getGroupPQuota(group, printer)
-                if gpq.Exists :
-                    gpq.delete()
+        if not (printers and groups) :
+            return
+        names = self.escapeValues([unicodeToDatabase(group.Name) for group in groups])
+        if self.info["groupquotabase"].lower() == "group" :
+            base = self.info["groupbase"]
+        else :
+            base = self.info["groupquotabase"]
+        todelete = []
+        for i in range(0, len(printers), LDAPFILTERCHUNK) :
+            printersfilter = self.orFilter("pykotaPrinterName", self.escapeValues([unicodeToDatabase(p.Name) for p in printers[i:i+LDAPFILTERCHUNK]]))
+            todelete.extend([ident for (ident, fields) in self.searchMany("(objectClass=pykotaGroupPQuota)", "pykotaGroupName", names, base, extra=printersfilter)])
+        self.deleteEntries(todelete, percent)
 
     def deleteUserPQuota(self, upquota) :
         """Completely deletes an user print quota entry from the database."""
         uname = unicodeToDatabase(upquota.User.Name)
         pname = unicodeToDatabase(upquota.Printer.Name)
-        result = self.doSearch("(&(objectClass=pykotaJob)(pykotaUserName=%s)(pykotaPrinterName=%s))" \
-                                   % (uname, pname), \
-                                   base=self.info["jobbase"])
-        for (ident, fields) in result :
-            self.doDelete(ident)
+        for base in self.jobBases([upquota.Printer.Name]) :
+            result = self.doSearch("(&(objectClass=pykotaJob)(pykotaUserName=%s)(pykotaPrinterName=%s))" \
+                                       % (uname, pname), \
+                                       base=base)
+            for (ident, fields) in result :
+                self.doDelete(ident)
         if upquota.Printer.LastJob.UserName == upquota.User.Name :
             self.doDelete(upquota.Printer.LastJob.lastjobident)
         self.doDelete(upquota.ident)
@@ -1543,9 +2672,15 @@ class Storage(BaseStorage) :
         result = self.doSearch("(&(objectClass=pykotaLastJob)(pykotaPrinterName=%s))" % pname, base=self.info["lastjobbase"])
         for (ident, fields) in result :
             self.doDelete(ident)
-        result = self.doSearch("(&(objectClass=pykotaJob)(pykotaPrinterName=%s))" % pname, base=self.info["jobbase"])
-        for (ident, fields) in result :
-            self.doDelete(ident)
+        for jobbase in self.jobBases([printer.Name]) :
+            if "printer" in self.info["jobcontainers"] :
+                # the printer's containers are deleted with the jobs in them
+                result = self.doSearch("(|(objectClass=pykotaJob)(objectClass=organizationalUnit))", ["objectClass"], base=jobbase)
+                self.deleteEntries([ident for (ident, fields) in result])
+            else :
+                result = self.doSearch("(&(objectClass=pykotaJob)(pykotaPrinterName=%s))" % pname, base=jobbase)
+                for (ident, fields) in result :
+                    self.doDelete(ident)
         if self.info["groupquotabase"].lower() == "group" :
             base = self.info["groupbase"]
         else :
@@ -1605,7 +2740,7 @@ class Storage(BaseStorage) :
             nbkeys = len(orderby)
             while i < nbkeys :
                 (sign, index) = orderby[i]
-                result = cmp(x[i], y[i])
+                result = cmp(x[index], y[index])
                 if not result :
                     i += 1
                 else :
@@ -1736,8 +2871,20 @@ class Storage(BaseStorage) :
                         result.append((parent.Name, entry.Name, parent.ident, entry.ident))
             return [fields] + self.sortRecords(fields, result, ["+pgroupdn", "+printerdn"], ordering)
 
+    def historyRecords(self, where, printernames, start, end) :
+        """Yields the jobhistory records for extractHistory(), while retrieving them."""
+        for base in self.jobBases(printernames, start, end) :
+            for (ident, fields) in self.pagedSearch(where, JOBATTRIBUTES, base) :
+                entry = self.storageJobFromEntry(ident, fields, start, end)
+                if entry.Exists :
+                    yield (entry.UserName, entry.PrinterName, entry.ident, entry.JobId, entry.PrinterPageCounter, entry.JobSize, entry.JobAction, entry.JobDate, entry.JobFileName, entry.JobTitle, entry.JobCopies, entry.JobOptions, entry.JobPrice, entry.JobHostName, entry.JobSizeBytes, entry.JobMD5Sum, entry.JobPages, entry.JobBillingCode, entry.PrecomputedJobSize, entry.PrecomputedJobPrice)
+
     def extractHistory(self, extractonly={}, ordering=[]) :
-        """Extracts all jobhistory records."""
+        """Extracts all jobhistory records.
+
+           Unless some ordering is asked for, records are returned in
+           the directory's order, while the entries are retrieved.
+        """
         uname = extractonly.get("username")
         if uname :
             user = self.getUser(uname)
@@ -1746,18 +2893,24 @@ class Storage(BaseStorage) :
         pname = extractonly.get("printername")
         if pname :
             printer = self.getPrinter(pname)
+            printernames = [printer.Name]
         else :
             printer = None
+            printernames = None
         startdate = extractonly.get("start")
         enddate = extractonly.get("end")
         (startdate, enddate) = self.cleanDates(startdate, enddate)
-        entries = self.retrieveHistory(user, printer, hostname=extractonly.get("hostname"), billingcode=extractonly.get("billingcode"), jobid=extractonly.get("jobid"), limit=None, start=startdate, end=enddate)
-        if entries :
-            fields = ("username", "printername", "dn", "jobid", "pagecounter", "jobsize", "action", "jobdate", "filename", "title", "copies", "options", "jobprice", "hostname", "jobsizebytes", "md5sum", "pages", "billingcode", "precomputedjobsize", "precomputedjobprice")
-            result = []
-            for entry in entries :
-                result.append((entry.UserName, entry.PrinterName, entry.ident, entry.JobId, entry.PrinterPageCounter, entry.JobSize, entry.JobAction, entry.JobDate, entry.JobFileName, entry.JobTitle, entry.JobCopies, entry.JobOptions, entry.JobPrice, entry.JobHostName, entry.JobSizeBytes, entry.JobMD5Sum, entry.JobPages, entry.JobBillingCode, entry.PrecomputedJobSize, entry.PrecomputedJobPrice))
-            return [fields] + self.sortRecords(fields, result, ["+dn"], ordering)
+        where = self.historyFilter(user, printer, hostname=extractonly.get("hostname"), billingcode=extractonly.get("billingcode"), jobid=extractonly.get("jobid"), start=startdate, end=enddate)
+        records = self.historyRecords(where, printernames, startdate, enddate)
+        try :
+            first = records.next()
+        except StopIteration :
+            return None
+        records = itertools.chain([first], records)
+        fields = ("username", "printername", "dn", "jobid", "pagecounter", "jobsize", "action", "jobdate", "filename", "title", "copies", "options", "jobprice", "hostname", "jobsizebytes", "md5sum", "pages", "billingcode", "precomputedjobsize", "precomputedjobprice")
+        if ordering :
+            return [fields] + self.sortRecords(fields, list(records), ["+dn"], ordering)
+        return itertools.chain([fields], records)
 
     def getBillingCodeFromBackend(self, label) :
         """Extracts billing code information given its label : returns first matching billing code."""
@@ -1875,18 +3028,6 @@ class Storage(BaseStorage) :
         self.setJobAttributesFromRecord(lastjob, record)
         return lastjob
 
-    def storageUserPQuotaFromRecord(self, user, printer, record) :
-        """Returns a StorageUserPQuota instance from a database record."""
-        userpquota = StorageUserPQuota(self, user, printer)
-        userpquota.Exists = True
-        return userpquota
-
-    def storageGroupPQuotaFromRecord(self, group, printer, record) :
-        """Returns a StorageGroupPQuota instance from a database record."""
-        grouppquota = StorageGroupPQuota(self, group, printer)
-        grouppquota.Exists = True
-        return grouppquota
-
     def storageBillingCodeFromRecord(self, billingcode, record) :
         """Returns a StorageBillingCode instance from a database record."""
         code = StorageBillingCode(self, billingcode)
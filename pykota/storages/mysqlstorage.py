@@ -22,12 +22,15 @@
 
 """This module defines a class to access to a MySQL database backend."""
 
+import time
+
 from pykota.errors import PyKotaStorageError
 from pykota.storage import BaseStorage
-from pykota.storages.sql import SQLStorage
+from pykota.storages.sql import SQLStorage, FETCHSIZE
 
 try :
     import MySQLdb
+    import MySQLdb.cursors
 except ImportError :
     import sys
     # TODO : to translate or not to translate ?
@@ -37,45 +40,65 @@ class Storage(BaseStorage, SQLStorage) :
     def __init__(self, pykotatool, host, dbname, user, passwd) :
         """Opens the MySQL database connection."""
         BaseStorage.__init__(self, pykotatool)
-        try :
-            (host, port) = host.split(":")
-            port = int(port)
-        except ValueError :
-            port = 3306           # Use the default MySQL port
+        pooler = self.tool.config.getStoragePooler()
+        if pooler is not None :
+            host = pooler
+        self.pooled = (pooler is not None)
+        self.connectargs = { "db" : dbname,
+                             "user" : user,
+                             "passwd" : passwd,
+                           }
+        if host.startswith("/") :
+            port = None
+            self.connectargs["unix_socket"] = host
+        else :
+            try :
+                (host, port) = host.split(":")
+                port = int(port)
+            except ValueError :
+                port = 3306           # Use the default MySQL port
+            self.connectargs["host"] = host
+            self.connectargs["port"] = port
+        self.savedhost = host
+        self.savedport = port
+        self.intransaction = False
+        self.openDatabase()
 
+    def openDatabase(self) :
+        """Opens the connection, or opens it again after it was lost."""
+        (host, port, dbname, user) = (self.savedhost,
+                                      self.savedport,
+                                      self.connectargs["db"],
+                                      self.connectargs["user"])
         self.tool.logdebug("Trying to open database (host=%s, port=%s, dbname=%s, user=%s)..." \
                                % (repr(host),
                                   repr(port),
                                   repr(dbname),
                                   repr(user)))
         try :
-            self.database = MySQLdb.connect(host=host,
-                                            port=port,
-                                            db=dbname,
-                                            user=user,
-                                            passwd=passwd,
-                                            charset="utf8")
+            self.database = MySQLdb.connect(charset="utf8", **self.connectargs)
+            setnames = False
         except TypeError :
             self.tool.logdebug("'charset' argument not allowed with this version of python-mysqldb, retrying without...")
-            self.database = MySQLdb.connect(host=host,
-                                            port=port,
-                                            db=dbname,
-                                            user=user,
-                                            passwd=passwd)
+            self.database = MySQLdb.connect(**self.connectargs)
+            setnames = True
 
         try :
             self.database.autocommit(1)
         except AttributeError :
             raise PyKotaStorageError, _("Your version of python-mysqldb is too old. Please install a newer release.")
         self.cursor = self.database.cursor()
-        self.cursor.execute("SET NAMES 'utf8';")
+        if setnames :
+            # otherwise the connection's character set was already set
+            self.cursor.execute("SET NAMES 'utf8';")
         self.cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED;") # Same as PostgreSQL and Oracle's default
         self.closed = False
-        self.tool.logdebug("Database opened (host=%s, port=%s, dbname=%s, user=%s)" \
+        self.tool.logdebug("Database opened (host=%s, port=%s, dbname=%s, user=%s, pooled=%s)" \
                                % (repr(host),
                                   repr(port),
                                   repr(dbname),
-                                  repr(user)))
+                                  repr(user),
+                                  self.pooled))
         try :
             # Here we try to select a string (an &eacute;) which is
             # already encoded in UTF-8. If python-mysqldb suffers from
@@ -90,6 +113,43 @@ class Storage(BaseStorage, SQLStorage) :
             self.needsworkaround = False
             self.tool.logdebug("Database doesn't need encoding workaround.")
 
+    def isAlive(self) :
+        """Returns True if the connection to the server is still usable."""
+        try :
+            self.database.ping()
+        except MySQLdb.Error :
+            return False
+        return True
+
+    def hasTable(self, tablename) :
+        """Returns True if a table exists in the current database."""
+        return bool(self.doSearch("SELECT table_name FROM information_schema.tables WHERE table_schema=DATABASE() AND table_name=%s" % self.doQuote(tablename)))
+
+    def doWithReconnect(self, function) :
+        """Calls function, opening the connection again if it was lost.
+
+           Nothing is retried within a transaction, because what was
+           already done in it was lost along with the connection.
+        """
+        for tryit in range(3) :
+            try :
+                return function()
+            except MySQLdb.OperationalError, msg :
+                if self.intransaction or (tryit == 2) or self.isAlive() :
+                    raise
+                self.tool.printInfo("MySQL connection lost : %s" % repr(msg), "error")
+                self.tool.printInfo("MySQL connection will be closed and reopened.", "warn")
+                if tryit :
+                    time.sleep(2)
+                try :
+                    self.database.close()
+                except MySQLdb.Error :
+                    pass
+                try :
+                    self.openDatabase()
+                except MySQLdb.Error, msg :
+                    self.tool.printInfo("%s" % repr(msg), "error")
+
     def close(self) :
         """Closes the database connection."""
         if not self.closed :
@@ -100,20 +160,57 @@ class Storage(BaseStorage, SQLStorage) :
 
     def beginTransaction(self) :
         """Starts a transaction."""
-        self.cursor.execute("BEGIN;")
+        self.doWithReconnect(lambda : self.cursor.execute("BEGIN;"))
+        self.intransaction = True
         self.tool.logdebug("Transaction begins...")
 
     def commitTransaction(self) :
-        """Commits a transaction."""
-        self.database.commit()
+        """Commits a transaction, sending the deferred modify queries along."""
+        try :
+            queries = ["%s;" % self.quotePreparedStatement(name, params) for (name, params) in self.endBatch()]
+            if queries :
+                # MySQLdb allows several statements in a single query,
+                # their results have to be read, errors included.
+                queries.append("COMMIT;")
+                query = " ".join(queries)
+                self.querydebug("QUERY : %s" % query)
+                if self.needsworkaround :
+                    query = query.decode("UTF-8")
+                try :
+                    self.cursor.execute(query)
+                    while self.cursor.nextset() :
+                        pass
+                except MySQLdb.Error, msg :
+                    self.tool.logdebug("Query failed : %s" % repr(msg))
+                    try :
+                        self.database.rollback()
+                    except MySQLdb.Error :
+                        pass # the connection was lost
+                    raise PyKotaStorageError, repr(msg)
+            else :
+                self.database.commit()
+        finally :
+            self.intransaction = False
         self.tool.logdebug("Transaction committed.")
 
     def rollbackTransaction(self) :
         """Rollbacks a transaction."""
-        self.database.rollback()
+        self.endBatch()
+        try :
+            self.database.rollback()
+        finally :
+            self.intransaction = False
         self.tool.logdebug("Transaction aborted.")
 
-    def doRawSearch(self, query) :
+    def executeQuery(self, query, params) :
+        """Executes a query, binding its parameters if any."""
+        if params is None :
+            self.cursor.execute(query)
+        else :
+            self.querydebug("PARAMETERS : %s" % repr(params))
+            self.cursor.execute(query, params)
+
+    def doRawSearch(self, query, params=None) :
         """Does a raw search query."""
         query = query.strip()
         if not query.endswith(';') :
@@ -122,16 +219,16 @@ class Storage(BaseStorage, SQLStorage) :
         if self.needsworkaround :
             query = query.decode("UTF-8")
         try :
-            self.cursor.execute(query)
-        except self.database.Error, msg :
+            self.doWithReconnect(lambda : self.executeQuery(query, params))
+        except MySQLdb.Error, msg :
             raise PyKotaStorageError, repr(msg)
         else :
             # This returns a list of lists. Integers are returned as longs.
             return self.cursor.fetchall()
 
-    def doSearch(self, query) :
+    def doSearch(self, query, params=None) :
         """Does a search query."""
-        result = self.doRawSearch(query)
+        result = self.doRawSearch(query, params)
         if result :
             rows = []
             fields = {}
@@ -145,7 +242,7 @@ class Storage(BaseStorage, SQLStorage) :
             # returns a list of dicts
             return rows
 
-    def doModify(self, query) :
+    def doModify(self, query, params=None) :
         """Does a (possibly multiple) modify query."""
         query = query.strip()
         if not query.endswith(';') :
@@ -154,11 +251,35 @@ class Storage(BaseStorage, SQLStorage) :
         if self.needsworkaround :
             query = query.decode("UTF-8")
         try :
-            self.cursor.execute(query)
-        except self.database.Error, msg :
+            self.doWithReconnect(lambda : self.executeQuery(query, params))
+        except MySQLdb.Error, msg :
             self.tool.logdebug("Query failed : %s" % repr(msg))
             raise PyKotaStorageError, repr(msg)
 
+    def bindParameters(self, params) :
+        """Converts parameters to the types MySQLdb expects.
+
+           MySQLdb binds parameters on the client side, using the
+           connection's own escaping, and has the same parameter
+           style as our statements.
+        """
+        if not self.needsworkaround :
+            return tuple(params)
+        bound = []
+        for param in params :
+            if type(param) == type("") :
+                param = param.decode("UTF-8")
+            bound.append(param)
+        return tuple(bound)
+
+    def doPreparedSearch(self, name, params) :
+        """Does a search query from a named statement, binding its parameters."""
+        return self.doSearch(self.preparedstatements[name], self.bindParameters(params))
+
+    def executePreparedModify(self, name, params) :
+        """Executes a modify query from a named statement, binding its parameters."""
+        return self.doModify(self.preparedstatements[name], self.bindParameters(params))
+
     def doQuote(self, field) :
         """Quotes a field for use as a string in SQL queries."""
         if type(field) == type(0.0) :
@@ -172,8 +293,33 @@ class Storage(BaseStorage, SQLStorage) :
         else :
             return "NULL"
 
-    def prepareRawResult(self, result) :
-        """Prepares a raw result by including the headers."""
-        if result :
-            return [tuple([f[0] for f in self.cursor.description])] \
-                 + list(result)
+    def doStreamedSearch(self, query) :
+        """Does a search query, yields its headers then its records.
+
+           The records are read from the server a few at a time, with an
+           unbuffered cursor : no other query can be sent on the connection
+           until all of them were read.
+        """
+        query = query.strip()
+        if not query.endswith(';') :
+            query += ';'
+        self.querydebug("QUERY : %s" % query)
+        if self.needsworkaround :
+            query = query.decode("UTF-8")
+        cursor = self.database.cursor(MySQLdb.cursors.SSCursor)
+        try :
+            cursor.execute(query)
+        except MySQLdb.Error, msg :
+            cursor.close()
+            raise PyKotaStorageError, repr(msg)
+        yield tuple([f[0] for f in cursor.description])
+        while 1 :
+            try :
+                records = cursor.fetchmany(FETCHSIZE)
+            except MySQLdb.Error, msg :
+                raise PyKotaStorageError, repr(msg)
+            if not records :
+                break
+            for record in records :
+                yield record
+        cursor.close()
@@ -22,11 +22,13 @@
 
 """This module defines a class to access to a PostgreSQL database backend."""
 
+import os
+import time
 from types import StringType
 
 from pykota.errors import PyKotaStorageError
 from pykota.storage import BaseStorage
-from pykota.storages.sql import SQLStorage
+from pykota.storages.sql import SQLStorage, FETCHSIZE
 
 from pykota.utils import *
 
@@ -42,42 +44,192 @@ else :
     except AttributeError :
         PGError = pg.error
 
+class ServerCursor :
+    """Iterates over the headers then the records of a search query, with a server side cursor.
+
+       The records are fetched a few at a time. A cursor only lives
+       within a transaction, which is started if needed. The cursor and
+       this transaction end once all the records were read, when an error
+       occurs, or when close() is called, whichever comes first.
+    """
+    def __init__(self, storage, query) :
+        """Declares the cursor."""
+        self.storage = storage
+        storage.nbcursors += 1
+        self.name = "pykota_extract%i" % storage.nbcursors
+        self.mustcommit = not storage.intransaction
+        self.closed = False
+        self.headers = None
+        self.records = []
+        if self.mustcommit :
+            storage.beginTransaction()
+        try :
+            storage.doModify("DECLARE %s NO SCROLL CURSOR FOR %s" % (self.name, query))
+        except :
+            self.abort()
+            raise
+
+    def __del__(self) :
+        """Ensures the cursor is closed if the records weren't all read."""
+        try :
+            self.close()
+        except (PyKotaStorageError, PGError) :
+            pass
+
+    def __iter__(self) :
+        """Returns the iterator itself."""
+        return self
+
+    def fetch(self) :
+        """Fetches the next records."""
+        try :
+            result = self.storage.doRawSearch("FETCH FORWARD %i FROM %s" % (FETCHSIZE, self.name))
+        except :
+            self.abort()
+            raise
+        if self.headers is None :
+            self.headers = tuple(result.listfields())
+        self.records = result.getresult()
+        self.records.reverse()
+
+    def next(self) :
+        """Returns the headers, then the next record."""
+        if self.closed :
+            raise StopIteration
+        if self.headers is None :
+            self.fetch()
+            return self.headers
+        if not self.records :
+            self.fetch()
+            if not self.records :
+                self.close()
+                raise StopIteration
+        fields = list(self.records.pop())
+        for i in range(len(fields)) :
+            if type(fields[i]) == StringType :
+                fields[i] = databaseToUnicode(fields[i])
+        return tuple(fields)
+
+    def close(self) :
+        """Closes the cursor, and commits the transaction started for it."""
+        if not self.closed :
+            self.closed = True
+            try :
+                self.storage.doModify("CLOSE %s" % self.name)
+            except :
+                if self.mustcommit :
+                    self.storage.rollbackTransaction()
+                raise
+            if self.mustcommit :
+                self.storage.commitTransaction()
+
+    def abort(self) :
+        """Rollbacks the transaction started for the cursor, after an error."""
+        if not self.closed :
+            self.closed = True
+            if self.mustcommit :
+                self.storage.rollbackTransaction()
+
 class Storage(BaseStorage, SQLStorage) :
     def __init__(self, pykotatool, host, dbname, user, passwd) :
         """Opens the PostgreSQL database connection."""
         BaseStorage.__init__(self, pykotatool)
+        pooler = self.tool.config.getStoragePooler()
+        if pooler is not None :
+            # The pooler may give our server session to other clients
+            # between transactions, so no session state is kept.
+            host = pooler
+        self.pooled = (pooler is not None)
         try :
             (host, port) = host.split(":")
             port = int(port)
         except ValueError :
             port = 5432         # Use PostgreSQL's default tcp/ip port (5432).
+        self.savedhost = host
+        self.savedport = port
+        self.saveddbname = dbname
+        self.saveduser = user
+        self.savedpasswd = passwd
+        self.intransaction = False
+        self.nbcursors = 0
+        self.openDatabase()
 
+    def openDatabase(self) :
+        """Opens the connection, or opens it again after it was lost."""
+        (host, port, dbname, user) = (self.savedhost, self.savedport, self.saveddbname, self.saveduser)
         self.tool.logdebug("Trying to open database (host=%s, port=%s, dbname=%s, user=%s)..." % (repr(host),
                                                                                                   repr(port),
                                                                                                   repr(dbname),
                                                                                                   repr(user)))
+        # The client encoding is sent along with the connection request,
+        # this saves a query and is understood by connection poolers.
+        oldencoding = os.environ.get("PGCLIENTENCODING")
+        os.environ["PGCLIENTENCODING"] = "UTF8"
         try :
-            self.database = pg.DB(host=host,
-                                  port=port,
-                                  dbname=dbname,
-                                  user=user,
-                                  passwd=passwd)
-        except PGError, msg :
-            msg = "%(msg)s --- the most probable cause of your problem is that PostgreSQL is down, or doesn't accept incoming connections because you didn't configure it as explained in PyKota's documentation." % locals()
-            raise PGError, msg
+            try :
+                self.database = pg.DB(host=host,
+                                      port=port,
+                                      dbname=dbname,
+                                      user=user,
+                                      passwd=self.savedpasswd)
+            except PGError, msg :
+                msg = "%(msg)s --- the most probable cause of your problem is that PostgreSQL is down, or doesn't accept incoming connections because you didn't configure it as explained in PyKota's documentation." % locals()
+                raise PGError, msg
+        finally :
+            if oldencoding is None :
+                del os.environ["PGCLIENTENCODING"]
+            else :
+                os.environ["PGCLIENTENCODING"] = oldencoding
         self.closed = False
+        self.statements = {}
+        # PygreSQL v5.1 and above can prepare statements and bind their
+        # parameters through the protocol, older ones need SQL's PREPARE.
+        self.nativeprepare = hasattr(self.database, "query_prepared")
         try :
             self.quote = self.database._quote
         except AttributeError : # pg <v4.x
             self.quote = pg._quote
+        self.tool.logdebug("Database opened (host=%s, port=%s, dbname=%s, user=%s, pooled=%s)" % (repr(host),
+                                                                                                  repr(port),
+                                                                                                  repr(dbname),
+                                                                                                  repr(user),
+                                                                                                  self.pooled))
+
+    def isAlive(self) :
+        """Returns True if the connection to the server is still usable."""
         try :
-            self.database.query("SET CLIENT_ENCODING TO 'UTF-8';")
-        except PGError, msg :
-            self.tool.logdebug("Impossible to set database client encoding to UTF-8 : %s" % msg)
-        self.tool.logdebug("Database opened (host=%s, port=%s, dbname=%s, user=%s)" % (repr(host),
-                                                                                       repr(port),
-                                                                                       repr(dbname),
-                                                                                       repr(user)))
+            return self.database.status == 1
+        except (AttributeError, TypeError, PGError) :
+            return False
+
+    def hasTable(self, tablename) :
+        """Returns True if a table exists in the search path."""
+        return bool(self.doSearch("SELECT tablename FROM pg_tables WHERE tablename=%s AND schemaname=ANY(current_schemas(false))" % self.doQuote(tablename)))
+
+    def doWithReconnect(self, function) :
+        """Calls function, opening the connection again if it was lost.
+
+           Nothing is retried within a transaction, because what was
+           already done in it was lost along with the connection.
+        """
+        for tryit in range(3) :
+            try :
+                return function()
+            except PGError, msg :
+                if self.intransaction or (tryit == 2) or self.isAlive() :
+                    raise
+                self.tool.printInfo("PostgreSQL connection lost : %s" % msg, "error")
+                self.tool.printInfo("PostgreSQL connection will be closed and reopened.", "warn")
+                if tryit :
+                    time.sleep(2)
+                try :
+                    self.database.close()
+                except (AttributeError, TypeError, PGError) :
+                    pass
+                try :
+                    self.openDatabase()
+                except PGError, msg :
+                    self.tool.printInfo("%s" % msg, "error")
 
     def close(self) :
         """Closes the database connection."""
@@ -88,17 +240,37 @@ class Storage(BaseStorage, SQLStorage) :
 
     def beginTransaction(self) :
         """Starts a transaction."""
-        self.database.query("BEGIN;")
+        self.doWithReconnect(lambda : self.database.query("BEGIN;"))
+        self.intransaction = True
         self.tool.logdebug("Transaction begins...")
 
     def commitTransaction(self) :
-        """Commits a transaction."""
-        self.database.query("COMMIT;")
+        """Commits a transaction, sending the deferred modify queries along."""
+        try :
+            queries = [self.batchedQuery(name, params) for (name, params) in self.endBatch()]
+            if queries :
+                queries.append("COMMIT;")
+                try :
+                    self.doModify(" ".join(queries))
+                except PyKotaStorageError :
+                    try :
+                        self.database.query("ROLLBACK;")
+                    except PGError :
+                        pass # the connection was lost
+                    raise
+            else :
+                self.database.query("COMMIT;")
+        finally :
+            self.intransaction = False
         self.tool.logdebug("Transaction committed.")
 
     def rollbackTransaction(self) :
         """Rollbacks a transaction."""
-        self.database.query("ROLLBACK;")
+        self.endBatch()
+        try :
+            self.database.query("ROLLBACK;")
+        finally :
+            self.intransaction = False
         self.tool.logdebug("Transaction aborted.")
 
     def doRawSearch(self, query) :
@@ -108,7 +280,7 @@ class Storage(BaseStorage, SQLStorage) :
             query += ';'
         self.querydebug("QUERY : %s" % query)
         try :
-            return self.database.query(query)
+            return self.doWithReconnect(lambda : self.database.query(query))
         except PGError, msg :
             raise PyKotaStorageError, repr(msg)
 
@@ -125,11 +297,73 @@ class Storage(BaseStorage, SQLStorage) :
             query += ';'
         self.querydebug("QUERY : %s" % query)
         try :
-            return self.database.query(query)
+            return self.doWithReconnect(lambda : self.database.query(query))
+        except PGError, msg :
+            self.tool.logdebug("Query failed : %s" % repr(msg))
+            raise PyKotaStorageError, repr(msg)
+
+    def getPreparedStatement(self, name) :
+        """Prepares a named statement once per connection, returns its server side name."""
+        try :
+            return self.statements[name]
+        except KeyError :
+            parts = self.preparedstatements[name].split("%s")
+            query = [parts[0]]
+            for i in range(1, len(parts)) :
+                query.append("$%i%s" % (i, parts[i]))
+            query = "".join(query)
+            stmtname = "pykota_%s" % name
+            self.querydebug("PREPARE %s : %s" % (stmtname, query))
+            if self.nativeprepare :
+                self.database.prepare(stmtname, query)
+            else :
+                self.database.query("PREPARE %s AS %s;" % (stmtname, query))
+            self.statements[name] = stmtname
+            return stmtname
+
+    def executePreparedStatement(self, name, params) :
+        """Executes a named statement, preparing it first if needed."""
+        stmtname = self.getPreparedStatement(name)
+        self.querydebug("EXECUTE %s : %s" % (stmtname, repr(params)))
+        if self.nativeprepare :
+            return self.database.query_prepared(stmtname, *params)
+        else :
+            return self.database.query("EXECUTE %s(%s);" % (stmtname,
+                                                            ", ".join([str(self.doQuote(p)) for p in params])))
+
+    def doPreparedQuery(self, name, params) :
+        """Executes a named statement, binding its parameters."""
+        if self.pooled :
+            # prepared statements belong to a server session
+            return self.doRawSearch(self.quotePreparedStatement(name, params))
+        try :
+            return self.doWithReconnect(lambda : self.executePreparedStatement(name, params))
         except PGError, msg :
             self.tool.logdebug("Query failed : %s" % repr(msg))
             raise PyKotaStorageError, repr(msg)
 
+    def doPreparedSearch(self, name, params) :
+        """Does a search query from a named statement."""
+        result = self.doPreparedQuery(name, params)
+        if (result is not None) and (result.ntuples() > 0) :
+            return result.dictresult()
+
+    def executePreparedModify(self, name, params) :
+        """Executes a modify query from a named statement."""
+        return self.doPreparedQuery(name, params)
+
+    def batchedQuery(self, name, params) :
+        """Returns a named statement as text, to be sent with others in a single query.
+
+           Statements not yet prepared aren't prepared now, because
+           this would need an additional round trip for each of them.
+        """
+        if self.statements.has_key(name) :
+            return "EXECUTE %s(%s);" % (self.statements[name], \
+                                        ", ".join([str(self.doQuote(p)) for p in params]))
+        else :
+            return "%s;" % self.quotePreparedStatement(name, params)
+
     def doQuote(self, field) :
         """Quotes a field for use as a string in SQL queries."""
         if type(field) == type(0.0) :
@@ -142,18 +376,10 @@ class Storage(BaseStorage, SQLStorage) :
             typ = "text"
         return self.quote(field, typ)
 
-    def prepareRawResult(self, result) :
-        """Prepares a raw result by including the headers."""
-        if result.ntuples() > 0 :
-            entries = [result.listfields()]
-            entries.extend(result.getresult())
-            nbfields = len(entries[0])
-            for i in range(1, len(entries)) :
-                fields = list(entries[i])
-                for j in range(nbfields) :
-                    field = fields[j]
-                    if type(field) == StringType :
-                        fields[j] = databaseToUnicode(field)
-                entries[i] = tuple(fields)
-            return entries
+    def doStreamedSearch(self, query) :
+        """Does a search query through a server side cursor, returns an iterator over its headers then its records."""
+        query = query.strip()
+        if query.endswith(';') :
+            query = query[:-1]
+        return ServerCursor(self, query)
 
@@ -22,15 +22,131 @@
 
 """This module defines methods common to all relational backends."""
 
+from pykota.errors import PyKotaStorageError
 from pykota.storage import StorageUser, StorageGroup, StoragePrinter, \
                            StorageJob, StorageLastJob, StorageUserPQuota, \
-                           StorageGroupPQuota, StorageBillingCode
+                           StorageGroupPQuota, StorageBillingCode, \
+                           closeExtraction
 
 from pykota.utils import *
 
 MAXINNAMES = 500 # Maximum number of non-patterns names to use in a single IN statement
+FETCHSIZE = 1000 # Number of records read at once when extracting datas
+
+class Extraction :
+    """Iterates over some already read records, then over the remaining ones."""
+    def __init__(self, first, records) :
+        """Initializes the iterator."""
+        self.first = first
+        self.first.reverse()
+        self.records = records
+
+    def __iter__(self) :
+        """Returns the iterator itself."""
+        return self
+
+    def next(self) :
+        """Returns the next record."""
+        if self.first :
+            return self.first.pop()
+        return self.records.next()
+
+    def close(self) :
+        """Ends the extraction."""
+        self.first = []
+        closeExtraction(self.records)
 
 class SQLStorage :
+    batch = None # modify queries deferred until commit, if not None
+    closureusable = None # True if the printer groups closure can be trusted, None if not checked yet
+
+    # Statements used each time a job is printed. Their parameters are
+    # written as %s and are passed separately to doPreparedSearch() and
+    # doPreparedModify(), so that backends can bind them and keep the
+    # statements prepared for the lifetime of their connection.
+    preparedstatements = {
+        "getuser" : "SELECT * FROM users WHERE username=%s",
+        "getgroup" : "SELECT groups.*,COALESCE(SUM(balance), 0.0) AS balance, COALESCE(SUM(lifetimepaid), 0.0) AS lifetimepaid FROM groups LEFT OUTER JOIN groupsmembers ON groupsmembers.groupid=groups.id LEFT OUTER JOIN users ON users.id=groupsmembers.userid WHERE groupname=%s GROUP BY groups.id,groups.groupname,groups.limitby,groups.description",
+        "getprinter" : "SELECT * FROM printers WHERE printername=%s",
+        "getbillingcode" : "SELECT * FROM billingcodes WHERE billingcode=%s",
+        "getuserpquota" : "SELECT * FROM userpquota WHERE userid=%s AND printerid=%s",
+        "getgrouppquota" : "SELECT * FROM grouppquota WHERE groupid=%s AND printerid=%s",
+        "getgrouppquotacounters" : "SELECT SUM(lifepagecounter) AS lifepagecounter, SUM(pagecounter) AS pagecounter FROM userpquota JOIN groupsmembers ON groupsmembers.userid=userpquota.userid WHERE printerid=%s AND groupid=%s",
+        "getlastjob" : "SELECT jobhistory.id, jobid, userid, username, pagecounter, jobsize, jobprice, filename, title, copies, options, hostname, jobdate, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice FROM jobhistory, users WHERE userid=users.id AND jobhistory.id IN (SELECT max(id) FROM jobhistory WHERE printerid=%s)",
+        "getgroupmembers" : "SELECT * FROM groupsmembers JOIN users ON groupsmembers.userid=users.id WHERE groupid=%s",
+        "getusergroups" : "SELECT groupname FROM groupsmembers JOIN groups ON groupsmembers.groupid=groups.id WHERE userid=%s",
+        "getparentprinters" : "SELECT groupid,printername FROM printergroupsmembers JOIN printers ON groupid=id WHERE printerid=%s",
+        "getancestorprinters" : "SELECT printers.* FROM printergroupsclosure JOIN printers ON printers.id=printergroupsclosure.ancestorid WHERE printergroupsclosure.descendantid=%s",
+        "getancestorprintersuserpquota" : "SELECT printers.id AS p_id, printers.printername AS p_printername, printers.description AS p_description, printers.priceperpage AS p_priceperpage, printers.priceperjob AS p_priceperjob, printers.passthrough AS p_passthrough, printers.maxjobsize AS p_maxjobsize, " \
+                                          "userpquota.id AS q_id, userpquota.lifepagecounter AS q_lifepagecounter, userpquota.pagecounter AS q_pagecounter, userpquota.softlimit AS q_softlimit, userpquota.hardlimit AS q_hardlimit, userpquota.datelimit AS q_datelimit, userpquota.maxjobsize AS q_maxjobsize, userpquota.warncount AS q_warncount " \
+                                          "FROM printergroupsclosure JOIN printers ON printers.id=printergroupsclosure.ancestorid " \
+                                          "LEFT OUTER JOIN userpquota ON userpquota.printerid=printers.id AND userpquota.userid=%s " \
+                                          "WHERE printergroupsclosure.descendantid=%s",
+        "getadmission" : "SELECT printers.id AS p_id, printers.description AS p_description, printers.priceperpage AS p_priceperpage, printers.priceperjob AS p_priceperjob, printers.passthrough AS p_passthrough, printers.maxjobsize AS p_maxjobsize, " \
+                         "users.id AS u_id, users.email AS u_email, users.balance AS u_balance, users.lifetimepaid AS u_lifetimepaid, users.limitby AS u_limitby, users.description AS u_description, users.overcharge AS u_overcharge, " \
+                         "userpquota.id AS q_id, userpquota.lifepagecounter AS q_lifepagecounter, userpquota.pagecounter AS q_pagecounter, userpquota.softlimit AS q_softlimit, userpquota.hardlimit AS q_hardlimit, userpquota.datelimit AS q_datelimit, userpquota.maxjobsize AS q_maxjobsize, userpquota.warncount AS q_warncount, " \
+                         "jobhistory.id AS j_id, jobhistory.jobid AS j_jobid, jobhistory.userid AS j_userid, jobusers.username AS j_username, jobhistory.pagecounter AS j_pagecounter, jobhistory.jobsize AS j_jobsize, jobhistory.jobprice AS j_jobprice, jobhistory.filename AS j_filename, jobhistory.title AS j_title, jobhistory.copies AS j_copies, jobhistory.options AS j_options, jobhistory.hostname AS j_hostname, jobhistory.jobdate AS j_jobdate, jobhistory.md5sum AS j_md5sum, jobhistory.pages AS j_pages, jobhistory.billingcode AS j_billingcode, jobhistory.precomputedjobsize AS j_precomputedjobsize, jobhistory.precomputedjobprice AS j_precomputedjobprice, " \
+                         "billingcodes.id AS b_id, billingcodes.description AS b_description, billingcodes.balance AS b_balance, billingcodes.pagecounter AS b_pagecounter " \
+                         "FROM (SELECT 1 AS one) AS anchor " \
+                         "LEFT OUTER JOIN printers ON printers.printername=%s " \
+                         "LEFT OUTER JOIN users ON users.username=%s " \
+                         "LEFT OUTER JOIN userpquota ON userpquota.userid=users.id AND userpquota.printerid=printers.id " \
+                         "LEFT OUTER JOIN jobhistory ON jobhistory.id=(SELECT max(id) FROM jobhistory WHERE printerid=printers.id) " \
+                         "LEFT OUTER JOIN users AS jobusers ON jobusers.id=jobhistory.userid " \
+                         "LEFT OUTER JOIN billingcodes ON billingcodes.billingcode=%s",
+        "writeuserpquotadatelimit" : "UPDATE userpquota SET datelimit=%s WHERE id=%s",
+        "writegrouppquotadatelimit" : "UPDATE grouppquota SET datelimit=%s WHERE id=%s",
+        "increaseuserpquotapages" : "UPDATE userpquota SET pagecounter=pagecounter + %s,lifepagecounter=lifepagecounter + %s WHERE id=%s",
+        "consumebillingcode" : "UPDATE billingcodes SET balance=balance + %s, pagecounter=pagecounter + %s WHERE id=%s",
+        "decreaseuserbalance" : "UPDATE users SET balance=balance - %s WHERE id=%s",
+        "writelastjobsize" : "UPDATE jobhistory SET jobsize=%s, jobprice=%s WHERE id=%s",
+        "writewarncount" : "UPDATE userpquota SET warncount=%s WHERE id=%s",
+        "increasewarncount" : "UPDATE userpquota SET warncount=warncount+1 WHERE id=%s",
+        "insertjob" : "INSERT INTO jobhistory (userid, printerid, jobid, pagecounter, action, jobsize, jobprice, filename, title, copies, options, hostname, jobsizebytes, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        "insertjobnosize" : "INSERT INTO jobhistory (userid, printerid, jobid, pagecounter, action, filename, title, copies, options, hostname, jobsizebytes, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        "updatelastjob" : "UPDATE jobhistory SET userid=%s, jobid=%s, pagecounter=%s, action=%s, jobsize=%s, jobprice=%s, filename=%s, title=%s, copies=%s, options=%s, hostname=%s, jobsizebytes=%s, md5sum=%s, pages=%s, billingcode=%s, precomputedjobsize=%s, precomputedjobprice=%s, jobdate=now() WHERE id=%s",
+    }
+
+    def quotePreparedStatement(self, name, params) :
+        """Returns a named statement with its parameters quoted inline."""
+        return self.preparedstatements[name] % tuple([self.doQuote(p) for p in params])
+
+    def doPreparedSearch(self, name, params) :
+        """Does a search query from a named statement.
+
+           Backends which can bind parameters override this.
+        """
+        return self.doSearch(self.quotePreparedStatement(name, params))
+
+    def doPreparedModify(self, name, params) :
+        """Does a modify query from a named statement, unless it is deferred."""
+        if self.batch is not None :
+            self.batch.append((name, params))
+        else :
+            return self.executePreparedModify(name, params)
+
+    def executePreparedModify(self, name, params) :
+        """Executes a modify query from a named statement.
+
+           Backends which can bind parameters override this.
+        """
+        return self.doModify(self.quotePreparedStatement(name, params))
+
+    def beginBatch(self) :
+        """Defers modify queries done from named statements until the transaction is committed.
+
+           They are then sent along with the COMMIT, in as few round trips
+           as the backend allows, so that rows stay locked for a shorter
+           time. Searches done meanwhile don't see these modifications.
+        """
+        self.batch = []
+
+    def endBatch(self) :
+        """Stops deferring modify queries, returns the pending ones."""
+        batch = self.batch or []
+        self.batch = None
+        return batch
+
     def storageUserFromRecord(self, username, record) :
         """Returns a StorageUser instance from a database record."""
         user = StorageUser(self, username)
@@ -130,11 +246,15 @@ class SQLStorage :
         grouppquota.SoftLimit = record.get("softlimit")
         grouppquota.HardLimit = record.get("hardlimit")
         grouppquota.DateLimit = record.get("datelimit")
-        result = self.doSearch("SELECT SUM(lifepagecounter) AS lifepagecounter, SUM(pagecounter) AS pagecounter FROM userpquota WHERE printerid=%s AND userid IN (SELECT userid FROM groupsmembers WHERE groupid=%s)" \
-                      % (self.doQuote(printer.ident), self.doQuote(group.ident)))
-        if result :
-            grouppquota.PageCounter = result[0].get("pagecounter") or 0
-            grouppquota.LifePageCounter = result[0].get("lifepagecounter") or 0
+        if record.has_key("pagecounter") :
+            # the counters were computed by the query
+            grouppquota.PageCounter = record.get("pagecounter") or 0
+            grouppquota.LifePageCounter = record.get("lifepagecounter") or 0
+        else :
+            result = self.doPreparedSearch("getgrouppquotacounters", (printer.ident, group.ident))
+            if result :
+                grouppquota.PageCounter = result[0].get("pagecounter") or 0
+                grouppquota.LifePageCounter = result[0].get("lifepagecounter") or 0
         grouppquota.Exists = True
         return grouppquota
 
@@ -148,6 +268,14 @@ class SQLStorage :
         code.Exists = True
         return code
 
+    def splitRecord(self, record) :
+        """Splits a record whose fields are prefixed with a table alias into one dict per alias."""
+        records = {}
+        for (field, value) in record.items() :
+            (prefix, name) = field.split("_", 1)
+            records.setdefault(prefix, {})[name] = value
+        return records
+
     def createFilter(self, only) :
         """Returns the appropriate SQL filter."""
         if only :
@@ -171,14 +299,29 @@ class SQLStorage :
                 statements.append("%s ASC" % field)
         return ", ".join(statements)
 
+    def extractRecords(self, query) :
+        """Returns an iterator over the headers then the records of a search, or None if nothing matches.
+
+           Records are read from the database while the iterator is consumed,
+           so only one extraction at a time can be in progress : the iterator
+           has to be either consumed entirely or closed.
+        """
+        records = self.doStreamedSearch(query)
+        headers = records.next()
+        try :
+            first = records.next()
+        except StopIteration :
+            closeExtraction(records)
+            return None
+        return Extraction([headers, first], records)
+
     def extractPrinters(self, extractonly={}, ordering=[]) :
         """Extracts all printer records."""
         thefilter = self.createFilter(extractonly)
         if thefilter :
             thefilter = "WHERE %s" % thefilter
         orderby = self.createOrderBy(["+id"], ordering)
-        result = self.doRawSearch("SELECT * FROM printers %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.extractRecords("SELECT * FROM printers %(thefilter)s ORDER BY %(orderby)s" % locals())
 
     def extractUsers(self, extractonly={}, ordering=[]) :
         """Extracts all user records."""
@@ -186,8 +329,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "WHERE %s" % thefilter
         orderby = self.createOrderBy(["+id"], ordering)
-        result = self.doRawSearch("SELECT * FROM users %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.extractRecords("SELECT * FROM users %(thefilter)s ORDER BY %(orderby)s" % locals())
 
     def extractBillingcodes(self, extractonly={}, ordering=[]) :
         """Extracts all billing codes records."""
@@ -195,8 +337,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "WHERE %s" % thefilter
         orderby = self.createOrderBy(["+id"], ordering)
-        result = self.doRawSearch("SELECT * FROM billingcodes %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.extractRecords("SELECT * FROM billingcodes %(thefilter)s ORDER BY %(orderby)s" % locals())
 
     def extractGroups(self, extractonly={}, ordering=[]) :
         """Extracts all group records."""
@@ -204,8 +345,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "WHERE %s" % thefilter
         orderby = self.createOrderBy(["+groups.id"], ordering)
-        result = self.doRawSearch("SELECT groups.*,COALESCE(SUM(balance), 0) AS balance, COALESCE(SUM(lifetimepaid), 0) as lifetimepaid FROM groups LEFT OUTER JOIN users ON users.id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id) %(thefilter)s GROUP BY groups.id,groups.groupname,groups.limitby,groups.description ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.extractRecords("SELECT groups.*,COALESCE(SUM(balance), 0) AS balance, COALESCE(SUM(lifetimepaid), 0) as lifetimepaid FROM groups LEFT OUTER JOIN groupsmembers ON groupsmembers.groupid=groups.id LEFT OUTER JOIN users ON users.id=groupsmembers.userid %(thefilter)s GROUP BY groups.id,groups.groupname,groups.limitby,groups.description ORDER BY %(orderby)s" % locals())
 
     def extractPayments(self, extractonly={}, ordering=[]) :
         """Extracts all payment records."""
@@ -225,8 +365,7 @@ class SQLStorage :
         if enddate :
             thefilter = "%s AND date<=%s" % (thefilter, self.doQuote(enddate))
         orderby = self.createOrderBy(["+payments.id"], ordering)
-        result = self.doRawSearch("SELECT username,payments.* FROM users,payments WHERE users.id=payments.userid %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.extractRecords("SELECT username,payments.* FROM users,payments WHERE users.id=payments.userid %(thefilter)s ORDER BY %(orderby)s" % locals())
 
     def extractUpquotas(self, extractonly={}, ordering=[]) :
         """Extracts all userpquota records."""
@@ -234,8 +373,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "AND %s" % thefilter
         orderby = self.createOrderBy(["+userpquota.id"], ordering)
-        result = self.doRawSearch("SELECT users.username,printers.printername,userpquota.* FROM users,printers,userpquota WHERE users.id=userpquota.userid AND printers.id=userpquota.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.extractRecords("SELECT users.username,printers.printername,userpquota.* FROM users,printers,userpquota WHERE users.id=userpquota.userid AND printers.id=userpquota.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
 
     def extractGpquotas(self, extractonly={}, ordering=[]) :
         """Extracts all grouppquota records."""
@@ -243,8 +381,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "AND %s" % thefilter
         orderby = self.createOrderBy(["+grouppquota.id"], ordering)
-        result = self.doRawSearch("SELECT groups.groupname,printers.printername,grouppquota.*,coalesce(sum(pagecounter), 0) AS pagecounter,coalesce(sum(lifepagecounter), 0) AS lifepagecounter FROM groups,printers,grouppquota,userpquota WHERE groups.id=grouppquota.groupid AND printers.id=grouppquota.printerid AND userpquota.printerid=grouppquota.printerid AND userpquota.userid IN (SELECT userid FROM groupsmembers WHERE groupsmembers.groupid=grouppquota.groupid) %(thefilter)s GROUP BY grouppquota.id,grouppquota.groupid,grouppquota.printerid,grouppquota.softlimit,grouppquota.hardlimit,grouppquota.datelimit,groups.groupname,printers.printername ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.extractRecords("SELECT groups.groupname,printers.printername,grouppquota.*,coalesce(sum(pagecounter), 0) AS pagecounter,coalesce(sum(lifepagecounter), 0) AS lifepagecounter FROM groups,printers,grouppquota,groupsmembers,userpquota WHERE groups.id=grouppquota.groupid AND printers.id=grouppquota.printerid AND groupsmembers.groupid=grouppquota.groupid AND userpquota.userid=groupsmembers.userid AND userpquota.printerid=grouppquota.printerid %(thefilter)s GROUP BY grouppquota.id,grouppquota.groupid,grouppquota.printerid,grouppquota.softlimit,grouppquota.hardlimit,grouppquota.datelimit,groups.groupname,printers.printername ORDER BY %(orderby)s" % locals())
 
     def extractUmembers(self, extractonly={}, ordering=[]) :
         """Extracts all user groups members."""
@@ -252,8 +389,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "AND %s" % thefilter
         orderby = self.createOrderBy(["+groupsmembers.groupid", "+groupsmembers.userid"], ordering)
-        result = self.doRawSearch("SELECT groups.groupname, users.username, groupsmembers.* FROM groups,users,groupsmembers WHERE users.id=groupsmembers.userid AND groups.id=groupsmembers.groupid %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.extractRecords("SELECT groups.groupname, users.username, groupsmembers.* FROM groups,users,groupsmembers WHERE users.id=groupsmembers.userid AND groups.id=groupsmembers.groupid %(thefilter)s ORDER BY %(orderby)s" % locals())
 
     def extractPmembers(self, extractonly={}, ordering=[]) :
         """Extracts all printer groups members."""
@@ -268,8 +404,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "AND %s" % thefilter
         orderby = self.createOrderBy(["+printergroupsmembers.groupid", "+printergroupsmembers.printerid"], ordering)
-        result = self.doRawSearch("SELECT p1.printername as pgroupname, p2.printername as printername, printergroupsmembers.* FROM printers p1, printers p2, printergroupsmembers WHERE p1.id=printergroupsmembers.groupid AND p2.id=printergroupsmembers.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.extractRecords("SELECT p1.printername as pgroupname, p2.printername as printername, printergroupsmembers.* FROM printers p1, printers p2, printergroupsmembers WHERE p1.id=printergroupsmembers.groupid AND p2.id=printergroupsmembers.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
 
     def extractHistory(self, extractonly={}, ordering=[]) :
         """Extracts all jobhistory records."""
@@ -289,8 +424,7 @@ class SQLStorage :
         if enddate :
             thefilter = "%s AND jobdate<=%s" % (thefilter, self.doQuote(enddate))
         orderby = self.createOrderBy(["+jobhistory.id"], ordering)
-        result = self.doRawSearch("SELECT users.username,printers.printername,jobhistory.* FROM users,printers,jobhistory WHERE users.id=jobhistory.userid AND printers.id=jobhistory.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.extractRecords("SELECT users.username,printers.printername,jobhistory.* FROM users,printers,jobhistory WHERE users.id=jobhistory.userid AND printers.id=jobhistory.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
 
     def filterNames(self, records, attribute, patterns=None) :
         """Returns a list of 'attribute' from a list of records.
@@ -354,8 +488,7 @@ class SQLStorage :
 
     def getUserFromBackend(self, username) :
         """Extracts user information given its name."""
-        result = self.doSearch("SELECT * FROM users WHERE username=%s"\
-                      % self.doQuote(unicodeToDatabase(username)))
+        result = self.doPreparedSearch("getuser", (unicodeToDatabase(username),))
         if result :
             return self.storageUserFromRecord(username, result[0])
         else :
@@ -363,8 +496,7 @@ class SQLStorage :
 
     def getGroupFromBackend(self, groupname) :
         """Extracts group information given its name."""
-        result = self.doSearch("SELECT groups.*,COALESCE(SUM(balance), 0.0) AS balance, COALESCE(SUM(lifetimepaid), 0.0) AS lifetimepaid FROM groups LEFT OUTER JOIN users ON users.id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id) WHERE groupname=%s GROUP BY groups.id,groups.groupname,groups.limitby,groups.description" \
-                      % self.doQuote(unicodeToDatabase(groupname)))
+        result = self.doPreparedSearch("getgroup", (unicodeToDatabase(groupname),))
         if result :
             return self.storageGroupFromRecord(groupname, result[0])
         else :
@@ -372,8 +504,7 @@ class SQLStorage :
 
     def getPrinterFromBackend(self, printername) :
         """Extracts printer information given its name."""
-        result = self.doSearch("SELECT * FROM printers WHERE printername=%s" \
-                      % self.doQuote(unicodeToDatabase(printername)))
+        result = self.doPreparedSearch("getprinter", (unicodeToDatabase(printername),))
         if result :
             return self.storagePrinterFromRecord(printername, result[0])
         else :
@@ -381,8 +512,7 @@ class SQLStorage :
 
     def getBillingCodeFromBackend(self, label) :
         """Extracts a billing code information given its name."""
-        result = self.doSearch("SELECT * FROM billingcodes WHERE billingcode=%s" \
-                      % self.doQuote(unicodeToDatabase(label)))
+        result = self.doPreparedSearch("getbillingcode", (unicodeToDatabase(label),))
         if result :
             return self.storageBillingCodeFromRecord(label, result[0])
         else :
@@ -391,8 +521,7 @@ class SQLStorage :
     def getUserPQuotaFromBackend(self, user, printer) :
         """Extracts a user print quota."""
         if printer.Exists and user.Exists :
-            result = self.doSearch("SELECT * FROM userpquota WHERE userid=%s AND printerid=%s;" \
-                          % (self.doQuote(user.ident), self.doQuote(printer.ident)))
+            result = self.doPreparedSearch("getuserpquota", (user.ident, printer.ident))
             if result :
                 return self.storageUserPQuotaFromRecord(user, printer, result[0])
         return StorageUserPQuota(self, user, printer)
@@ -400,15 +529,14 @@ class SQLStorage :
     def getGroupPQuotaFromBackend(self, group, printer) :
         """Extracts a group print quota."""
         if printer.Exists and group.Exists :
-            result = self.doSearch("SELECT * FROM grouppquota WHERE groupid=%s AND printerid=%s" \
-                          % (self.doQuote(group.ident), self.doQuote(printer.ident)))
+            result = self.doPreparedSearch("getgrouppquota", (group.ident, printer.ident))
             if result :
                 return self.storageGroupPQuotaFromRecord(group, printer, result[0])
         return StorageGroupPQuota(self, group, printer)
 
     def getPrinterLastJobFromBackend(self, printer) :
         """Extracts a printer's last job information."""
-        result = self.doSearch("SELECT jobhistory.id, jobid, userid, username, pagecounter, jobsize, jobprice, filename, title, copies, options, hostname, jobdate, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice FROM jobhistory, users WHERE userid=users.id AND jobhistory.id IN (SELECT max(id) FROM jobhistory WHERE printerid=%s)" % self.doQuote(printer.ident))
+        result = self.doPreparedSearch("getlastjob", (printer.ident,))
         if result :
             return self.storageLastJobFromRecord(printer, result[0])
         else :
@@ -417,7 +545,7 @@ class SQLStorage :
     def getGroupMembersFromBackend(self, group) :
         """Returns the group's members list."""
         groupmembers = []
-        result = self.doSearch("SELECT * FROM groupsmembers JOIN users ON groupsmembers.userid=users.id WHERE groupid=%s" % self.doQuote(group.ident))
+        result = self.doPreparedSearch("getgroupmembers", (group.ident,))
         if result :
             for record in result :
                 user = self.storageUserFromRecord(databaseToUnicode(record.get("username")), \
@@ -429,30 +557,273 @@ class SQLStorage :
     def getUserGroupsFromBackend(self, user) :
         """Returns the user's groups list."""
         groups = []
-        result = self.doSearch("SELECT groupname FROM groupsmembers JOIN groups ON groupsmembers.groupid=groups.id WHERE userid=%s" % self.doQuote(user.ident))
+        result = self.doPreparedSearch("getusergroups", (user.ident,))
         if result :
             for record in result :
                 groups.append(self.getGroup(databaseToUnicode(record.get("groupname"))))
         return groups
 
-    def getParentPrintersFromBackend(self, printer) :
-        """Get all the printer groups this printer is a member of."""
+    def getCachedPrinterFromRecord(self, record) :
+        """Returns the printer a database record describes, from cache if possible."""
+        printername = databaseToUnicode(record["printername"])
+        printer = self.getFromCache("PRINTERS", printername)
+        if printer is None :
+            printer = self.storagePrinterFromRecord(printername, record)
+            self.cacheEntry("PRINTERS", printername, printer)
+        return printer
+
+    def usePrinterGroupsClosure(self) :
+        """Returns True if the printer groups closure can be trusted.
+
+           It can't when the printergroupsclosure table doesn't exist, or
+           when it is empty while some printers are members of printer
+           groups, as is the case in databases created with a pre-1.28
+           version of PyKota until pkprinters --checkgroups fills it.
+        """
+        if self.closureusable is None :
+            if not self.hasTable("printergroupsclosure") :
+                reason = "doesn't exist"
+            elif self.doSearch("SELECT groupid FROM printergroupsmembers LIMIT 1") \
+                     and not self.doSearch("SELECT ancestorid FROM printergroupsclosure LIMIT 1") :
+                reason = "is empty"
+            else :
+                reason = None
+            self.closureusable = (reason is None)
+            if not self.closureusable :
+                self.tool.printInfo("The printergroupsclosure table %s, printer groups will be searched one level at a time. Please create it as explained in the initscripts' README if needed, then fill it with pkprinters --checkgroups." % reason, "warn")
+        return self.closureusable
+
+    def warnPrinterGroupsLoop(self, printer) :
+        """Warns that printer groups membership loops back to a printer."""
+        self.tool.printInfo("Printer %s is a member of itself through printer groups, please fix this." % printer.Name, "warn")
+
+    def getParentPrintersByLevel(self, printer) :
+        """Get all the printer groups this printer is a member of, with one query per level.
+
+           A printer group met twice isn't searched again,
+           so that loops can't recurse forever.
+        """
         pgroups = []
-        result = self.doSearch("SELECT groupid,printername FROM printergroupsmembers JOIN printers ON groupid=id WHERE printerid=%s" % self.doQuote(printer.ident))
-        if result :
-            for record in result :
-                if record["groupid"] != printer.ident : # in case of integrity violation
-                    parentprinter = self.getPrinter(databaseToUnicode(record.get("printername")))
-                    if parentprinter.Exists :
-                        pgroups.append(parentprinter)
+        seen = { printer.ident : None }
+        level = [ printer ]
+        while level :
+            result = self.doSearch("SELECT printers.* FROM printergroupsmembers JOIN printers ON groupid=id WHERE printerid IN (%s)" \
+                                       % ", ".join([str(self.doQuote(p.ident)) for p in level]))
+            level = []
+            for record in (result or []) :
+                if seen.has_key(record["id"]) :
+                    if record["id"] == printer.ident :
+                        self.warnPrinterGroupsLoop(printer)
+                    continue
+                seen[record["id"]] = None
+                parentprinter = self.getCachedPrinterFromRecord(record)
+                pgroups.append(parentprinter)
+                level.append(parentprinter)
         return pgroups
 
+    def getParentPrintersFromBackend(self, printer) :
+        """Get all the printer groups this printer is a member of, recursively."""
+        if not self.usePrinterGroupsClosure() :
+            return self.getParentPrintersByLevel(printer)
+        result = self.doPreparedSearch("getancestorprinters", (printer.ident,))
+        return [self.getCachedPrinterFromRecord(record) for record in (result or [])]
+
+    def getParentPrintersUserPQuotaFromBackend(self, userpquota) :
+        """Returns the user's print quotas on all the printer's parents, along with these parents."""
+        user = userpquota.User
+        printer = userpquota.Printer
+        parents = []
+        upquotas = []
+        if not self.usePrinterGroupsClosure() :
+            parents = self.getParentPrinters(printer)
+            if parents :
+                printers = {}
+                for parent in parents :
+                    printers[parent.ident] = parent
+                result = self.doSearch("SELECT * FROM userpquota WHERE userid=%s AND printerid IN (%s)" \
+                                           % (self.doQuote(user.ident), \
+                                              ", ".join([str(self.doQuote(p.ident)) for p in parents])))
+                byprinter = {}
+                for record in (result or []) :
+                    byprinter[record["printerid"]] = self.storageUserPQuotaFromRecord(user, printers[record["printerid"]], record)
+                upquotas = [byprinter[p.ident] for p in parents if byprinter.has_key(p.ident)]
+            return upquotas
+        result = self.doPreparedSearch("getancestorprintersuserpquota", (user.ident, printer.ident))
+        for record in (result or []) :
+            records = self.splitRecord(record)
+            parent = self.getCachedPrinterFromRecord(records["p"])
+            parents.append(parent)
+            if records["q"]["id"] is not None :
+                upquota = self.storageUserPQuotaFromRecord(user, parent, records["q"])
+                self.cacheEntry("USERPQUOTAS", "%s@%s" % (user.Name, parent.Name), upquota)
+                upquotas.append(upquota)
+        printer.Parents = parents
+        return upquotas
+
+    def getAdmissionContextFromBackend(self, username, printername, billingcode) :
+        """Retrieves everything needed to admit a job with a few queries.
+
+           The printer, user, user print quota, last job and billing code
+           come from a single row, then the parent printers' user print
+           quotas, and finally the user's groups with their print quotas
+           on the printer and all its parents.
+        """
+        result = self.doPreparedSearch("getadmission", (unicodeToDatabase(printername), \
+                                                        unicodeToDatabase(username), \
+                                                        unicodeToDatabase(billingcode)))
+        records = self.splitRecord(result[0])
+        if records["p"]["id"] is not None :
+            printer = self.storagePrinterFromRecord(printername, records["p"])
+            if (records["j"]["id"] is not None) and (records["j"]["username"] is not None) :
+                printer.LastJob = self.storageLastJobFromRecord(printer, records["j"])
+            else :
+                printer.LastJob = StorageLastJob(self, printer)
+        else :
+            printer = StoragePrinter(self, printername)
+        if records["u"]["id"] is not None :
+            user = self.storageUserFromRecord(username, records["u"])
+        else :
+            user = StorageUser(self, username)
+        if printer.Exists and user.Exists and (records["q"]["id"] is not None) :
+            userpquota = self.storageUserPQuotaFromRecord(user, printer, records["q"])
+        else :
+            userpquota = StorageUserPQuota(self, user, printer)
+        code = None
+        if billingcode :
+            if records["b"]["id"] is not None :
+                code = self.storageBillingCodeFromRecord(billingcode, records["b"])
+            else :
+                code = StorageBillingCode(self, billingcode)
+        if not userpquota.Exists :
+            # the job won't be checked against print quotas.
+            return (printer, user, userpquota, code)
+
+        userpquota.ParentPrintersUserPQuota = self.getParentPrintersUserPQuotaFromBackend(userpquota)
+        parents = printer.Parents
+        printers = {}
+        for p in [ printer ] + parents :
+            printers[p.ident] = p
+        printerids = ", ".join([str(self.doQuote(ident)) for ident in printers.keys()])
+
+        groups = []
+        gpquotas = {}
+        # The balances and page counters are summed once per group
+        # over the members of the user's groups only, then joined.
+        userid = self.doQuote(user.ident)
+        result = self.doSearch("SELECT groups.id AS g_id, groups.groupname AS g_groupname, groups.limitby AS g_limitby, groups.description AS g_description, " \
+                               "COALESCE(balances.balance, 0.0) AS g_balance, COALESCE(balances.lifetimepaid, 0.0) AS g_lifetimepaid, " \
+                               "grouppquota.id AS q_id, grouppquota.printerid AS q_printerid, grouppquota.softlimit AS q_softlimit, grouppquota.hardlimit AS q_hardlimit, grouppquota.datelimit AS q_datelimit, " \
+                               "counters.pagecounter AS q_pagecounter, counters.lifepagecounter AS q_lifepagecounter " \
+                               "FROM groupsmembers JOIN groups ON groupsmembers.groupid=groups.id " \
+                               "LEFT OUTER JOIN (SELECT members.groupid AS groupid, SUM(users.balance) AS balance, SUM(users.lifetimepaid) AS lifetimepaid " \
+                                                "FROM groupsmembers mine JOIN groupsmembers members ON members.groupid=mine.groupid " \
+                                                "JOIN users ON users.id=members.userid " \
+                                                "WHERE mine.userid=%s GROUP BY members.groupid) balances ON balances.groupid=groups.id " \
+                               "LEFT OUTER JOIN grouppquota ON grouppquota.groupid=groups.id AND grouppquota.printerid IN (%s) " \
+                               "LEFT OUTER JOIN (SELECT members.groupid AS groupid, userpquota.printerid AS printerid, SUM(userpquota.pagecounter) AS pagecounter, SUM(userpquota.lifepagecounter) AS lifepagecounter " \
+                                                "FROM groupsmembers mine JOIN groupsmembers members ON members.groupid=mine.groupid " \
+                                                "JOIN userpquota ON userpquota.userid=members.userid " \
+                                                "WHERE mine.userid=%s AND userpquota.printerid IN (%s) GROUP BY members.groupid, userpquota.printerid) counters " \
+                                                "ON counters.groupid=groups.id AND counters.printerid=grouppquota.printerid " \
+                               "WHERE groupsmembers.userid=%s" % (userid, printerids, userid, printerids, userid))
+        groupsbyid = {}
+        for record in (result or []) :
+            records = self.splitRecord(record)
+            group = groupsbyid.get(records["g"]["id"])
+            if group is None :
+                group = groupsbyid[records["g"]["id"]] = self.storageGroupFromRecord(databaseToUnicode(records["g"]["groupname"]), records["g"])
+                groups.append(group)
+            if records["q"]["id"] is not None :
+                gpquotas[(group.ident, records["q"]["printerid"])] = self.storageGroupPQuotaFromRecord(group, printers[records["q"]["printerid"]], records["q"])
+        user.Groups = groups
+        userpquota.GroupsPQuota = []
+        for group in groups :
+            grouppquota = gpquotas.get((group.ident, printer.ident)) or StorageGroupPQuota(self, group, printer)
+            grouppquota.ParentPrintersGroupPQuota = [gpquotas[(group.ident, p.ident)] for p in parents if gpquotas.has_key((group.ident, p.ident))]
+            userpquota.GroupsPQuota.append(grouppquota)
+        return (printer, user, userpquota, code)
+
+    def splitPattern(self, pattern) :
+        """Splits an fnmatch pattern the way fnmatch parses it.
+
+           Returns a list of "*", "?", (negated, characters) tuples for
+           sets of characters, and literal characters.
+        """
+        tokens = []
+        i = 0
+        n = len(pattern)
+        while i < n :
+            c = pattern[i]
+            i += 1
+            if c in "*?" :
+                tokens.append(c)
+            elif c == "[" :
+                j = i
+                if (j < n) and (pattern[j] == "!") :
+                    j += 1
+                if (j < n) and (pattern[j] == "]") :
+                    j += 1
+                while (j < n) and (pattern[j] != "]") :
+                    j += 1
+                if j >= n :
+                    tokens.append(c) # unclosed : fnmatch sees a literal [
+                else :
+                    stuff = pattern[i:j]
+                    if stuff.startswith("!") :
+                        tokens.append((True, stuff[1:]))
+                    else :
+                        tokens.append((False, stuff))
+                    i = j + 1
+            else :
+                tokens.append(c)
+        return tokens
+
+    def patternToLike(self, pattern) :
+        """Converts an fnmatch pattern to a LIKE pattern, with = as the escape character.
+
+           Sets of characters can't be expressed with LIKE, so they
+           match any single character : the result may match more.
+        """
+        like = []
+        for token in self.splitPattern(pattern) :
+            if isinstance(token, tuple) or (token == "?") :
+                like.append("_")
+            elif token == "*" :
+                like.append("%")
+            elif token in ("%", "_", "=") :
+                like.append("=" + token)
+            else :
+                like.append(token)
+        return "".join(like)
+
+    def patternToPredicate(self, keyname, pattern) :
+        """Returns an SQL condition true at least for the names which match an fnmatch pattern."""
+        condition = "%s=%s" % (keyname, self.doQuote(unicodeToDatabase(pattern)))
+        if self.hasWildCards(pattern) :
+            wildcards = "%s LIKE %s ESCAPE '='" % (keyname, self.doQuote(unicodeToDatabase(self.patternToLike(pattern))))
+            if "[" in pattern :
+                # a name may be equal to a pattern it doesn't match
+                condition = "(%s OR %s)" % (wildcards, condition)
+            else :
+                condition = wildcards
+        return condition
+
+    def createPatternsFilter(self, keyname, patterns) :
+        """Returns an SQL condition true at least for the names which match one of the patterns.
+
+           Returns None if all names match.
+        """
+        if (not patterns) or ("*" in patterns) :
+            return None
+        return "(%s)" % " OR ".join([self.patternToPredicate(keyname, p) for p in patterns])
+
     def getMatchingStuff(self, pattern, tablename, entrytype, keyname) :
         """Returns the list of all entries for which the name matches a certain pattern."""
         entries = []
-        # We 'could' do a SELECT xxxxname FROM xxxx WHERE xxxxname LIKE ...
-        # but we don't because other storages semantics may be different, so every
-        # storage should use fnmatch to match patterns and be storage agnostic
+        # Patterns are translated to SQL conditions which only reduce the
+        # number of records retrieved : the semantics of each database
+        # differ a bit (e.g. case sensitivity), so fnmatch still decides,
+        # like with other storages.
         #
         # This doesn't prevent us from being smarter, thanks to bse@chalmers.se
         pattern = pattern or "*"
@@ -464,7 +835,11 @@ class SQLStorage :
         cachename = tablename.upper()
         if self.hasWildCards(pattern) :
             # Slow route
-            result = self.doSearch("SELECT * FROM %s" % tablename)
+            wherestmt = self.createPatternsFilter(keyname, patterns)
+            if wherestmt is None :
+                result = self.doSearch("SELECT * FROM %s" % tablename)
+            else :
+                result = self.doSearch("SELECT * FROM %s WHERE %s" % (tablename, wherestmt))
             if result :
                 for record in result :
                     name = databaseToUnicode(record[keyname])
@@ -509,13 +884,17 @@ class SQLStorage :
     def getMatchingGroups(self, grouppattern) :
         """Returns the list of all groups for which name matches a certain pattern."""
         groups = []
-        # We 'could' do a SELECT groupname FROM groups WHERE groupname LIKE ...
-        # but we don't because other storages semantics may be different, so every
-        # storage should use fnmatch to match patterns and be storage agnostic
-        result = self.doSearch("SELECT groups.*,COALESCE(SUM(balance), 0.0) AS balance, COALESCE(SUM(lifetimepaid), 0.0) AS lifetimepaid FROM groups LEFT OUTER JOIN users ON users.id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id) GROUP BY groups.id,groups.groupname,groups.limitby,groups.description")
+        # The SQL condition only reduces the number of groups to
+        # aggregate, fnmatch still decides, see getMatchingStuff()
+        patterns = grouppattern.split(",")
+        patdict = {}.fromkeys(patterns)
+        wherestmt = self.createPatternsFilter("groups.groupname", patterns)
+        if wherestmt is None :
+            wherestmt = ""
+        else :
+            wherestmt = "WHERE %s " % wherestmt
+        result = self.doSearch("SELECT groups.*,COALESCE(SUM(balance), 0.0) AS balance, COALESCE(SUM(lifetimepaid), 0.0) AS lifetimepaid FROM groups LEFT OUTER JOIN groupsmembers ON groupsmembers.groupid=groups.id LEFT OUTER JOIN users ON users.id=groupsmembers.userid %sGROUP BY groups.id,groups.groupname,groups.limitby,groups.description" % wherestmt)
         if result :
-            patterns = grouppattern.split(",")
-            patdict = {}.fromkeys(patterns)
             for record in result :
                 gname = databaseToUnicode(record["groupname"])
                 if patdict.has_key(gname) or self.tool.matchString(gname, patterns) :
@@ -527,7 +906,12 @@ class SQLStorage :
     def getPrinterUsersAndQuotas(self, printer, names=["*"]) :
         """Returns the list of users who uses a given printer, along with their quotas."""
         usersandquotas = []
-        result = self.doSearch("SELECT users.id as uid,username,description,balance,lifetimepaid,limitby,email,overcharge,userpquota.id,lifepagecounter,pagecounter,softlimit,hardlimit,datelimit,warncount FROM users JOIN userpquota ON users.id=userpquota.userid AND printerid=%s ORDER BY username ASC" % self.doQuote(printer.ident))
+        wherestmt = self.createPatternsFilter("username", names)
+        if wherestmt is None :
+            wherestmt = ""
+        else :
+            wherestmt = "WHERE %s " % wherestmt
+        result = self.doSearch("SELECT users.id as uid,username,description,balance,lifetimepaid,limitby,email,overcharge,userpquota.id,lifepagecounter,pagecounter,softlimit,hardlimit,datelimit,warncount FROM users JOIN userpquota ON users.id=userpquota.userid AND printerid=%s %sORDER BY username ASC" % (self.doQuote(printer.ident), wherestmt))
         if result :
             for record in result :
                 uname = databaseToUnicode(record.get("username"))
@@ -542,7 +926,12 @@ class SQLStorage :
     def getPrinterGroupsAndQuotas(self, printer, names=["*"]) :
         """Returns the list of groups which uses a given printer, along with their quotas."""
         groupsandquotas = []
-        result = self.doSearch("SELECT groupname FROM groups JOIN grouppquota ON groups.id=grouppquota.groupid AND printerid=%s ORDER BY groupname ASC" % self.doQuote(printer.ident))
+        wherestmt = self.createPatternsFilter("groupname", names)
+        if wherestmt is None :
+            wherestmt = ""
+        else :
+            wherestmt = "WHERE %s " % wherestmt
+        result = self.doSearch("SELECT groupname FROM groups JOIN grouppquota ON groups.id=grouppquota.groupid AND printerid=%s %sORDER BY groupname ASC" % (self.doQuote(printer.ident), wherestmt))
         if result :
             for record in result :
                 gname = databaseToUnicode(record.get("groupname"))
@@ -689,15 +1078,15 @@ class SQLStorage :
 
     def writeUserPQuotaDateLimit(self, userpquota, datelimit) :
         """Sets the date limit permanently for a user print quota."""
-        self.doModify("UPDATE userpquota SET datelimit=%s WHERE id=%s" % (self.doQuote(datelimit), self.doQuote(userpquota.ident)))
+        self.doPreparedModify("writeuserpquotadatelimit", (datelimit, userpquota.ident))
 
     def writeGroupPQuotaDateLimit(self, grouppquota, datelimit) :
         """Sets the date limit permanently for a group print quota."""
-        self.doModify("UPDATE grouppquota SET datelimit=%s WHERE id=%s" % (self.doQuote(datelimit), self.doQuote(grouppquota.ident)))
+        self.doPreparedModify("writegrouppquotadatelimit", (datelimit, grouppquota.ident))
 
     def increaseUserPQuotaPagesCounters(self, userpquota, nbpages) :
         """Increase page counters for a user print quota."""
-        self.doModify("UPDATE userpquota SET pagecounter=pagecounter + %s,lifepagecounter=lifepagecounter + %s WHERE id=%s" % (self.doQuote(nbpages), self.doQuote(nbpages), self.doQuote(userpquota.ident)))
+        self.doPreparedModify("increaseuserpquotapages", (nbpages, nbpages, userpquota.ident))
 
     def saveBillingCode(self, bcode) :
         """Saves the billing code to the database."""
@@ -709,7 +1098,7 @@ class SQLStorage :
 
     def consumeBillingCode(self, bcode, pagecounter, balance) :
         """Consumes from a billing code."""
-        self.doModify("UPDATE billingcodes SET balance=balance + %s, pagecounter=pagecounter + %s WHERE id=%s" % (self.doQuote(balance), self.doQuote(pagecounter), self.doQuote(bcode.ident)))
+        self.doPreparedModify("consumebillingcode", (balance, pagecounter, bcode.ident))
 
     def refundJob(self, jobident) :
         """Marks a job as refunded in the history."""
@@ -717,7 +1106,7 @@ class SQLStorage :
 
     def decreaseUserAccountBalance(self, user, amount) :
         """Decreases user's account balance from an amount."""
-        self.doModify("UPDATE users SET balance=balance - %s WHERE id=%s" % (self.doQuote(amount), self.doQuote(user.ident)))
+        self.doPreparedModify("decreaseuserbalance", (amount, user.ident))
 
     def writeNewPayment(self, user, amount, comment="") :
         """Adds a new payment to the payments history."""
@@ -728,7 +1117,7 @@ class SQLStorage :
 
     def writeLastJobSize(self, lastjob, jobsize, jobprice) :
         """Sets the last job's size permanently."""
-        self.doModify("UPDATE jobhistory SET jobsize=%s, jobprice=%s WHERE id=%s" % (self.doQuote(jobsize), self.doQuote(jobprice), self.doQuote(lastjob.ident)))
+        self.doPreparedModify("writelastjobsize", (jobsize, jobprice, lastjob.ident))
 
     def writeJobNew(self, printer, user, jobid, pagecounter, action, jobsize=None, jobprice=None, filename=None, title=None, copies=None, options=None, clienthost=None, jobsizebytes=None, jobmd5sum=None, jobpages=None, jobbilling=None, precomputedsize=None, precomputedprice=None) :
         """Adds a job in a printer's history."""
@@ -737,64 +1126,64 @@ class SQLStorage :
             title = filename = options = "hidden"
         if (not self.disablehistory) or (not printer.LastJob.Exists) :
             if jobsize is not None :
-                self.doModify("INSERT INTO jobhistory (userid, printerid, jobid, pagecounter, action, jobsize, jobprice, filename, title, copies, options, hostname, jobsizebytes, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)" \
-                                  % (self.doQuote(user.ident),
-                                     self.doQuote(printer.ident),
-                                     self.doQuote(unicodeToDatabase(jobid)),
-                                     self.doQuote(pagecounter),
-                                     self.doQuote(action),
-                                     self.doQuote(jobsize),
-                                     self.doQuote(jobprice),
-                                     self.doQuote(unicodeToDatabase(filename)),
-                                     self.doQuote(unicodeToDatabase(title)),
-                                     self.doQuote(copies),
-                                     self.doQuote(unicodeToDatabase(options)),
-                                     self.doQuote(unicodeToDatabase(clienthost)),
-                                     self.doQuote(jobsizebytes),
-                                     self.doQuote(jobmd5sum),
-                                     self.doQuote(jobpages),
-                                     self.doQuote(unicodeToDatabase(jobbilling)),
-                                     self.doQuote(precomputedsize),
-                                     self.doQuote(precomputedprice)))
+                self.doPreparedModify("insertjob",
+                                      (user.ident,
+                                       printer.ident,
+                                       unicodeToDatabase(jobid),
+                                       pagecounter,
+                                       action,
+                                       jobsize,
+                                       jobprice,
+                                       unicodeToDatabase(filename),
+                                       unicodeToDatabase(title),
+                                       copies,
+                                       unicodeToDatabase(options),
+                                       unicodeToDatabase(clienthost),
+                                       jobsizebytes,
+                                       jobmd5sum,
+                                       jobpages,
+                                       unicodeToDatabase(jobbilling),
+                                       precomputedsize,
+                                       precomputedprice))
             else :
-                self.doModify("INSERT INTO jobhistory (userid, printerid, jobid, pagecounter, action, filename, title, copies, options, hostname, jobsizebytes, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)" \
-                                  % (self.doQuote(user.ident),
-                                     self.doQuote(printer.ident),
-                                     self.doQuote(unicodeToDatabase(jobid)),
-                                     self.doQuote(pagecounter),
-                                     self.doQuote(action),
-                                     self.doQuote(unicodeToDatabase(filename)),
-                                     self.doQuote(unicodeToDatabase(title)),
-                                     self.doQuote(copies),
-                                     self.doQuote(unicodeToDatabase(options)),
-                                     self.doQuote(unicodeToDatabase(clienthost)),
-                                     self.doQuote(jobsizebytes),
-                                     self.doQuote(jobmd5sum),
-                                     self.doQuote(jobpages),
-                                     self.doQuote(unicodeToDatabase(jobbilling)),
-                                     self.doQuote(precomputedsize),
-                                     self.doQuote(precomputedprice)))
+                self.doPreparedModify("insertjobnosize",
+                                      (user.ident,
+                                       printer.ident,
+                                       unicodeToDatabase(jobid),
+                                       pagecounter,
+                                       action,
+                                       unicodeToDatabase(filename),
+                                       unicodeToDatabase(title),
+                                       copies,
+                                       unicodeToDatabase(options),
+                                       unicodeToDatabase(clienthost),
+                                       jobsizebytes,
+                                       jobmd5sum,
+                                       jobpages,
+                                       unicodeToDatabase(jobbilling),
+                                       precomputedsize,
+                                       precomputedprice))
         else :
             # here we explicitly want to reset jobsize to NULL if needed
-            self.doModify("UPDATE jobhistory SET userid=%s, jobid=%s, pagecounter=%s, action=%s, jobsize=%s, jobprice=%s, filename=%s, title=%s, copies=%s, options=%s, hostname=%s, jobsizebytes=%s, md5sum=%s, pages=%s, billingcode=%s, precomputedjobsize=%s, precomputedjobprice=%s, jobdate=now() WHERE id=%s" \
-                              % (self.doQuote(user.ident),
-                                 self.doQuote(unicodeToDatabase(jobid)),
-                                 self.doQuote(pagecounter),
-                                 self.doQuote(action),
-                                 self.doQuote(jobsize),
-                                 self.doQuote(jobprice),
-                                 self.doQuote(unicodeToDatabase(filename)),
-                                 self.doQuote(unicodeToDatabase(title)),
-                                 self.doQuote(copies),
-                                 self.doQuote(unicodeToDatabase(options)),
-                                 self.doQuote(unicodeToDatabase(clienthost)),
-                                 self.doQuote(jobsizebytes),
-                                 self.doQuote(jobmd5sum),
-                                 self.doQuote(jobpages),
-                                 self.doQuote(unicodeToDatabase(jobbilling)),
-                                 self.doQuote(precomputedsize),
-                                 self.doQuote(precomputedprice),
-                                 self.doQuote(printer.LastJob.ident)))
+            self.doPreparedModify("updatelastjob",
+                                  (user.ident,
+                                   unicodeToDatabase(jobid),
+                                   pagecounter,
+                                   action,
+                                   jobsize,
+                                   jobprice,
+                                   unicodeToDatabase(filename),
+                                   unicodeToDatabase(title),
+                                   copies,
+                                   unicodeToDatabase(options),
+                                   unicodeToDatabase(clienthost),
+                                   jobsizebytes,
+                                   jobmd5sum,
+                                   jobpages,
+                                   unicodeToDatabase(jobbilling),
+                                   precomputedsize,
+                                   precomputedprice,
+                                   printer.LastJob.ident))
 
     def saveUserPQuota(self, userpquota) :
         """Saves an user print quota entry."""
@@ -810,14 +1199,11 @@ class SQLStorage :
 
     def writeUserPQuotaWarnCount(self, userpquota, warncount) :
         """Sets the warn counter value for a user quota."""
-        self.doModify("UPDATE userpquota SET warncount=%s WHERE id=%s" \
-                          % (self.doQuote(warncount),
-                             self.doQuote(userpquota.ident)))
+        self.doPreparedModify("writewarncount", (warncount, userpquota.ident))
 
     def increaseUserPQuotaWarnCount(self, userpquota) :
         """Increases the warn counter value for a user quota."""
-        self.doModify("UPDATE userpquota SET warncount=warncount+1 WHERE id=%s" \
-                          % self.doQuote(userpquota.ident))
+        self.doPreparedModify("increasewarncount", (userpquota.ident,))
 
     def saveGroupPQuota(self, grouppquota) :
         """Saves a group print quota entry."""
@@ -836,10 +1222,91 @@ class SQLStorage :
                 children.append(record.get("printerid")) # TODO : put this into the database integrity rules
         if printer.ident not in children :
             self.doModify("INSERT INTO printergroupsmembers (groupid, printerid) VALUES (%s, %s)" % (self.doQuote(pgroup.ident), self.doQuote(printer.ident)))
+            if not self.usePrinterGroupsClosure() :
+                return # pkprinters --checkgroups will fill it
+            # the printer group and its ancestors become
+            # ancestors of the printer and its descendants.
+            self.doModify("INSERT INTO printergroupsclosure (ancestorid, descendantid) " \
+                          "SELECT ancestors.id, descendants.id " \
+                          "FROM (SELECT %(groupid)s AS id UNION SELECT ancestorid FROM printergroupsclosure WHERE descendantid=%(groupid)s) AS ancestors, " \
+                          "(SELECT %(printerid)s AS id UNION SELECT descendantid FROM printergroupsclosure WHERE ancestorid=%(printerid)s) AS descendants " \
+                          "WHERE ancestors.id<>descendants.id " \
+                          "AND NOT EXISTS (SELECT 1 FROM printergroupsclosure AS known WHERE known.ancestorid=ancestors.id AND known.descendantid=descendants.id)" \
+                              % { "groupid" : self.doQuote(pgroup.ident),
+                                  "printerid" : self.doQuote(printer.ident) })
 
     def removePrinterFromGroup(self, pgroup, printer) :
         """Removes a printer from a printer group."""
+        descendants = self.getDescendantPrinterIds(printer)
         self.doModify("DELETE FROM printergroupsmembers WHERE groupid=%s AND printerid=%s" % (self.doQuote(pgroup.ident), self.doQuote(printer.ident)))
+        if self.usePrinterGroupsClosure() :
+            # the printer may still be a member of some of
+            # its former ancestors through other printer groups.
+            self.rebuildPrinterGroupsClosure([ printer.ident ] + descendants)
+
+    def getDescendantPrinterIds(self, printer) :
+        """Returns the identifiers of all the printers which are members of this printer group, recursively."""
+        if not self.usePrinterGroupsClosure() :
+            return []
+        result = self.doSearch("SELECT descendantid FROM printergroupsclosure WHERE ancestorid=%s" % self.doQuote(printer.ident))
+        return [record["descendantid"] for record in (result or [])]
+
+    def rebuildPrinterGroupsClosure(self, printerids=None) :
+        """Computes the ancestors of some printers, or of all printers if None, from printer groups membership.
+
+           Returns the numbers of missing and of unneeded rows found in the
+           printergroupsclosure table, which are fixed, and the names of
+           printers which are members of themselves through printer groups.
+        """
+        parents = {}
+        names = {}
+        result = self.doSearch("SELECT groupid, printerid, printername FROM printergroupsmembers JOIN printers ON printers.id=printerid")
+        for record in (result or []) :
+            parents.setdefault(record["printerid"], []).append(record["groupid"])
+            names[record["printerid"]] = databaseToUnicode(record["printername"])
+        if printerids is None :
+            result = self.doSearch("SELECT ancestorid, descendantid FROM printergroupsclosure")
+        elif printerids :
+            result = self.doSearch("SELECT ancestorid, descendantid FROM printergroupsclosure WHERE descendantid IN (%s)" \
+                                       % ", ".join([str(self.doQuote(ident)) for ident in printerids]))
+        else :
+            result = None
+        known = {}
+        for record in (result or []) :
+            known[(record["ancestorid"], record["descendantid"])] = None
+        if printerids is None :
+            printerids = parents.keys() + [descendantid for (ancestorid, descendantid) in known.keys()]
+        expected = {}
+        loops = []
+        for printerid in {}.fromkeys(printerids).keys() :
+            (ancestors, isloop) = self.walkPrinterGroups(printerid, parents)
+            if isloop :
+                loops.append(names[printerid])
+            for ancestorid in ancestors :
+                expected[(ancestorid, printerid)] = None
+        missing = [couple for couple in expected.keys() if not known.has_key(couple)]
+        unneeded = [couple for couple in known.keys() if not expected.has_key(couple)]
+        for (ancestorid, descendantid) in unneeded :
+            self.doModify("DELETE FROM printergroupsclosure WHERE ancestorid=%s AND descendantid=%s" \
+                              % (self.doQuote(ancestorid), self.doQuote(descendantid)))
+        for (ancestorid, descendantid) in missing :
+            self.doModify("INSERT INTO printergroupsclosure (ancestorid, descendantid) VALUES (%s, %s)" \
+                              % (self.doQuote(ancestorid), self.doQuote(descendantid)))
+        loops.sort()
+        return (len(missing), len(unneeded), loops)
+
+    def checkPrinterGroups(self) :
+        """Checks printer groups membership, and rebuilds the printer groups closure from it.
+
+           Returns the numbers of fixed missing and unneeded rows in
+           the closure, and the names of printers which are members of
+           themselves through printer groups.
+        """
+        if not self.hasTable("printergroupsclosure") :
+            raise PyKotaStorageError, "The printergroupsclosure table doesn't exist, please create it as explained in the initscripts' README."
+        result = self.rebuildPrinterGroupsClosure()
+        self.closureusable = True
+        return result
 
     def retrieveHistory(self, user=None, printer=None, hostname=None, billingcode=None, jobid=None, limit=100, start=None, end=None) :
         """Retrieves all print jobs for user on printer (or all) between start and end date, limited to first 100 results."""
@@ -900,14 +1367,14 @@ class SQLStorage :
         else :
             self.commitTransaction()
 
-    def deleteManyBillingCodes(self, billingcodes) :
+    def deleteManyBillingCodes(self, billingcodes, percent=None) :
         """Deletes many billing codes."""
         codeids = ", ".join(["%s" % self.doQuote(b.ident) for b in billingcodes])
         if codeids :
             self.multipleQueriesInTransaction([
                     "DELETE FROM billingcodes WHERE id IN (%s)" % codeids,])
 
-    def deleteManyUsers(self, users) :
+    def deleteManyUsers(self, users, percent=None) :
         """Deletes many users."""
         userids = ", ".join(["%s" % self.doQuote(u.ident) for u in users])
         if userids :
@@ -917,8 +1384,9 @@ class SQLStorage :
                     "DELETE FROM jobhistory WHERE userid IN (%s)" % userids,
                     "DELETE FROM userpquota WHERE userid IN (%s)" % userids,
                     "DELETE FROM users WHERE id IN (%s)" % userids,])
+            self.flushDeletedUsers(users)
 
-    def deleteManyGroups(self, groups) :
+    def deleteManyGroups(self, groups, percent=None) :
         """Deletes many groups."""
         groupids = ", ".join(["%s" % self.doQuote(g.ident) for g in groups])
         if groupids :
@@ -926,19 +1394,41 @@ class SQLStorage :
                     "DELETE FROM groupsmembers WHERE groupid IN (%s)" % groupids,
                     "DELETE FROM grouppquota WHERE groupid IN (%s)" % groupids,
                     "DELETE FROM groups WHERE id IN (%s)" % groupids,])
+            self.flushDeletedGroups(groups)
 
-    def deleteManyPrinters(self, printers) :
+    def deleteManyPrinters(self, printers, percent=None) :
         """Deletes many printers."""
         printerids = ", ".join(["%s" % self.doQuote(p.ident) for p in printers])
         if printerids :
-            self.multipleQueriesInTransaction([
+            queries = [
                     "DELETE FROM printergroupsmembers WHERE groupid IN (%s) OR printerid IN (%s)" % (printerids, printerids),
                     "DELETE FROM jobhistory WHERE printerid IN (%s)" % printerids,
                     "DELETE FROM grouppquota WHERE printerid IN (%s)" % printerids,
                     "DELETE FROM userpquota WHERE printerid IN (%s)" % printerids,
-                    "DELETE FROM printers WHERE id IN (%s)" % printerids,])
+                    "DELETE FROM printers WHERE id IN (%s)" % printerids,]
+            descendants = []
+            useclosure = self.usePrinterGroupsClosure()
+            if useclosure :
+                deleted = {}.fromkeys([p.ident for p in printers])
+                result = self.doSearch("SELECT DISTINCT descendantid FROM printergroupsclosure WHERE ancestorid IN (%s)" % printerids)
+                descendants = [record["descendantid"] for record in (result or []) if not deleted.has_key(record["descendantid"])]
+                queries.insert(0, "DELETE FROM printergroupsclosure WHERE ancestorid IN (%s) OR descendantid IN (%s)" % (printerids, printerids))
+            self.beginTransaction()
+            try :
+                for q in queries :
+                    self.doModify(q)
+                if useclosure :
+                    # members of the deleted printer groups may
+                    # have other paths to their ancestors.
+                    self.rebuildPrinterGroupsClosure(descendants)
+            except :
+                self.rollbackTransaction()
+                raise
+            else :
+                self.commitTransaction()
+                self.flushDeletedPrinters(printers)
 
-    def deleteManyUserPQuotas(self, printers, users) :
+    def deleteManyUserPQuotas(self, printers, users, percent=None) :
         """Deletes many user print quota entries."""
         printerids = ", ".join(["%s" % self.doQuote(p.ident) for p in printers])
         userids = ", ".join(["%s" % self.doQuote(u.ident) for u in users])
@@ -949,7 +1439,7 @@ class SQLStorage :
                     "DELETE FROM userpquota WHERE userid IN (%s) AND printerid IN (%s)" \
                                  % (userids, printerids),])
 
-    def deleteManyGroupPQuotas(self, printers, groups) :
+    def deleteManyGroupPQuotas(self, printers, groups, percent=None) :
         """Deletes many group print quota entries."""
         printerids = ", ".join(["%s" % self.doQuote(p.ident) for p in printers])
         groupids = ", ".join(["%s" % self.doQuote(g.ident) for g in groups])
@@ -985,14 +1475,22 @@ class SQLStorage :
 
     def deletePrinter(self, printer) :
         """Completely deletes a printer from the database."""
-        for q in [
+        descendants = self.getDescendantPrinterIds(printer)
+        queries = [
                     "DELETE FROM printergroupsmembers WHERE groupid=%s OR printerid=%s" % (self.doQuote(printer.ident), self.doQuote(printer.ident)),
                     "DELETE FROM jobhistory WHERE printerid=%s" % self.doQuote(printer.ident),
                     "DELETE FROM grouppquota WHERE printerid=%s" % self.doQuote(printer.ident),
                     "DELETE FROM userpquota WHERE printerid=%s" % self.doQuote(printer.ident),
                     "DELETE FROM printers WHERE id=%s" % self.doQuote(printer.ident),
-                  ] :
+                  ]
+        useclosure = self.usePrinterGroupsClosure()
+        if useclosure :
+            queries.insert(0, "DELETE FROM printergroupsclosure WHERE ancestorid=%s OR descendantid=%s" % (self.doQuote(printer.ident), self.doQuote(printer.ident)))
+        for q in queries :
             self.doModify(q)
+        if useclosure :
+            # its members may have other paths to its ancestors.
+            self.rebuildPrinterGroupsClosure(descendants)
 
     def deleteBillingCode(self, code) :
         """Completely deletes a billing code from the database."""
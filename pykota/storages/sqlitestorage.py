@@ -24,7 +24,8 @@
 
 from pykota.errors import PyKotaStorageError
 from pykota.storage import BaseStorage
-from pykota.storages.sql import SQLStorage
+from pykota.storages.sql import SQLStorage, FETCHSIZE
+from pykota.utils import unicodeToDatabase
 
 try :
     from pysqlite2 import dbapi2 as sqlite
@@ -41,6 +42,7 @@ class Storage(BaseStorage, SQLStorage) :
         self.tool.logdebug("Trying to open database (dbname=%s)..." % repr(dbname))
         self.database = sqlite.connect(dbname, isolation_level=None)
         self.cursor = self.database.cursor()
+        self.statements = {}
         self.closed = False
         try :
             self.doQuery("PRAGMA foreign_keys = True;")
@@ -62,36 +64,61 @@ class Storage(BaseStorage, SQLStorage) :
         self.tool.logdebug("Transaction begins...")
 
     def commitTransaction(self) :
-        """Commits a transaction."""
-        self.cursor.execute("COMMIT;")
+        """Commits a transaction, executing the deferred modify queries first.
+
+           Consecutive executions of the same statement are grouped.
+        """
+        statements = self.endBatch()
+        try :
+            index = 0
+            while index < len(statements) :
+                name = statements[index][0]
+                paramslist = []
+                while (index < len(statements)) and (statements[index][0] == name) :
+                    paramslist.append(self.bindParameters(statements[index][1]))
+                    index += 1
+                query = self.getPreparedStatement(name)
+                self.querydebug("QUERY : %s" % query)
+                self.querydebug("PARAMETERS : %s" % repr(paramslist))
+                self.cursor.executemany(query, paramslist)
+            self.cursor.execute("COMMIT;")
+        except self.database.Error, msg :
+            self.tool.logdebug("Query failed : %s" % repr(msg))
+            self.cursor.execute("ROLLBACK;")
+            raise PyKotaStorageError, repr(msg)
         self.tool.logdebug("Transaction committed.")
 
     def rollbackTransaction(self) :
         """Rollbacks a transaction."""
+        self.endBatch()
         self.cursor.execute("ROLLBACK;")
         self.tool.logdebug("Transaction aborted.")
 
-    def doQuery(self, query) :
-        """Executes an SQL query."""
+    def doQuery(self, query, params=None) :
+        """Executes an SQL query, binding its parameters if any."""
         query = query.strip()
         if not query.endswith(';') :
             query += ';'
         self.querydebug("QUERY : %s" % query)
         try :
-            self.cursor.execute(query)
+            if params is None :
+                self.cursor.execute(query)
+            else :
+                self.querydebug("PARAMETERS : %s" % repr(params))
+                self.cursor.execute(query, params)
         except self.database.Error, msg :
             self.tool.logdebug("Query failed : %s" % repr(msg))
             raise PyKotaStorageError, repr(msg)
 
-    def doRawSearch(self, query) :
+    def doRawSearch(self, query, params=None) :
         """Executes a raw search query."""
-        self.doQuery(query)
+        self.doQuery(query, params)
         result = self.cursor.fetchall()
         return result
 
-    def doSearch(self, query) :
+    def doSearch(self, query, params=None) :
         """Does a search query."""
-        result = self.doRawSearch(query)
+        result = self.doRawSearch(query, params)
         if result :
             rows = []
             fields = {}
@@ -109,6 +136,39 @@ class Storage(BaseStorage, SQLStorage) :
                 rows.append(rowdict)
             return rows
 
+    def hasTable(self, tablename) :
+        """Returns True if a table exists."""
+        return bool(self.doSearch("SELECT name FROM sqlite_master WHERE type='table' AND name=%s" % self.doQuote(tablename)))
+
+    def getPreparedStatement(self, name) :
+        """Returns a named statement in SQLite's parameter style.
+
+           The statement's text never changes, so SQLite's own
+           statement cache compiles it only once per connection.
+        """
+        try :
+            return self.statements[name]
+        except KeyError :
+            query = self.statements[name] = self.preparedstatements[name].replace("%s", "?")
+            return query
+
+    def bindParameters(self, params) :
+        """Converts parameters to the types PySQLite expects."""
+        bound = []
+        for param in params :
+            if type(param) == type("") :
+                param = param.decode("UTF-8")
+            bound.append(param)
+        return bound
+
+    def doPreparedSearch(self, name, params) :
+        """Does a search query from a named statement, binding its parameters."""
+        return self.doSearch(self.getPreparedStatement(name), self.bindParameters(params))
+
+    def executePreparedModify(self, name, params) :
+        """Executes a modify query from a named statement, binding its parameters."""
+        return self.doQuery(self.getPreparedStatement(name), self.bindParameters(params))
+
     def doQuote(self, field) :
         """Quotes a field for use as a string in SQL queries."""
         if type(field) == type(0.0) :
@@ -122,10 +182,63 @@ class Storage(BaseStorage, SQLStorage) :
         else :
             return "NULL"
 
-    def prepareRawResult(self, result) :
-        """Prepares a raw result by including the headers."""
-        if result :
-            entries = [tuple([f[0] for f in self.cursor.description])]
-            entries.extend(result)
-            return entries
+    def patternToGlob(self, pattern) :
+        """Converts an fnmatch pattern to a GLOB pattern."""
+        glob = []
+        for token in self.splitPattern(pattern) :
+            if isinstance(token, tuple) :
+                (negated, stuff) = token
+                if negated :
+                    glob.append("[^%s]" % stuff)
+                elif stuff.startswith("^") :
+                    glob.append("?") # would be negated by GLOB, fnmatch decides
+                else :
+                    glob.append("[%s]" % stuff)
+            elif token in ("*", "?") :
+                glob.append(token)
+            elif token == "[" :
+                glob.append("[[]")
+            else :
+                glob.append(token)
+        return "".join(glob)
+
+    def patternToPredicate(self, keyname, pattern) :
+        """Returns an SQL condition true at least for the names which match an fnmatch pattern.
+
+           Unlike LIKE, GLOB is case sensitive and knows about sets of characters.
+        """
+        condition = "%s=%s" % (keyname, self.doQuote(unicodeToDatabase(pattern)))
+        if self.hasWildCards(pattern) :
+            wildcards = "%s GLOB %s" % (keyname, self.doQuote(unicodeToDatabase(self.patternToGlob(pattern))))
+            if "[" in pattern :
+                condition = "(%s OR %s)" % (wildcards, condition)
+            else :
+                condition = wildcards
+        return condition
+
+    def doStreamedSearch(self, query) :
+        """Executes a search query, yields its headers then its records.
+
+           The records are fetched a few at a time, with a cursor of
+           their own so that other queries can be done meanwhile.
+        """
+        query = query.strip()
+        if not query.endswith(';') :
+            query += ';'
+        self.querydebug("QUERY : %s" % query)
+        cursor = self.database.cursor()
+        try :
+            cursor.execute(query)
+        except self.database.Error, msg :
+            self.tool.logdebug("Query failed : %s" % repr(msg))
+            cursor.close()
+            raise PyKotaStorageError, repr(msg)
+        yield tuple([f[0] for f in cursor.description])
+        while 1 :
+            records = cursor.fetchmany(FETCHSIZE)
+            if not records :
+                break
+            for record in records :
+                yield record
+        cursor.close()
 
@@ -296,6 +296,7 @@ class PyKotaTool(Tool) :
     def clean(self) :
         """Ensures that the database is closed."""
         try :
+            self.storage.logCacheStatistics()
             self.storage.close()
         except (TypeError, NameError, AttributeError) :
             pass
@@ -432,10 +433,9 @@ class PyKotaTool(Tool) :
         warned = False
 
         # first we check any group the user is a member of
-        for group in self.storage.getUserGroups(user) :
+        for grouppquota in userpquota.GroupsPQuota :
             # No need to check anything if the group is in noquota mode
-            if group.LimitBy != "noquota" :
-                grouppquota = self.storage.getGroupPQuota(group, printer)
+            if grouppquota.Group.LimitBy != "noquota" :
                 # for the printer and all its parents
                 for gpquota in [ grouppquota ] + grouppquota.ParentPrintersGroupPQuota :
                     if gpquota.Exists :
@@ -119,7 +119,8 @@ data_files.append((ldapdirectory, ["initscripts/ldap/README.ldap",
                                    "initscripts/ldap/pykota.schema",
                                    "initscripts/ldap/pykota-sunds-indexes.ldif",
                                    "initscripts/ldap/pykota-schema-sunds.ldif",
-                                   "initscripts/ldap/pykota-sample.ldif"]))
+                                   "initscripts/ldap/pykota-sample.ldif",
+                                   "initscripts/ldap/move-ldap-jobs.py"]))
 
 mysqldirectory = os.sep.join([directory, "mysql"])
 data_files.append((mysqldirectory, ["initscripts/mysql/README.mysql",
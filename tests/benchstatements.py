@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyKota : Print Quotas for CUPS
+#
+# (c) 2003-2013 Jerome Alet <alet@librelogiciel.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id$
+
+
+"""Measures the cost of the SQL queries done for each print job.
+
+   The same queries are run with their parameters quoted inline, as
+   PyKota used to do, then bound to prepared statements. Everything
+   is written inside a transaction which is rolled back at the end.
+"""
+
+import sys
+import time
+
+import pykota.appinit
+
+from pykota.tool import PyKotaTool
+from pykota.storages.sql import SQLStorage
+
+class Bench(PyKotaTool) :
+    """A tool which only needs to open the database."""
+    pass
+
+def quotedSearch(storage, name, params) :
+    """Runs a search the old way."""
+    return SQLStorage.doPreparedSearch(storage, name, params)
+
+def quotedModify(storage, name, params) :
+    """Runs a modification the old way."""
+    return SQLStorage.executePreparedModify(storage, name, params)
+
+def preparedSearch(storage, name, params) :
+    """Runs a search through the backend's prepared statements."""
+    return storage.doPreparedSearch(name, params)
+
+def preparedModify(storage, name, params) :
+    """Runs a modification through the backend's prepared statements."""
+    return storage.doPreparedModify(name, params)
+
+def printJob(storage, search, modify, user, printer, jobnumber) :
+    """Does the queries cupspykota does for a typical print job."""
+    search(storage, "getuser", (user.Name.encode("UTF-8"),))
+    search(storage, "getprinter", (printer.Name.encode("UTF-8"),))
+    search(storage, "getparentprinters", (printer.ident,))
+    search(storage, "getusergroups", (user.ident,))
+    search(storage, "getuserpquota", (user.ident, printer.ident))
+    search(storage, "getlastjob", (printer.ident,))
+    modify(storage, "increaseuserpquotapages", (1, 1, user.ident))
+    modify(storage, "decreaseuserbalance", (0.0, user.ident))
+    modify(storage, "insertjobnosize", (user.ident, printer.ident,
+                                        "bench-%i" % jobnumber, 0, "ALLOW",
+                                        "benchfile", "benchtitle", 1, "",
+                                        "localhost", 1024, None, None,
+                                        None, None, None))
+
+def timeJobs(storage, search, modify, user, printer, nbjobs) :
+    """Returns the time spent per job, in milliseconds."""
+    storage.beginTransaction()
+    try :
+        before = time.time()
+        for i in range(nbjobs) :
+            printJob(storage, search, modify, user, printer, i)
+        elapsed = time.time() - before
+    finally :
+        storage.rollbackTransaction()
+    return (elapsed * 1000.0) / nbjobs
+
+if __name__ == "__main__" :
+    if len(sys.argv) < 3 :
+        sys.stderr.write("usage :  %s  UserName  PrinterName  [NbJobs]\n" % sys.argv[0])
+    else :
+        username = sys.argv[1].decode("UTF-8")
+        printername = sys.argv[2].decode("UTF-8")
+        if len(sys.argv) > 3 :
+            nbjobs = int(sys.argv[3])
+        else :
+            nbjobs = 1000
+        bench = Bench()
+        try :
+            bench.deferredInit()
+            storage = bench.storage
+            user = storage.getUser(username)
+            printer = storage.getPrinter(printername)
+            if not (user.Exists and printer.Exists) :
+                sys.stderr.write("User %s and printer %s must exist.\n" % (sys.argv[1], sys.argv[2]))
+            else :
+                # one untimed job first so that both runs
+                # see the same database and OS caches
+                timeJobs(storage, quotedSearch, quotedModify, user, printer, 1)
+                quoted = timeJobs(storage, quotedSearch, quotedModify, user, printer, nbjobs)
+                prepared = timeJobs(storage, preparedSearch, preparedModify, user, printer, nbjobs)
+                sys.stdout.write("%i jobs, %i queries per job\n" % (nbjobs, 9))
+                sys.stdout.write("Quoted inline   : %.3f ms per job\n" % quoted)
+                sys.stdout.write("Prepared        : %.3f ms per job\n" % prepared)
+                if prepared :
+                    sys.stdout.write("Speedup         : %.2fx\n" % (quoted / prepared))
+        finally :
+            bench.clean()
@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyKota : Print Quotas for CUPS
+#
+# (c) 2003-2013 Jerome Alet <alet@librelogiciel.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id$
+
+
+"""Checks that patterns matched by the database give the same results
+   as fnmatch applied to every name, like PyKota used to do.
+
+   Patterns can be given on the command line, else a set of patterns
+   using all of fnmatch's and SQL's special characters is used.
+"""
+
+import sys
+import fnmatch
+
+import pykota.appinit
+
+from pykota.tool import PyKotaTool
+from pykota.utils import databaseToUnicode
+
+PATTERNS = [ u"*", u"a*", u"A*", u"?", u"*?*", u"*%*", u"*_*", u"*=*",
+             u"*\\*", u"*'*", u"[", u"[]", u"[!]", u"*[*?]*", u"*[[]*",
+             u"*[]]*", u"*[!]]*", u"[a-m]*", u"[!a-m]*", u"[^a-m]*",
+             u"*[^]*", u"*!*", u"a*,b*", u"*e,*[0-9]" ]
+
+TABLES = [ ("users", "username", "getMatchingUsers"),
+           ("groups", "groupname", "getMatchingGroups"),
+           ("printers", "printername", "getMatchingPrinters"),
+           ("billingcodes", "billingcode", "getMatchingBillingCodes") ]
+
+class Compare(PyKotaTool) :
+    """A tool which only needs to open the database."""
+    pass
+
+def allNames(storage, tablename, keyname) :
+    """Returns all the names from a table."""
+    result = storage.doSearch("SELECT %s FROM %s" % (keyname, tablename)) or []
+    return [databaseToUnicode(record[keyname]) for record in result]
+
+def slowMatch(names, pattern) :
+    """Returns the sorted names which match the patterns, the old way."""
+    patterns = pattern.split(",")
+    matching = []
+    for name in names :
+        if name in patterns :
+            matching.append(name)
+        else :
+            for p in patterns :
+                if fnmatch.fnmatchcase(name, p) :
+                    matching.append(name)
+                    break
+    matching.sort()
+    return matching
+
+if __name__ == "__main__" :
+    if len(sys.argv) > 1 :
+        patterns = [arg.decode("UTF-8") for arg in sys.argv[1:]]
+    else :
+        patterns = PATTERNS
+    compare = Compare()
+    differences = 0
+    try :
+        compare.deferredInit()
+        storage = compare.storage
+        for (tablename, keyname, method) in TABLES :
+            names = allNames(storage, tablename, keyname)
+            for pattern in patterns :
+                expected = slowMatch(names, pattern)
+                got = [entry.Name for entry in getattr(storage, method)(pattern)]
+                got.sort()
+                if got != expected :
+                    differences += 1
+                    sys.stdout.write("%s %s : expected %s, got %s\n" % (tablename, \
+                                     pattern.encode("UTF-8"), repr(expected), repr(got)))
+            sys.stdout.write("%s : %i names, %i patterns checked\n" % (tablename, len(names), len(patterns)))
+    finally :
+        compare.clean()
+    if differences :
+        sys.stdout.write("%i differences found\n" % differences)
+        sys.exit(1)
+    sys.stdout.write("No difference found\n")
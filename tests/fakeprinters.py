@@ -0,0 +1,249 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PyKota : Print Quotas for CUPS
+#
+# (c) 2003-2013 Jerome Alet <alet@librelogiciel.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id$
+
+
+"""Fakes many SNMP and PJL printers on loopback addresses, to check
+   pkturnkey's printer probing without any real printer.
+
+   Each printer listens on its own loopback address, from 127.1.1.1
+   onwards, and printer number N behaves according to N modulo 6 :
+   SNMP, PJL on port 9100, PJL on port 9101, PJL on port 9102, silent
+   (accepts connections but never answers), or absent.
+
+   By default the printers are probed the way pkturnkey --doconf does,
+   and the results are checked. With --serve the printers are only
+   served, until interrupted, for example to run pkturnkey against CUPS
+   queues which print to them : since pkturnkey sends its SNMP queries
+   to port 161, this needs to be launched as root then.
+
+   usage : fakeprinters.py [--serve] [--snmpport PORT] [nbprinters]
+"""
+
+import sys
+import os
+import time
+import errno
+import socket
+import select
+import tempfile
+import threading
+
+import pykota.appinit
+
+from pykota import snmppoller
+from pykota.prober import Prober, loadCache, saveCache
+
+NBPRINTERS = 120
+SNMPPORT = 16161        # an unprivileged port, used when checking
+PROBETIMEOUT = 1.0
+PJLANSWER = '@PJL INFO STATUS\r\nCODE=10001\r\nDISPLAY="Ready"\r\nONLINE=TRUE\r\n\f'
+BEHAVIOURS = [ ("snmp", None, "hardware(snmp)"),
+               ("pjl", 9100, "hardware(pjl)"),
+               ("pjl", 9101, "hardware(pjl:9101)"),
+               ("pjl", 9102, "hardware(pjl:9102)"),
+               ("silent", 9100, "software()"),
+               ("absent", 9100, "software()"),
+             ]
+
+class Tool :
+    """Just what the prober needs from a PyKota tool."""
+    def logdebug(self, message) :
+        """Discards debug messages."""
+        pass
+
+class FakePrinters :
+    """Serves all the fake printers from a single poll() loop."""
+    def __init__(self, nbprinters, snmpport) :
+        """Opens the listening sockets."""
+        self.printers = []
+        self.sockets = {}
+        self.poller = select.poll()
+        for number in range(nbprinters) :
+            address = "127.%i.%i.%i" % (1 + (number // 250) // 250, \
+                                        1 + (number // 250) % 250, \
+                                        1 + number % 250)
+            (behaviour, port, expected) = BEHAVIOURS[number % len(BEHAVIOURS)]
+            if behaviour in ("snmp", "silent") :
+                self.listen(socket.SOCK_DGRAM, address, snmpport, behaviour)
+            if behaviour in ("pjl", "silent") :
+                self.listen(socket.SOCK_STREAM, address, port, behaviour)
+            self.printers.append(("fake%03i" % number, address, port or 9100, expected))
+
+    def listen(self, socktype, address, port, behaviour) :
+        """Opens a listening socket."""
+        sock = socket.socket(socket.AF_INET, socktype)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((address, port))
+        if socktype == socket.SOCK_STREAM :
+            sock.listen(16)
+            kind = "listen"
+        else :
+            kind = "udp"
+        self.register(sock, kind, behaviour)
+
+    def register(self, sock, kind, behaviour) :
+        """Watches a socket."""
+        sock.setblocking(0)
+        self.sockets[sock.fileno()] = (sock, kind, behaviour)
+        self.poller.register(sock.fileno(), select.POLLIN)
+
+    def unregister(self, sock) :
+        """Stops watching a socket and closes it."""
+        self.poller.unregister(sock.fileno())
+        del self.sockets[sock.fileno()]
+        sock.close()
+
+    def answerSNMP(self, sock, behaviour) :
+        """Answers an SNMP request with a page counter."""
+        try :
+            (data, client) = sock.recvfrom(65536)
+        except socket.error :
+            return
+        if behaviour == "silent" :
+            return
+        try :
+            (community, pdutype, requestid, errorstatus, errorindex, varbinds) = snmppoller.decodeMessage(data)
+        except ValueError :
+            return
+        if pdutype != snmppoller.GETREQUEST :
+            return
+        answer = snmppoller.encodeMessage(community, snmppoller.GETRESPONSE, requestid, \
+                                          [(oid, (snmppoller.COUNTER32, 12345)) for (oid, value) in varbinds])
+        sock.sendto(answer, client)
+
+    def serveOnce(self, timeout) :
+        """Serves what is ready, waiting at most timeout seconds."""
+        try :
+            events = self.poller.poll(int(timeout * 1000))
+        except select.error, msg :
+            if msg[0] == errno.EINTR :
+                return
+            raise
+        for (fd, event) in events :
+            if not self.sockets.has_key(fd) :
+                continue
+            (sock, kind, behaviour) = self.sockets[fd]
+            if kind == "udp" :
+                self.answerSNMP(sock, behaviour)
+            elif kind == "listen" :
+                try :
+                    (client, dummy) = sock.accept()
+                except socket.error :
+                    continue
+                self.register(client, "client", behaviour)
+            else :
+                try :
+                    data = sock.recv(1024)
+                except socket.error :
+                    data = ""
+                if not data :
+                    self.unregister(sock)
+                elif (behaviour == "pjl") and ("@PJL INFO STATUS" in data) :
+                    sock.send(PJLANSWER)
+
+    def serveForever(self) :
+        """Serves until interrupted."""
+        while 1 :
+            self.serveOnce(1.0)
+
+    def close(self) :
+        """Closes all the sockets."""
+        for (sock, kind, behaviour) in self.sockets.values() :
+            sock.close()
+        self.sockets = {}
+
+def check(printers, snmpport) :
+    """Probes the fake printers in a thread pool, returns the number of errors."""
+    stop = []
+    def serve() :
+        """Serves the fake printers while they are probed."""
+        while not stop :
+            printers.serveOnce(0.1)
+    server = threading.Thread(target=serve)
+    server.setDaemon(True)
+    server.start()
+
+    prober = Prober(Tool(), timeout=PROBETIMEOUT, snmpport=snmpport)
+    before = time.time()
+    results = prober.probeAll([(name, address, port) for (name, address, port, expected) in printers.printers])
+    elapsed = time.time() - before
+    stop.append(1)
+    server.join()
+
+    errors = 0
+    for (name, address, port, expected) in printers.printers :
+        if results.get(name) != expected :
+            errors += 1
+            sys.stdout.write("%s (%s:%s) : expected %s, got %s\n" % (name, address, port, expected, results.get(name)))
+    sys.stdout.write("%i printers probed in %.2f seconds by %i workers\n" % (len(printers.printers), elapsed, prober.workers))
+
+    (fd, filename) = tempfile.mkstemp()
+    os.close(fd)
+    try :
+        cache = {}
+        for (name, accounter) in results.items() :
+            cache[name] = ("socket://%s" % name, accounter)
+        saveCache(filename, cache)
+        if loadCache(filename) != cache :
+            errors += 1
+            sys.stdout.write("Probe results differ once saved and loaded again\n")
+    finally :
+        os.remove(filename)
+    return errors
+
+if __name__ == "__main__" :
+    arguments = sys.argv[1:]
+    serve = False
+    snmpport = None
+    nbprinters = NBPRINTERS
+    while arguments :
+        argument = arguments.pop(0)
+        if argument == "--serve" :
+            serve = True
+        elif argument == "--snmpport" :
+            snmpport = int(arguments.pop(0))
+        else :
+            nbprinters = int(argument)
+    if snmpport is None :
+        if serve :
+            snmpport = 161
+        else :
+            snmpport = SNMPPORT
+    printers = FakePrinters(nbprinters, snmpport)
+    try :
+        if serve :
+            for (name, address, port, expected) in printers.printers :
+                sys.stdout.write("%s socket://%s:%s %s\n" % (name, address, port, expected))
+            sys.stdout.flush()
+            try :
+                printers.serveForever()
+            except KeyboardInterrupt :
+                pass
+            errors = 0
+        else :
+            errors = check(printers, snmpport)
+    finally :
+        printers.close()
+    if errors :
+        sys.stdout.write("%i errors found\n" % errors)
+        sys.exit(1)
+    if not serve :
+        sys.stdout.write("No error found\n")